@@ -0,0 +1,16 @@
+#!/bin/bash
+# Clones the primary with pg_basebackup on first start, then follows it as a hot standby
+set -e
+
+export PGPASSWORD="$PRIMARY_PASSWORD"
+until pg_isready -h "$PRIMARY_HOST" -p 5432 -U "$PRIMARY_USER"; do
+	sleep 1
+done
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+	# -R writes the recovery.conf that makes this server a standby streaming from the primary
+	pg_basebackup -h "$PRIMARY_HOST" -p 5432 -U "$PRIMARY_USER" -D "$PGDATA" -X stream -R
+	chmod 700 "$PGDATA"
+fi
+
+exec postgres
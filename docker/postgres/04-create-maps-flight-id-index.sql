@@ -0,0 +1,3 @@
+-- vendor_ids.maps flight_id lookups
+-- flight_id processing filters maps on substring(li_code, 4); this expression index lets those lookups avoid a seq scan
+CREATE INDEX maps_flight_id_idx ON vendor_ids.maps USING btree ((substring(li_code, 4)));
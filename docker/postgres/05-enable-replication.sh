@@ -0,0 +1,12 @@
+#!/bin/bash
+# Lets the replica service stream WAL from this server; ALTER SYSTEM settings apply from the next start
+set -e
+
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" --dbname "$POSTGRES_DB" <<-EOSQL
+	ALTER SYSTEM SET wal_level = replica;
+	ALTER SYSTEM SET max_wal_senders = 5;
+	ALTER SYSTEM SET wal_keep_segments = 64;
+	ALTER SYSTEM SET hot_standby = on;
+EOSQL
+
+echo "host replication all all md5" >> "$PGDATA/pg_hba.conf"
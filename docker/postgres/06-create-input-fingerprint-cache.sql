@@ -0,0 +1,52 @@
+-- snoopy.input_fingerprint_cache
+-- input fingerprint of the last full processing of each processing_id, with the flights whose output rows it covers; a unit
+-- of work whose inputs still have that fingerprint is skipped, as the output table already holds its expected data
+-- (see processor_config.input_fingerprint_cache)
+CREATE TABLE snoopy.input_fingerprint_cache (
+	processing_id_type text NOT NULL,
+	processing_id text NOT NULL,
+	input_fingerprint text NOT NULL,
+	flight_ids text[] NOT NULL,
+	updated_at timestamp NOT NULL DEFAULT now(),
+	PRIMARY KEY (processing_id_type, processing_id)
+);
+CREATE INDEX input_fingerprint_cache_flight_ids_idx ON snoopy.input_fingerprint_cache USING gin (flight_ids);
+GRANT ALL ON snoopy.input_fingerprint_cache TO db_username;
+
+-- Any write to the output table, by any engine or out of band, drops the fingerprints covering the flights it wrote,
+-- in the writing transaction. Each flight is dropped once per transaction; the flights already dropped are kept in a
+-- transaction local setting, so writing every row of a flight costs one lookup in the cache, not one per row.
+-- Security definer, so writers that may not change the cache can still write the output table.
+CREATE FUNCTION snoopy.drop_input_fingerprints_of_written_flights() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog AS $function$
+DECLARE
+    v_flight_id text;
+    v_dropped_flight_ids text;
+BEGIN
+    FOREACH v_flight_id IN ARRAY CASE TG_OP WHEN 'INSERT' THEN ARRAY[NEW.flight_id] WHEN 'DELETE' THEN ARRAY[OLD.flight_id]
+                                             ELSE ARRAY[OLD.flight_id, NEW.flight_id] END LOOP
+        v_dropped_flight_ids := coalesce(nullif(current_setting('snoopy.input_fingerprint_dropped_flight_ids', true), ''), ',');
+        IF v_flight_id IS NOT NULL AND strpos(v_dropped_flight_ids, ',' || v_flight_id || ',') = 0 THEN
+            DELETE FROM snoopy.input_fingerprint_cache WHERE flight_ids @> ARRAY[v_flight_id];
+            PERFORM set_config('snoopy.input_fingerprint_dropped_flight_ids', v_dropped_flight_ids || v_flight_id || ',', true);
+        END IF;
+    END LOOP;
+    RETURN NULL;
+END
+$function$;
+
+CREATE FUNCTION snoopy.drop_all_input_fingerprints() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER SET search_path = pg_catalog AS $function$
+BEGIN
+    DELETE FROM snoopy.input_fingerprint_cache;
+    RETURN NULL;
+END
+$function$;
+
+CREATE TRIGGER drop_input_fingerprints_of_written_flights
+AFTER INSERT OR UPDATE OR DELETE ON snoopy.delivery_by_flight_creative_day
+FOR EACH ROW EXECUTE PROCEDURE snoopy.drop_input_fingerprints_of_written_flights();
+
+CREATE TRIGGER drop_all_input_fingerprints
+AFTER TRUNCATE ON snoopy.delivery_by_flight_creative_day
+FOR EACH STATEMENT EXECUTE PROCEDURE snoopy.drop_all_input_fingerprints();
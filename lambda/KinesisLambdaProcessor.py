@@ -1,17 +1,26 @@
-import base64
-import json
+import functools
 import logging
 import os
 import sys
-import traceback
+import time
+
+# cold start report, started before the imports it times
+from config import processor_config
+from helpers.startup_helper import ImportTimer
+import_timer = ImportTimer() if processor_config.import_time_report else None
+if import_timer:
+    import_timer.start()
 
 if os.getenv('env') in ['production', 'staging']:
     sys.path.insert(0, "thirdpartylib/")
 import psycopg2
-from sqlalchemy.exc import OperationalError
 
 from config import db_config
-from helpers.database_helper import (create_new_engine, process_processing_id, LOCK_ERROR_MESSAGE)
+from helpers.batch_helper import (decode_record_with_date_window, group_processing_ids, group_date_window_specs, process_processing_ids)
+from helpers.database_helper import (create_new_engine, prepare_connection, process_processing_id, resolve_date_window)
+from helpers.log_helper import log_info, log_sampled, log_error
+from helpers.metrics_helper import record_phase_metrics, time_phase, increment
+from helpers.retry_helper import call_with_retries
 
 ##### below setup will load on every new Execution Context container #####
 ##### 'cold' functions will setup a new container
@@ -29,50 +38,170 @@ db_password = db_config.db_password
 db_name = db_config.db_name
 db_postgres_string = "postgres://" + db_username + ":" + db_password + "@" + db_endpoint + "/" + db_name
 
-logger.info("Creating new database engine: " + db_postgres_string)
-engine = create_new_engine(db_postgres_string, pool_size=10, max_overflow=20)
+# one invocation runs at a time per container, so the pool only needs a connection per concurrent worker;
+# open the first one now so warm invocations start with a connected, prepared session
+engine = create_new_engine(db_postgres_string, pool_size=processor_config.processing_concurrency, max_overflow=0)
+# the URL's repr masks the password
+logger.info("Created new database engine: {!r}".format(engine.url))
+# timed apart from the rest of the init phase, which the cold start budget covers; see helpers/startup_helper.py
+initial_connection_start = time.perf_counter()
+try:
+    with engine.connect() as connection:
+        prepare_connection(connection)
+except Exception as e:
+    logger.error('Failed to open initial database connection: {}'.format(e))
+initial_connection_duration = time.perf_counter() - initial_connection_start
+
+# optional read replica the python engine computes expected data on; see helpers/replica_helper.py
+replica_engine = None
+if db_config.db_replica_endpoint:
+    replica_engine = create_new_engine("postgres://" + db_username + ":" + db_password + "@" + db_config.db_replica_endpoint + "/" + db_name,
+                                       pool_size=processor_config.processing_concurrency, max_overflow=0)
+    logger.info("Created new replica database engine: {!r}".format(replica_engine.url))
+
+def process_processing_id_with_psycopg2(connection, processing_id_type, processing_id):
+    # imported on first use, so the default python engine doesn't import it on cold start
+    from helpers.psycopg2_helper import process_processing_id_with_psycopg2
+    return process_processing_id_with_psycopg2(connection, processing_id_type, processing_id)
 
-# Expected messages handling
-PROCESSING_ID_TYPE_JSON_HEADER = 'processing_id_type'
-PROCESSING_ID_JSON_HEADER = 'processing_id'
+def process_processing_id_on_server(connection, processing_id_type, processing_id):
+    # imported on first use, so the default python engine doesn't import it on cold start
+    from helpers.server_function_helper import process_processing_id_on_server
+    return process_processing_id_on_server(connection, processing_id_type, processing_id)
 
-MAXIMUM_RETRY_ON_DEADLOCK = 3
+def process_processing_id_with_replica(connection, processing_id_type, processing_id):
+    # imported on first use, so deployments without a replica don't import it on cold start
+    from helpers.replica_helper import process_processing_id_with_replica
+    return process_processing_id_with_replica(connection, processing_id_type, processing_id, replica_engine)
+
+PROCESS_FUNCTION_BY_PROCESSING_ENGINE = {
+    'python' : process_processing_id,
+    'psycopg2' : process_processing_id_with_psycopg2,
+    'server_function' : process_processing_id_on_server
+}
 
 def lambda_handler(event, context):    
+    # retries stop once the invocation is about to time out
+    process_function = functools.partial(process_with_retries, get_remaining_time_in_millis=context.get_remaining_time_in_millis if context else None)
+
+    with record_phase_metrics({'metric_scope': 'batch'}):
+        increment('records', len(event['Records']))
+        if processor_config.report_batch_item_failures:
+            return process_batch_reporting_item_failures(event, process_function)
+        return process_batch(event, process_function)
+
+def process_batch(event, process_function):
     # wrap all processing within try/except because we don't want failures to halt further processing
     try:
-        # we only expect one record to arrive at a time, but leaving this loop for best practice
-        for record in event['Records']:
-            # Kinesis data is base64 encoded so decode here
-            payload = base64.b64decode(record['kinesis']['data'])
-            decoded_payload = payload.decode("utf-8")
-            logger.info("Processing payload: " + decoded_payload)
-
-            json_payload = json.loads(decoded_payload)
-            processing_id_type = json_payload[PROCESSING_ID_TYPE_JSON_HEADER]
-            processing_id = json_payload[PROCESSING_ID_JSON_HEADER]
-
-            # attempt to process, retrying up to MAXIMUM_RETRY_ON_DEADLOCK times
-            retries_left = MAXIMUM_RETRY_ON_DEADLOCK
-            while retries_left >= 0:
-                try:
-                    connection = get_connection()
-                    process_processing_id(connection, processing_id_type, processing_id)
-                    break;
-                except OperationalError as e:
-                    if LOCK_ERROR_MESSAGE in traceback.format_exc() and retries_left > 0:
-                        logger.warn('Lock timeout trying to process {0}. Number of attempts left: {1}'.format(decoded_payload, retries_left))
-                    else:
-                        raise
-                finally:
-                    connection.close()
-                retries_left -= 1
+        # decode the whole batch first so duplicate units of work are only processed once
+        with time_phase('decode'):
+            decoded_records = [decode_record_with_date_window(record) for record in event['Records']]
+            processing_id_pairs = [processing_id_pair for processing_id_pair, date_window_spec in decoded_records]
+            pair_indexes_by_processing_id_pair = group_processing_ids(processing_id_pairs)
+            unique_processing_id_pairs = list(pair_indexes_by_processing_id_pair)
+            date_window_specs_by_processing_id_pair = group_date_window_specs(
+                pair_indexes_by_processing_id_pair, [date_window_spec for processing_id_pair, date_window_spec in decoded_records])
+
+        process_function = functools.partial(process_function, date_window_specs_by_processing_id_pair=date_window_specs_by_processing_id_pair)
+        results = process_processing_ids(unique_processing_id_pairs, process_function, processor_config.processing_concurrency)
+        failed_units = sum(1 for error in results.values() if error)
+        log_info('batch_summary', records=len(processing_id_pairs), units_of_work=len(unique_processing_id_pairs), failed_units_of_work=failed_units)
+        if failed_units:
+            return 'Failed to process {} records'.format(len(event['Records']))
     
     except Exception as e:
-        logger.error(traceback.format_exc())
+        log_error('batch_failed', records=len(event['Records']))
         return 'Failed to process {} records'.format(len(event['Records']))
 
     return 'Successfully processed {} records.'.format(len(event['Records']))
 
+def process_batch_reporting_item_failures(event, process_function):
+    """
+    Processes every record of the batch on its own, so one bad record does not fail the whole batch.
+    Records that could not be decoded or whose unit of work failed are reported back to the event source,
+    which only retries those records.
+
+    :param event: Kinesis lambda event
+    :param process_function: Function(processing_id_type, processing_id) processing one unit of work
+    :return: Dict, {'batchItemFailures': List({'itemIdentifier': String sequence number of a failed record})}
+    """
+    records = event['Records']
+    failed_record_indexes = set()
+
+    decoded_record_indexes = []
+    processing_id_pairs = []
+    date_window_specs = []
+    with time_phase('decode'):
+        for record_index, record in enumerate(records):
+            try:
+                processing_id_pair, date_window_spec = decode_record_with_date_window(record)
+                processing_id_pairs.append(processing_id_pair)
+                date_window_specs.append(date_window_spec)
+                decoded_record_indexes.append(record_index)
+            except Exception as e:
+                log_error('decode_failed', sequence_number=record['kinesis']['sequenceNumber'])
+                failed_record_indexes.add(record_index)
+
+        pair_indexes_by_processing_id_pair = group_processing_ids(processing_id_pairs)
+        date_window_specs_by_processing_id_pair = group_date_window_specs(pair_indexes_by_processing_id_pair, date_window_specs)
+    process_function = functools.partial(process_function, date_window_specs_by_processing_id_pair=date_window_specs_by_processing_id_pair)
+    results = process_processing_ids(list(pair_indexes_by_processing_id_pair), process_function, processor_config.processing_concurrency)
+    for processing_id_pair, error in results.items():
+        if error:
+            failed_record_indexes.update(decoded_record_indexes[pair_index] for pair_index in pair_indexes_by_processing_id_pair[processing_id_pair])
+
+    log_info('batch_summary', records=len(records), units_of_work=len(results), failed_units_of_work=sum(1 for error in results.values() if error),
+             failed_records=len(failed_record_indexes))
+    return {'batchItemFailures': [{'itemIdentifier': records[record_index]['kinesis']['sequenceNumber']}
+                                  for record_index in sorted(failed_record_indexes)]}
+
+def process_with_retries(processing_id_type, processing_id, get_remaining_time_in_millis=None, date_window_specs_by_processing_id_pair=None):
+    log_sampled('processing', processing_id_type=processing_id_type, processing_id=processing_id)
+
+    process_function = PROCESS_FUNCTION_BY_PROCESSING_ENGINE[processor_config.processing_engine]
+    if replica_engine is not None and process_function is process_processing_id:
+        process_function = process_processing_id_with_replica
+    # only the python engine on the primary limits a unit of work to the dates its events changed; the others process its whole history
+    date_window_specs = None
+    if process_function is process_processing_id and date_window_specs_by_processing_id_pair:
+        date_window_specs = date_window_specs_by_processing_id_pair.get((processing_id_type, processing_id))
+
+    # attempt to process on a new connection each time, retrying retryable database errors with backoff
+    def attempt():
+        increment('attempts')
+        with time_phase('connect'):
+            connection = get_connection()
+        try:
+            start = time.perf_counter()
+            date_window = None
+            if date_window_specs:
+                date_window = resolve_date_window(connection, date_window_specs)
+                process_function(connection, processing_id_type, processing_id, date_window)
+            else:
+                process_function(connection, processing_id_type, processing_id)
+            # slow units of work have their query plan captured while the data they ran on is still current
+            if processor_config.slow_invocation_threshold_ms:
+                # imported only when query plans are captured
+                from helpers.query_plan_helper import maybe_capture_query_plan
+                maybe_capture_query_plan(connection, processing_id_type, processing_id, (time.perf_counter() - start) * 1000, date_window)
+        finally:
+            connection.close()
+
+    with record_phase_metrics({'processing_id_type': processing_id_type},
+                              {'processing_id': processing_id, 'processing_engine': processor_config.processing_engine}):
+        try:
+            call_with_retries(attempt, '{0} {1}'.format(processing_id_type, processing_id), get_remaining_time_in_millis)
+        except Exception:
+            increment('failures')
+            # logged here, while the unit's phase timings are still being recorded
+            log_error('processing_failed')
+            raise
+
 def get_connection():
     return engine.connect()
+
+##### end of execution context setup #####
+if import_timer:
+    import_timer.stop()
+    import_timer.connect_duration = initial_connection_duration
+    logger.info(import_timer.get_report())
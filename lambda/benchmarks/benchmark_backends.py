@@ -0,0 +1,60 @@
+"""
+Benchmarks the Python-side overhead per invocation of the SQLAlchemy and psycopg2 processing engines.
+
+Processes one flight_id unit of work per synthetic flight --passes times with each engine on one warm connection.
+Reports wall time per invocation and the CPU time this process spent per invocation;
+the CPU time excludes waiting on Postgres, so it is the client overhead that differs between the engines.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.benchmark_backends --flights 200 --days 90 --passes 3
+"""
+import argparse
+import time
+
+from benchmarks.benchmark_helper import build_engine, load_upstream_table_data, get_flight_id_processing_id_pairs, truncate_output_table
+from helpers import database_helper as h
+from helpers.psycopg2_helper import process_processing_id_with_psycopg2
+
+PROCESS_FUNCTION_BY_BACKEND = {
+    'sqlalchemy' : h.process_processing_id,
+    'psycopg2' : process_processing_id_with_psycopg2
+}
+
+
+def run(connection, process_function, processing_id_pairs, passes):
+    """ :return: 2 element tuple, (Float wall ms per invocation, Float client CPU ms per invocation) """
+    start = time.time()
+    start_cpu = time.process_time()
+    for _ in range(passes):
+        for processing_id_type, processing_id in processing_id_pairs:
+            process_function(connection, processing_id_type, processing_id)
+    invocations = passes * len(processing_id_pairs)
+    return (time.time() - start) * 1000 / invocations, (time.process_time() - start_cpu) * 1000 / invocations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=100)
+    parser.add_argument('--creatives', type=int, default=5, help='creatives per flight')
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--passes', type=int, default=3)
+    parser.add_argument('--backends', nargs='+', default=sorted(PROCESS_FUNCTION_BY_BACKEND))
+    args = parser.parse_args()
+
+    engine = build_engine()
+    load_upstream_table_data(engine, args.flights, args.creatives, args.days)
+    processing_id_pairs = get_flight_id_processing_id_pairs(args.flights)
+
+    print('{:>11} {:>14} {:>20}'.format('backend', 'wall ms / call', 'client cpu ms / call'))
+    for backend in args.backends:
+        truncate_output_table(engine)
+        connection = engine.connect()
+        # warm up the session and the reflected output table before timing
+        run(connection, PROCESS_FUNCTION_BY_BACKEND[backend], processing_id_pairs[:1], 1)
+        wall_ms, cpu_ms = run(connection, PROCESS_FUNCTION_BY_BACKEND[backend], processing_id_pairs, args.passes)
+        connection.close()
+        print('{:>11} {:>14.2f} {:>20.2f}'.format(backend, wall_ms, cpu_ms))
+
+
+if __name__ == '__main__':
+    main()
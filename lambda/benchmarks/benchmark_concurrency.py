@@ -0,0 +1,57 @@
+"""
+Benchmarks batch throughput against the number of concurrent workers.
+
+Loads a synthetic set of flights into the test database (the docker-compose db by default),
+then processes one flight_id unit of work per flight for every worker count,
+starting each run from an empty output table.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.benchmark_concurrency --flights 200 --days 90 --workers 1 2 4 8 16
+"""
+import argparse
+import time
+
+from benchmarks.benchmark_helper import build_engine, load_upstream_table_data, get_flight_id_processing_id_pairs, truncate_output_table
+from helpers import database_helper as h
+from helpers.batch_helper import process_processing_ids
+
+
+def run(engine, flights, max_workers):
+    truncate_output_table(engine)
+
+    def process_function(processing_id_type, processing_id):
+        connection = engine.connect()
+        try:
+            h.process_processing_id(connection, processing_id_type, processing_id)
+        finally:
+            connection.close()
+
+    processing_id_pairs = get_flight_id_processing_id_pairs(flights)
+    start = time.time()
+    results = process_processing_ids(processing_id_pairs, process_function, max_workers)
+    elapsed = time.time() - start
+
+    failures = sum(1 for error in results.values() if error)
+    return elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=100)
+    parser.add_argument('--creatives', type=int, default=5, help='creatives per flight')
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    load_upstream_table_data(build_engine(1), args.flights, args.creatives, args.days)
+
+    print('{:>8} {:>10} {:>14} {:>9}'.format('workers', 'seconds', 'flights/sec', 'failures'))
+    for max_workers in args.workers:
+        engine = build_engine(max_workers)
+        elapsed, failures = run(engine, args.flights, max_workers)
+        engine.dispose()
+        print('{:>8} {:>10.2f} {:>14.1f} {:>9}'.format(max_workers, elapsed, args.flights / elapsed, failures))
+
+
+if __name__ == '__main__':
+    main()
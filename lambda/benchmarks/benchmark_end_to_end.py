@@ -0,0 +1,172 @@
+"""
+End-to-end benchmark of process_processing_id for every processing_id_type across data scales.
+
+For every scale, generates the upstream data with benchmarks.data_generator, then for each processing_id_type
+processes --samples processing_ids twice: a cold pass into an empty output table, then a warm pass
+reprocessing the unchanged data. Reports per call p50/p95 latency, statements issued, output rows written
+and WAL bytes generated.
+
+Results are saved as JSON with --output. Passing a previous run as --baseline compares every metric
+against it, and exits non-zero when any got worse by more than --threshold.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.benchmark_end_to_end --scales small medium --output results.json
+    $ python -m benchmarks.benchmark_end_to_end --scales small medium --baseline results.json --threshold 0.2
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from benchmarks.benchmark_helper import (build_engine, truncate_output_table, get_wal_location, get_wal_bytes_since,
+                                         OUTPUT_TABLE_FULL_NAME, FIRST_FLIGHT_ID)
+from benchmarks.data_generator import generate_upstream_table_data, DEFAULT_TIME_ZONES
+from config import processor_config
+from helpers import database_helper as h
+
+SCALES = OrderedDict([
+    ('small', {'flights': 100, 'days': 60}),
+    ('medium', {'flights': 1000, 'days': 180}),
+    ('large', {'flights': 5000, 'days': 365})
+])
+PASSES = ('cold', 'warm')
+METRICS = ('p50_ms', 'p95_ms', 'statements_per_call', 'rows_written_per_call', 'wal_bytes_per_call')
+# Latencies this small are noise, so they are never reported as regressions
+MINIMUM_COMPARED_MS = 1.0
+WRITE_STATEMENT_PREFIXES = ('INSERT', 'UPDATE', 'DELETE')
+
+
+class StatementCounter(object):
+    """ Counts the statements run through an engine, and the output table rows written by them """
+
+    def __init__(self, engine):
+        self.statements = 0
+        self.rows_written = 0
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        if statement.lstrip().upper().startswith(WRITE_STATEMENT_PREFIXES) and OUTPUT_TABLE_FULL_NAME in statement:
+            self.rows_written += max(cursor.rowcount, 0)
+
+
+def get_percentile(values, percentile):
+    """ Nearest rank percentile """
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(percentile / 100.0 * len(ordered))) - 1)]
+
+
+def get_processing_ids(processing_id_type, flights, samples, seed):
+    rng = random.Random(seed)
+    if processing_id_type == h.IMPORT_ID_STRING:
+        return [str(import_record_id) for import_record_id in range(1, min(samples, len(DEFAULT_TIME_ZONES)) + 1)]
+    flight_ids = rng.sample(range(FIRST_FLIGHT_ID, FIRST_FLIGHT_ID + flights), min(samples, flights))
+    if processing_id_type == h.LI_CODE_STRING:
+        return ['LI-{}'.format(flight_id) for flight_id in flight_ids]
+    return [str(flight_id) for flight_id in flight_ids]
+
+
+def run_pass(engine, statement_counter, processing_id_type, processing_ids):
+    """ :return: Dict, every metric of METRICS for the pass """
+    latencies_ms = []
+    statements, rows_written = statement_counter.statements, statement_counter.rows_written
+    wal_location = get_wal_location(engine)
+    connection = engine.connect()
+    for processing_id in processing_ids:
+        start = time.time()
+        h.process_processing_id(connection, processing_id_type, processing_id)
+        latencies_ms.append((time.time() - start) * 1000)
+    connection.close()
+    wal_bytes = get_wal_bytes_since(engine, wal_location)
+
+    calls = len(processing_ids)
+    return OrderedDict([
+        ('calls', calls),
+        ('p50_ms', get_percentile(latencies_ms, 50)),
+        ('p95_ms', get_percentile(latencies_ms, 95)),
+        ('statements_per_call', float(statement_counter.statements - statements) / calls),
+        ('rows_written_per_call', float(statement_counter.rows_written - rows_written) / calls),
+        ('wal_bytes_per_call', float(wal_bytes) / calls)
+    ])
+
+
+def run(engine, scales, samples, seed):
+    """ :return: List(Dict), one result per scale, processing_id_type and pass """
+    statement_counter = StatementCounter(engine)
+    results = []
+    for scale in scales:
+        generate_upstream_table_data(engine.connect(), seed=seed, **SCALES[scale])
+        for processing_id_type in h.PROCESSING_ID_TYPES:
+            processing_ids = get_processing_ids(processing_id_type, SCALES[scale]['flights'], samples, seed)
+            truncate_output_table(engine)
+            for pass_name in PASSES:
+                result = OrderedDict([('scale', scale), ('processing_id_type', processing_id_type), ('pass', pass_name)])
+                result.update(run_pass(engine, statement_counter, processing_id_type, processing_ids))
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def get_result_key(result):
+    return (result['scale'], result['processing_id_type'], result['pass'])
+
+
+def compare_to_baseline(results, baseline_results, threshold):
+    """ :return: List(String), one description per metric that got worse than its baseline by more than threshold """
+    baseline_result_by_key = {get_result_key(result): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_result_by_key.get(get_result_key(result))
+        if baseline_result is None:
+            continue
+        for metric in METRICS:
+            value, baseline_value = result[metric], baseline_result[metric]
+            if metric.endswith('_ms') and max(value, baseline_value) < MINIMUM_COMPARED_MS:
+                continue
+            if value > baseline_value * (1 + threshold):
+                regressions.append('{0} {1} {2} {3}: {4:.2f} against baseline {5:.2f}'.format(
+                    result['scale'], result['processing_id_type'], result['pass'], metric, value, baseline_value))
+    return regressions
+
+
+def print_result(result):
+    print('{:>7} {:>10} {:>5} {:>10.2f} {:>10.2f} {:>11.1f} {:>13.1f} {:>14.0f}'.format(*[result[key] for key in
+          ('scale', 'processing_id_type', 'pass', 'p50_ms', 'p95_ms', 'statements_per_call', 'rows_written_per_call', 'wal_bytes_per_call')]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['small'])
+    parser.add_argument('--samples', type=int, default=20, help='processing_ids processed per processing_id_type and pass')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='path to save the results to, as JSON')
+    parser.add_argument('--baseline', help='path of the JSON results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative increase of any metric over the baseline')
+    args = parser.parse_args()
+
+    print('{:>7} {:>10} {:>5} {:>10} {:>10} {:>11} {:>13} {:>14}'.format(
+        'scale', 'type', 'pass', 'p50 ms', 'p95 ms', 'statements', 'rows written', 'wal bytes'))
+    results = run(build_engine(), args.scales, args.samples, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'config': {'upsert_strategy': processor_config.upsert_strategy, 'locking_mode': processor_config.locking_mode,
+                                  'samples': args.samples, 'seed': args.seed},
+                       'results': results}, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file)['results'], args.threshold)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Shared setup for the benchmarks; every benchmark runs against the test database (the docker-compose db by default).
+"""
+from config import db_config
+from helpers import database_helper as h
+
+OUTPUT_TABLE_FULL_NAME = h.OUTPUT_SCHEMA + "." + h.OUTPUT_TABLE
+FIRST_FLIGHT_ID = 100000
+
+LOAD_UPSTREAM_TABLE_DATA_QUERIES = [
+    "TRUNCATE double_click.raw_delivery, double_click.import_metadata, vendor_ids.maps, vendor_ids.alignment_conflicts, static.calendar;",
+    """
+    INSERT INTO static.calendar (SELECT i::date FROM generate_series('2018-01-01'::date, '2018-01-01'::date + {days}, '1 day'::interval) i);
+    """,
+    """
+    INSERT INTO double_click.import_metadata (import_record_id, report_time_zone, s3_path, credential, profile_id)
+    VALUES (1, 'America/New_York', 'benchmark', 'benchmark', 0);
+    """,
+    """
+    INSERT INTO vendor_ids.maps (li_code, creative_rtb_id, date_start, date_end, vendor, vendor_id, is_deleted)
+    SELECT 'LI-' || f, f * 100 + c, '2018-01-01'::date, '2018-01-01'::date + {days}, 'doubleclick', (f * 100 + c)::text, FALSE
+    FROM generate_series({first_flight_id}, {first_flight_id} + {flights} - 1) f, generate_series(1, {creatives}) c;
+    """,
+    """
+    INSERT INTO double_click.raw_delivery (import_record_id, placement_id, "date", impressions, clicks, campaign_id, ad_id, advertiser, advertiser_id, campaign, placement_rate, site_keyname)
+    SELECT 1, f * 100 + c, '2018-01-01'::date + d, mod(f + c + d, 5000), mod(f + c + d, 7), 0, 0, 'benchmark', 0, 'benchmark', 0, 'benchmark'
+    FROM generate_series({first_flight_id}, {first_flight_id} + {flights} - 1) f, generate_series(1, {creatives}) c, generate_series(0, {days}) d;
+    """,
+    "ANALYZE;"
+]
+
+
+def build_engine(pool_size=1):
+    db_postgres_string = "postgres://" + db_config.db_username + ":" + db_config.db_password + "@" + \
+                         db_config.db_test_endpoint + "/" + db_config.db_name
+    return h.create_new_engine(db_postgres_string, pool_size=pool_size, max_overflow=0)
+
+
+def load_upstream_table_data(engine, flights, creatives, days):
+    with engine.begin() as connection:
+        for query in LOAD_UPSTREAM_TABLE_DATA_QUERIES:
+            connection.execute(query.format(flights=flights, creatives=creatives, days=days, first_flight_id=FIRST_FLIGHT_ID))
+
+
+def get_flight_id_processing_id_pairs(flights):
+    return [(h.FLIGHT_ID_STRING, str(flight_id)) for flight_id in range(FIRST_FLIGHT_ID, FIRST_FLIGHT_ID + flights)]
+
+
+def truncate_output_table(engine):
+    engine.execute("TRUNCATE {};".format(OUTPUT_TABLE_FULL_NAME))
+
+
+def get_wal_location(engine):
+    if engine.dialect.server_version_info >= (10,):
+        return engine.execute("SELECT pg_current_wal_lsn()::text").scalar()
+    return engine.execute("SELECT pg_current_xlog_location()::text").scalar()
+
+
+def get_wal_bytes_since(engine, wal_location):
+    if engine.dialect.server_version_info >= (10,):
+        query = "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %(wal_location)s::pg_lsn)"
+    else:
+        query = "SELECT pg_xlog_location_diff(pg_current_xlog_location(), %(wal_location)s::pg_lsn)"
+    return int(engine.execute(query, wal_location=wal_location).scalar())
+
+
+def get_output_table_tuples_written(connection):
+    """
+    Counts the output table tuples the connection's session wrote and hasn't reported to the statistics collector yet.
+    Nothing is reported during a transaction, so the difference of two calls in the same transaction is what it wrote in between.
+
+    :return: 2 element tuple, (Int tuples inserted, updated or deleted, Int of those updates that were HOT)
+    """
+    return tuple(connection.execute("""
+        SELECT n_tup_ins + n_tup_upd + n_tup_del, n_tup_hot_upd FROM pg_stat_xact_user_tables
+        WHERE schemaname = %(schema)s AND relname = %(table)s
+    """, schema=h.OUTPUT_SCHEMA, table=h.OUTPUT_TABLE).fetchone())
@@ -0,0 +1,87 @@
+"""
+Benchmarks the prepared expected data statements against sending the same SQL text on every call.
+
+For every processing_id_type, fills the expected data temp table --iterations times both ways,
+and reads the planning time Postgres reports through EXPLAIN ANALYZE for each.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.benchmark_prepared_statements --flights 200 --days 90 --iterations 50
+"""
+import argparse
+import re
+import time
+
+from benchmarks.benchmark_helper import build_engine, load_upstream_table_data, FIRST_FLIGHT_ID
+from helpers import database_helper as h
+
+PLANNING_TIME_PATTERN = re.compile(r'Planning time: ([\d.]+) ms', re.IGNORECASE)
+
+
+def get_processing_id_by_processing_id_type():
+    return {
+        h.LI_CODE_STRING : 'LI-' + str(FIRST_FLIGHT_ID),
+        h.FLIGHT_ID_STRING : str(FIRST_FLIGHT_ID),
+        h.IMPORT_ID_STRING : '1'
+    }
+
+
+def get_unprepared_queries(processing_id_type):
+    """ The statements prepare_connection prepares, as plain SQL text taking a pyformat processing_id """
+    conditional_query_tuple = h.WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE[processing_id_type]
+    queries = [
+        h.BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY.format(h.CONDITION_STRING_BY_PROCESSING_ID_TYPE[processing_id_type]),
+        h.INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY.format(h.TEMP_TABLE_NAME, *conditional_query_tuple)
+    ]
+    return [query.replace('$1', '%(processing_id)s') for query in queries]
+
+
+def get_prepared_queries(processing_id_type):
+    return ["EXECUTE {0}(%(processing_id)s)".format(statement_name) for statement_name in (
+        h.BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+        h.INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type]
+    )]
+
+
+def run(connection, queries, processing_id, iterations):
+    """ :return: 2 element tuple, (Float ms per call, Float planning ms per call) """
+    cursor = connection.connection.cursor()
+    start = time.time()
+    for _ in range(iterations):
+        for query in queries:
+            cursor.execute(query, {'processing_id': processing_id})
+        connection.connection.rollback()
+    elapsed_ms = (time.time() - start) * 1000 / iterations
+
+    planning_ms = 0.0
+    for _ in range(iterations):
+        for query in queries:
+            cursor.execute("EXPLAIN ANALYZE " + query, {'processing_id': processing_id})
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            planning_ms += float(PLANNING_TIME_PATTERN.search(plan).group(1))
+        connection.connection.rollback()
+    cursor.close()
+    return elapsed_ms, planning_ms / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=100)
+    parser.add_argument('--creatives', type=int, default=5, help='creatives per flight')
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    engine = build_engine()
+    load_upstream_table_data(engine, args.flights, args.creatives, args.days)
+    connection = engine.connect()
+    h.prepare_connection(connection)
+
+    print('{:>10} {:>11} {:>10} {:>13}'.format('type', 'statements', 'ms / call', 'planning ms'))
+    for processing_id_type, processing_id in sorted(get_processing_id_by_processing_id_type().items()):
+        for name, queries in (('unprepared', get_unprepared_queries(processing_id_type)), ('prepared', get_prepared_queries(processing_id_type))):
+            elapsed_ms, planning_ms = run(connection, queries, processing_id, args.iterations)
+            print('{:>10} {:>11} {:>10.2f} {:>13.3f}'.format(processing_id_type, name, elapsed_ms, planning_ms))
+
+
+if __name__ == '__main__':
+    main()
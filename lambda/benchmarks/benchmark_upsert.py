@@ -0,0 +1,61 @@
+"""
+Benchmarks the upsert strategies used to write expected rows to the output table.
+
+For every strategy, processes one flight_id unit of work per synthetic flight twice:
+a cold pass into an empty output table, then a warm pass reprocessing the unchanged data.
+Reports elapsed time, WAL bytes generated, output table tuples written and how many of them were HOT updates by each pass.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.benchmark_upsert --flights 200 --days 90 --strategies delete_insert on_conflict diff
+"""
+import argparse
+import time
+
+from benchmarks.benchmark_helper import (build_engine, load_upstream_table_data, get_flight_id_processing_id_pairs,
+                                         truncate_output_table, get_wal_location, get_wal_bytes_since, get_output_table_tuples_written)
+from config import processor_config
+from helpers import database_helper as h
+
+
+def run_pass(engine, processing_id_pairs):
+    wal_location = get_wal_location(engine)
+    tuples_written, hot_updates = 0, 0
+    start = time.time()
+    for processing_id_type, processing_id in processing_id_pairs:
+        connection = engine.connect()
+        try:
+            # the unit of work joins this transaction, so its writes can be counted before it commits
+            with connection.begin() as transaction:
+                tuples_written_before, hot_updates_before = get_output_table_tuples_written(connection)
+                h.process_processing_id(connection, processing_id_type, processing_id)
+                tuples_written_after, hot_updates_after = get_output_table_tuples_written(connection)
+            tuples_written += tuples_written_after - tuples_written_before
+            hot_updates += hot_updates_after - hot_updates_before
+        finally:
+            connection.close()
+    return time.time() - start, get_wal_bytes_since(engine, wal_location), tuples_written, hot_updates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=100)
+    parser.add_argument('--creatives', type=int, default=5, help='creatives per flight')
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--strategies', nargs='+', default=sorted(h.UPSERT_FUNCTION_BY_STRATEGY))
+    args = parser.parse_args()
+
+    engine = build_engine()
+    load_upstream_table_data(engine, args.flights, args.creatives, args.days)
+    processing_id_pairs = get_flight_id_processing_id_pairs(args.flights)
+
+    print('{:>14} {:>6} {:>10} {:>12} {:>14} {:>12}'.format('strategy', 'pass', 'seconds', 'wal bytes', 'tuples written', 'hot updates'))
+    for strategy in args.strategies:
+        processor_config.upsert_strategy = strategy
+        truncate_output_table(engine)
+        for pass_name in ('cold', 'warm'):
+            elapsed, wal_bytes, tuples_written, hot_updates = run_pass(engine, processing_id_pairs)
+            print('{:>14} {:>6} {:>10.2f} {:>12} {:>14} {:>12}'.format(strategy, pass_name, elapsed, wal_bytes, tuples_written, hot_updates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""
+Synthetic upstream data at production scale, for the schema in docker/postgres/02-init-tables.sql.
+
+Replaces the contents of double_click.raw_delivery, double_click.import_metadata, vendor_ids.maps,
+vendor_ids.alignment_conflicts and static.calendar with generated data, bulk loaded with COPY.
+The same arguments and seed always generate the same data.
+
+Every flight gets:
+    - a li_code of 'LI-<flight_id>', with flight ids counting up from --first-flight-id
+    - a skewed number of creatives (Pareto distributed, capped at --max-creatives), each with its own placement
+    - one report time zone, and so one import_record_id per time zone
+    - a date range within --days of --start-date, with one raw_delivery row per placement per day
+A --conflict-share of the flights with more than one creative has a within flight creative conflict:
+two of its creatives share a placement, and the flight has an alignment_conflicts row over its whole date range.
+
+Usage, from the lambda/ directory:
+    $ python -m benchmarks.data_generator --flights 5000 --days 365 --seed 1
+"""
+import argparse
+import datetime
+import random
+import time
+from collections import namedtuple
+
+from benchmarks.benchmark_helper import build_engine, FIRST_FLIGHT_ID
+
+DEFAULT_FLIGHTS = 1000
+DEFAULT_DAYS = 180
+DEFAULT_START_DATE = datetime.date(2018, 1, 1)
+DEFAULT_MAX_CREATIVES = 50
+# Pareto shape of the creatives per flight; lower is more skewed, most flights still have one or two creatives
+DEFAULT_CREATIVE_SKEW = 1.2
+DEFAULT_CONFLICT_SHARE = 0.05
+DEFAULT_TIME_ZONES = ('America/New_York', 'America/Los_Angeles', 'America/Chicago', 'Europe/London')
+DEFAULT_SEED = 0
+MINIMUM_FLIGHT_DAYS = 7
+# creative_rtb_ids are flight_id * CREATIVE_IDS_PER_FLIGHT + creative number
+CREATIVE_IDS_PER_FLIGHT = 1000
+COPY_BUFFER_SIZE = 1 << 16
+VENDOR = 'doubleclick'
+
+Flight = namedtuple('Flight', ['flight_id', 'date_start', 'date_end', 'import_record_id', 'placement_id_by_creative_id', 'has_conflict'])
+
+UPSTREAM_TABLES = ('double_click.raw_delivery', 'double_click.import_metadata', 'vendor_ids.maps', 'vendor_ids.alignment_conflicts', 'static.calendar')
+COPY_QUERY_BY_TABLE = {
+    'static.calendar' : "COPY static.calendar (report_date) FROM STDIN",
+    'double_click.import_metadata' : "COPY double_click.import_metadata (import_record_id, report_time_zone, s3_path, credential, profile_id) FROM STDIN",
+    'vendor_ids.maps' : "COPY vendor_ids.maps (li_code, creative_rtb_id, date_start, date_end, vendor, vendor_id, is_deleted) FROM STDIN",
+    'vendor_ids.alignment_conflicts' : "COPY vendor_ids.alignment_conflicts (li_code, li_code_2, vendor, date_start, date_end, creative_ids, vendor_ids) FROM STDIN",
+    'double_click.raw_delivery' : """COPY double_click.raw_delivery (import_record_id, placement_id, "date", impressions, clicks, campaign_id, ad_id,
+                                     advertiser, advertiser_id, campaign, placement_rate, site_keyname) FROM STDIN"""
+}
+
+
+class LineStream(object):
+    """ File-like object that COPY reads from, pulling lines from an iterator only as they are consumed """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        for line in self._lines:
+            chunks.append(line)
+            buffered += len(line)
+            if 0 <= size <= buffered:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+    readline = read
+
+
+def to_copy_line(*values):
+    return '\t'.join('\\N' if value is None else str(value) for value in values) + '\n'
+
+
+def generate_flights(flights=DEFAULT_FLIGHTS, days=DEFAULT_DAYS, start_date=DEFAULT_START_DATE, max_creatives=DEFAULT_MAX_CREATIVES,
+                     creative_skew=DEFAULT_CREATIVE_SKEW, conflict_share=DEFAULT_CONFLICT_SHARE, time_zones=DEFAULT_TIME_ZONES,
+                     seed=DEFAULT_SEED, first_flight_id=FIRST_FLIGHT_ID):
+    """ :return: List(Flight), every flight's shape; placement ids are unique across flights except for conflicts """
+    rng = random.Random('{}-flights'.format(seed))
+    generated_flights = []
+    next_placement_id = 1
+    for flight_id in range(first_flight_id, first_flight_id + flights):
+        creatives = max(1, min(max_creatives, CREATIVE_IDS_PER_FLIGHT - 1, int(rng.paretovariate(creative_skew))))
+        flight_days = rng.randint(min(MINIMUM_FLIGHT_DAYS, days), days)
+        date_start = start_date + datetime.timedelta(days=rng.randrange(days - flight_days + 1))
+        import_record_id = rng.randrange(len(time_zones)) + 1
+        has_conflict = creatives > 1 and rng.random() < conflict_share
+
+        placement_id_by_creative_id = {}
+        for creative_number in range(1, creatives + 1):
+            if has_conflict and creative_number == 2:
+                placement_id_by_creative_id[flight_id * CREATIVE_IDS_PER_FLIGHT + creative_number] = next_placement_id - 1
+                continue
+            placement_id_by_creative_id[flight_id * CREATIVE_IDS_PER_FLIGHT + creative_number] = next_placement_id
+            next_placement_id += 1
+
+        generated_flights.append(Flight(flight_id, date_start, date_start + datetime.timedelta(days=flight_days - 1),
+                                        import_record_id, placement_id_by_creative_id, has_conflict))
+    return generated_flights
+
+
+def generate_calendar_lines(days, start_date):
+    for day in range(days):
+        yield to_copy_line(start_date + datetime.timedelta(days=day))
+
+
+def generate_import_metadata_lines(time_zones):
+    for import_record_id, time_zone in enumerate(time_zones, 1):
+        yield to_copy_line(import_record_id, time_zone, 'synthetic', 'synthetic', 0)
+
+
+def generate_maps_lines(flights):
+    for flight in flights:
+        for creative_id, placement_id in sorted(flight.placement_id_by_creative_id.items()):
+            yield to_copy_line('LI-{}'.format(flight.flight_id), creative_id, flight.date_start, flight.date_end, VENDOR, placement_id, 'f')
+
+
+def generate_alignment_conflicts_lines(flights):
+    for flight in flights:
+        if flight.has_conflict:
+            li_code = 'LI-{}'.format(flight.flight_id)
+            creative_ids = sorted(flight.placement_id_by_creative_id)[:2]
+            vendor_ids = sorted(set(flight.placement_id_by_creative_id[creative_id] for creative_id in creative_ids))
+            yield to_copy_line(li_code, li_code, VENDOR, flight.date_start, flight.date_end,
+                               '{' + ','.join(str(id) for id in creative_ids) + '}', '{' + ','.join(str(id) for id in vendor_ids) + '}')
+
+
+def generate_raw_delivery_lines(flights, seed=DEFAULT_SEED):
+    """ One row per placement per day of its flight; impressions are log-normal, clicks a small share of them """
+    rng = random.Random('{}-raw_delivery'.format(seed))
+    for flight in flights:
+        flight_days = (flight.date_end - flight.date_start).days + 1
+        for placement_id in sorted(set(flight.placement_id_by_creative_id.values())):
+            for day in range(flight_days):
+                impressions = int(rng.lognormvariate(7, 1.5))
+                clicks = int(impressions * rng.random() * 0.002)
+                yield to_copy_line(flight.import_record_id, placement_id, flight.date_start + datetime.timedelta(days=day),
+                                   impressions, clicks, flight.flight_id, placement_id, 'synthetic', 0, 'synthetic', 0, 'synthetic')
+
+
+def copy_lines(cursor, table, lines):
+    cursor.copy_expert(COPY_QUERY_BY_TABLE[table], LineStream(lines), size=COPY_BUFFER_SIZE)
+    return cursor.rowcount
+
+
+def generate_upstream_table_data(connection, flights=DEFAULT_FLIGHTS, days=DEFAULT_DAYS, start_date=DEFAULT_START_DATE,
+                                 max_creatives=DEFAULT_MAX_CREATIVES, creative_skew=DEFAULT_CREATIVE_SKEW,
+                                 conflict_share=DEFAULT_CONFLICT_SHARE, time_zones=DEFAULT_TIME_ZONES,
+                                 seed=DEFAULT_SEED, first_flight_id=FIRST_FLIGHT_ID):
+    """
+    Replaces the upstream tables' contents with generated data, in one transaction.
+
+    :param connection: SQLAlchemy Connection; the COPYs run on its DBAPI connection
+    :return: Dict, {String table name: Int rows loaded}
+    """
+    generated_flights = generate_flights(flights, days, start_date, max_creatives, creative_skew, conflict_share,
+                                         time_zones, seed, first_flight_id)
+    lines_by_table = {
+        'static.calendar' : generate_calendar_lines(days, start_date),
+        'double_click.import_metadata' : generate_import_metadata_lines(time_zones),
+        'vendor_ids.maps' : generate_maps_lines(generated_flights),
+        'vendor_ids.alignment_conflicts' : generate_alignment_conflicts_lines(generated_flights),
+        'double_click.raw_delivery' : generate_raw_delivery_lines(generated_flights, seed)
+    }
+
+    rows_by_table = {}
+    with connection.begin() as transaction:
+        cursor = connection.connection.cursor()
+        cursor.execute("TRUNCATE " + ", ".join(UPSTREAM_TABLES) + ";")
+        for table in UPSTREAM_TABLES:
+            rows_by_table[table] = copy_lines(cursor, table, lines_by_table[table])
+        cursor.close()
+    connection.execute("ANALYZE " + ", ".join(UPSTREAM_TABLES) + ";")
+    return rows_by_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--flights', type=int, default=DEFAULT_FLIGHTS)
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS)
+    parser.add_argument('--start-date', type=lambda value: datetime.datetime.strptime(value, '%Y-%m-%d').date(), default=DEFAULT_START_DATE)
+    parser.add_argument('--max-creatives', type=int, default=DEFAULT_MAX_CREATIVES, help='cap on creatives per flight')
+    parser.add_argument('--creative-skew', type=float, default=DEFAULT_CREATIVE_SKEW, help='Pareto shape; lower is more skewed')
+    parser.add_argument('--conflict-share', type=float, default=DEFAULT_CONFLICT_SHARE, help='share of flights with a creative conflict')
+    parser.add_argument('--time-zones', nargs='+', default=list(DEFAULT_TIME_ZONES))
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--first-flight-id', type=int, default=FIRST_FLIGHT_ID)
+    args = parser.parse_args()
+
+    start = time.time()
+    connection = build_engine().connect()
+    rows_by_table = generate_upstream_table_data(connection, args.flights, args.days, args.start_date, args.max_creatives,
+                                                 args.creative_skew, args.conflict_share, args.time_zones, args.seed, args.first_flight_id)
+    for table in UPSTREAM_TABLES:
+        print('{:>31} {:>12}'.format(table, rows_by_table[table]))
+    print('Loaded in {:.1f} seconds'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,4 +13,7 @@ db_test_endpoint = os.getenv('db_test_endpoint') or "localhost"
 
 db_username = os.getenv('db_username') or "db_username"
 db_password = os.getenv('db_password') or "db_password"
-db_name = os.getenv('db_name') or "db_name"
\ No newline at end of file
+db_name = os.getenv('db_name') or "db_name"
+# Optional streaming replica of the same database; when set, expected data is computed on it. See helpers/replica_helper.py
+db_replica_endpoint = os.getenv('db_replica_endpoint')
+db_replica_test_endpoint = os.getenv('db_replica_test_endpoint')
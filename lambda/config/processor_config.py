@@ -0,0 +1,71 @@
+# config file containing settings for how the lambda processor handles a batch of records
+import os
+
+# When enabled, the handler returns the batchItemFailures response so only failed records are retried.
+# The event source mapping must have ReportBatchItemFailures turned on for this to take effect.
+report_batch_item_failures = (os.getenv('report_batch_item_failures') or "false").lower() == "true"
+
+# Number of units of work processed at the same time; units touching the same flight are always processed one at a time.
+# Each concurrent unit holds its own pooled connection, so keep this below the engine's pool_size + max_overflow.
+processing_concurrency = int(os.getenv('processing_concurrency') or 1)
+
+# How expected rows are written to the output table:
+#   delete_insert: delete every matching row, then insert all expected rows
+#   on_conflict: INSERT ... ON CONFLICT DO UPDATE, only touching new or changed rows (PostgreSQL 9.5+)
+#   diff: UPDATE changed rows in place (HOT updates, as no updated column is indexed), INSERT new rows, and leave unchanged
+#         rows and rows already marked deleted untouched
+upsert_strategy = os.getenv('upsert_strategy') or "delete_insert"
+
+# Which engine runs the processing pipeline for a unit of work:
+#   python: helpers/database_helper.py, statement by statement
+#   psycopg2: helpers/psycopg2_helper.py, the same statements as precompiled SQL text on the psycopg2 cursor
+#   server_function: the snoopy.process_processing_id PL/pgSQL function in one call; see helpers/server_function_helper.py
+processing_engine = os.getenv('processing_engine') or "python"
+
+# How writers of the same flight are serialized:
+#   row_lock: SELECT ... FOR UPDATE over every output table row of the flight
+#   advisory: one pg_advisory_xact_lock per flight, which also covers flights without rows yet
+# Writers only exclude writers using the same mode, so switch every lambda at once
+locking_mode = os.getenv('locking_mode') or "row_lock"
+
+# When enabled, logs how long each module took to import and how long the init phase took, once per execution context
+import_time_report = (os.getenv('import_time_report') or "false").lower() == "true"
+
+# When enabled, prints one CloudWatch Embedded Metric Format line per unit of work, with the duration and rows of each phase
+phase_metrics = (os.getenv('phase_metrics') or "true").lower() == "true"
+
+# Units of work taking longer than this many ms have the plan of their expected data statement captured with
+# EXPLAIN (ANALYZE, BUFFERS) and logged; 0 turns capturing off. Only the python and psycopg2 engines capture.
+# See helpers/query_plan_helper.py
+slow_invocation_threshold_ms = int(os.getenv('slow_invocation_threshold_ms') or 0)
+
+# Share of slow units of work whose plan is captured, and the fewest seconds between two captures per execution context;
+# capturing runs the expected data statement again, so it is kept rare
+query_plan_sample_rate = float(os.getenv('query_plan_sample_rate') or 0.2)
+query_plan_capture_interval_seconds = int(os.getenv('query_plan_capture_interval_seconds') or 300)
+
+# Share of the per unit of work info log lines that are logged, from 0 to 1; batch summaries, warnings and errors are always logged
+log_sample_rate = float(os.getenv('log_sample_rate') or 0.01)
+
+# Share of the lines of single events that are logged, as comma separated event=rate pairs, e.g. "retrying=0.1,processing=0.05".
+# Overrides log_sample_rate for sampled info lines, and samples warnings of the event; errors are always logged
+log_sample_rate_by_event = {
+    event.strip() : float(sample_rate)
+    for event, sample_rate in (pair.split('=') for pair in (os.getenv('log_sample_rate_by_event') or "").split(',') if pair.strip())
+}
+
+# How the python engine splits a unit of work into transactions:
+#   one_transaction: builds the expected data, then locks, diffs and writes it, in one transaction
+#   two_phase: builds the expected data in a read only REPEATABLE READ transaction, then locks, diffs and writes it
+#              in a short second transaction, processing again in one transaction if the inputs changed in between
+transaction_mode = os.getenv('transaction_mode') or "one_transaction"
+
+# When enabled, the python engine fingerprints the inputs of each unit of work and skips it when they are unchanged since
+# it last processed them and nothing changed the output rows of its flights since, keeping the fingerprints in the
+# snoopy.input_fingerprint_cache table, whose triggers drop them on every output write. The psycopg2 and server_function
+# engines never skip units
+input_fingerprint_cache = (os.getenv('input_fingerprint_cache') or "false").lower() == "true"
+
+# Longest time in ms a unit of work waits for the replica (db_config.db_replica_endpoint) to replay every transaction
+# the primary had committed when the unit started, before computing its expected data on the primary instead
+replica_max_wait_ms = int(os.getenv('replica_max_wait_ms') or 200)
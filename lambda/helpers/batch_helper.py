@@ -0,0 +1,157 @@
+import base64
+import datetime
+import json
+import logging
+from collections import OrderedDict
+
+from helpers.database_helper import LI_CODE_STRING, FLIGHT_ID_STRING, DateWindow, get_flight_id_of_processing_id
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Expected messages handling
+PROCESSING_ID_TYPE_JSON_HEADER = 'processing_id_type'
+PROCESSING_ID_JSON_HEADER = 'processing_id'
+# Optional; limit a li_code/flight_id event to the dates it changed on, given directly or as the dates of an import
+DATE_START_JSON_HEADER = 'date_start'
+DATE_END_JSON_HEADER = 'date_end'
+IMPORT_RECORD_ID_JSON_HEADER = 'import_record_id'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def decode_payload(record):
+    # Kinesis data is base64 encoded so decode here
+    payload = base64.b64decode(record['kinesis']['data'])
+    return json.loads(payload.decode("utf-8"))
+
+
+def decode_record_with_date_window(record):
+    """
+    Decodes a single Kinesis record into its processing_id_type and processing_id, and the dates it is limited to.
+
+    :param record: Kinesis record dict from the lambda event
+    :return: 2 element tuple, ((processing_id_type, processing_id), date window spec); the spec is a DateWindow
+        from the date_start and date_end of the record, the String import_record_id whose dates it is limited to,
+        or None when the record is not limited to any dates
+    """
+    json_payload = decode_payload(record)
+    processing_id_pair = (json_payload[PROCESSING_ID_TYPE_JSON_HEADER], json_payload[PROCESSING_ID_JSON_HEADER])
+    if json_payload.get(DATE_START_JSON_HEADER) and json_payload.get(DATE_END_JSON_HEADER):
+        date_window_spec = DateWindow(datetime.datetime.strptime(json_payload[DATE_START_JSON_HEADER], DATE_FORMAT).date(),
+                                      datetime.datetime.strptime(json_payload[DATE_END_JSON_HEADER], DATE_FORMAT).date())
+    elif json_payload.get(IMPORT_RECORD_ID_JSON_HEADER):
+        date_window_spec = str(json_payload[IMPORT_RECORD_ID_JSON_HEADER])
+    else:
+        date_window_spec = None
+    return (processing_id_pair, date_window_spec)
+
+
+def group_date_window_specs(indexes_by_processing_id_pair, date_window_specs):
+    """
+    Collects the date window specs of every pair a unit of work covers.
+
+    :param indexes_by_processing_id_pair: OrderedDict, as returned by group_processing_ids
+    :param date_window_specs: List(date window spec), one per pair, as returned by decode_record_with_date_window
+    :return: Dict((processing_id_type, processing_id) -> List(date window spec) or None); None when any pair the
+        unit covers is not limited to any dates, as its whole history must then be processed
+    """
+    date_window_specs_by_processing_id_pair = {}
+    for processing_id_pair, indexes in indexes_by_processing_id_pair.items():
+        specs = [date_window_specs[index] for index in indexes]
+        date_window_specs_by_processing_id_pair[processing_id_pair] = None if None in specs else specs
+    return date_window_specs_by_processing_id_pair
+
+
+def group_processing_ids(processing_id_pairs):
+    """
+    Groups a batch of (processing_id_type, processing_id) pairs by the unique unit of work that covers them.
+
+    Every unit of work recomputes its data from the current state of the upstream tables,
+    so processing the same unit more than once in a batch only repeats the same writes.
+        - Duplicate (processing_id_type, processing_id) pairs are processed once
+        - A li_code is covered by a flight_id event for the same flight in the batch,
+          as the flight_id event covers every li_code of that flight
+        - import_id events are never covered by another event, as they are not scoped to a single flight
+
+    :param processing_id_pairs: List((processing_id_type, processing_id)), in arrival order
+    :return: OrderedDict((processing_id_type, processing_id) -> List(int)); unique units of work in order of
+        first arrival, mapped to the indexes of every pair in processing_id_pairs that they cover
+    """
+    flight_ids_in_batch = {processing_id for processing_id_type, processing_id in processing_id_pairs
+                           if processing_id_type == FLIGHT_ID_STRING}
+
+    def is_covered_by_flight_id(processing_id_type, processing_id):
+        return processing_id_type == LI_CODE_STRING and \
+            get_flight_id_of_processing_id(processing_id_type, processing_id) in flight_ids_in_batch
+
+    indexes_by_processing_id_pair = OrderedDict()
+    for index, (processing_id_type, processing_id) in enumerate(processing_id_pairs):
+        if not is_covered_by_flight_id(processing_id_type, processing_id):
+            indexes_by_processing_id_pair.setdefault((processing_id_type, processing_id), []).append(index)
+    for index, (processing_id_type, processing_id) in enumerate(processing_id_pairs):
+        if is_covered_by_flight_id(processing_id_type, processing_id):
+            flight_id = get_flight_id_of_processing_id(processing_id_type, processing_id)
+            indexes_by_processing_id_pair[(FLIGHT_ID_STRING, flight_id)].append(index)
+    return indexes_by_processing_id_pair
+
+
+def group_by_flight_affinity(processing_id_pairs):
+    """
+    Splits units of work into the groups that may safely run at the same time.
+
+    Units scoped to the same flight would fight over the same output table row locks,
+    so they are grouped together and must run one after the other.
+    import_id units can touch any flight, so they are returned separately and must not
+    run alongside any other unit.
+
+    :param processing_id_pairs: List((processing_id_type, processing_id))
+    :return: 2 element tuple, (List(List(pair)) one list per flight, List(pair) import_id units); arrival order kept
+    """
+    pairs_by_flight_id = OrderedDict()
+    unscoped_pairs = []
+    for processing_id_type, processing_id in processing_id_pairs:
+        flight_id = get_flight_id_of_processing_id(processing_id_type, processing_id)
+        if flight_id is None:
+            unscoped_pairs.append((processing_id_type, processing_id))
+        else:
+            pairs_by_flight_id.setdefault(flight_id, []).append((processing_id_type, processing_id))
+    return (list(pairs_by_flight_id.values()), unscoped_pairs)
+
+
+def process_processing_ids(processing_id_pairs, process_function, max_workers=1):
+    """
+    Runs process_function(processing_id_type, processing_id) once for every unit of work.
+    A failing unit does not stop the rest of the batch; process_function is expected to log its failure.
+
+    With max_workers above 1, the flights of the batch are processed in parallel on a thread pool,
+    each flight's units one after the other on a single worker. import_id units run afterwards,
+    one at a time, as the flights they touch are only known once they are processed.
+
+    :param processing_id_pairs: List((processing_id_type, processing_id)), unique units of work
+    :param process_function: Function(processing_id_type, processing_id); must get its own connection
+    :param max_workers: Int; number of units allowed to run at the same time
+    :return: OrderedDict((processing_id_type, processing_id) -> Exception or None), in processing_id_pairs order
+    """
+    results = OrderedDict((processing_id_pair, None) for processing_id_pair in processing_id_pairs)
+
+    def process_serially(pairs):
+        for processing_id_type, processing_id in pairs:
+            try:
+                process_function(processing_id_type, processing_id)
+            except Exception as e:
+                results[(processing_id_type, processing_id)] = e
+
+    if max_workers <= 1:
+        process_serially(processing_id_pairs)
+        return results
+
+    # only imported when processing concurrently, keeping it off the default cold start path
+    from concurrent.futures import ThreadPoolExecutor
+
+    flight_scoped_pair_groups, unscoped_pairs = group_by_flight_affinity(processing_id_pairs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the iterator so every group has finished before import_ids start
+        list(executor.map(process_serially, flight_scoped_pair_groups))
+    process_serially(unscoped_pairs)
+    return results
@@ -1,100 +1,311 @@
 import logging
+import threading
+import time
 import warnings
+from collections import namedtuple
 
 from sqlalchemy import exc as sa_exc
-from sqlalchemy import create_engine, Table, MetaData, select, text, and_, or_, exists
+from sqlalchemy import create_engine, event, Table, MetaData, Column, select, text, and_, or_, exists
+from sqlalchemy.types import BigInteger, Boolean, Date, DateTime, Text
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql.functions import current_timestamp
 
+from config import processor_config
+from helpers.log_helper import log_warning
+from helpers.metrics_helper import time_phase, add_phase_rows, increment
+from helpers.statement_helper import instrument_engine
+
 # Logger settings
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
 def create_new_engine(db_postgres_string, pool_size, max_overflow):
-    return create_engine(db_postgres_string, pool_size=pool_size, max_overflow=max_overflow)
+    engine = create_engine(db_postgres_string, pool_size=pool_size, max_overflow=max_overflow)
+    event.listen(engine, 'connect', set_session_settings)
+    event.listen(engine, 'checkout', check_idle_connection_is_alive)
+    event.listen(engine, 'checkin', record_connection_checkin)
+    event.listen(engine, 'rollback', forget_prepared_connection)
+    instrument_engine(engine)
+    return engine
 
 
 # Database_helper entrypoint, called by main processor
-def process_processing_id(connection, processing_id_type, processing_id):
-    with connection.begin() as transaction:
-        set_lock_timeout_for_transaction(connection)
-
-        temp_table = generate_expected_data_temp_table(connection, processing_id_type, processing_id)
-        s = select([temp_table.c.date, temp_table.c.flight_id, temp_table.c.creative_id, temp_table.c.impressions, temp_table.c.clicks, temp_table.c.provider, temp_table.c.time_zone, temp_table.c.is_deleted])
-
-        flight_ids_affected = []
-        if processing_id_type == LI_CODE_STRING:
-            flight_ids_affected = [processing_id[3:]]
-            perform_deletions = True
-        elif processing_id_type == FLIGHT_ID_STRING:
-            flight_ids_affected = [processing_id]
-            perform_deletions = True
-        else:
-            flight_ids_affected = [row[temp_table.c.flight_id] for row in select([temp_table.c.flight_id]).distinct().execute().fetchall()]
-            perform_deletions = False
-        if not perform_deletions and not flight_ids_affected:
-            # processing import_id, but no data in the temp table
-            return
+# Returns 2 element tuple, (List(rows marked deleted), List(rows written)); see calculate_diffs_and_writes_to_output_table
+# date_window: DateWindow limiting a li_code/flight_id to the dates it changed on; None processes its whole history
+def process_processing_id(connection, processing_id_type, processing_id, date_window=None):
+    process_function = PROCESS_FUNCTION_BY_TRANSACTION_MODE[processor_config.transaction_mode]
+    return process_function(connection, processing_id_type, processing_id, date_window)
 
-        deleted, inserted = calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_ids_affected, perform_deletions)
 
+def process_processing_id_in_one_transaction(connection, processing_id_type, processing_id, date_window=None):
+    """ Builds the expected data, then locks, diffs and writes it, all in one transaction """
+    with connection.begin() as transaction:
+        input_fingerprint = None
+        if processor_config.input_fingerprint_cache:
+            with time_phase('input_fingerprint'):
+                input_fingerprint = get_input_fingerprint(connection, processing_id_type, processing_id)
+        if is_input_fingerprint_cached(connection, processing_id_type, processing_id, input_fingerprint):
+            return ([], [])
+        temp_table = generate_expected_data_temp_table(connection, processing_id_type, processing_id, date_window)
+        diffs = write_expected_data_to_output_table(connection, temp_table, processing_id_type, processing_id, date_window=date_window)
+        cache_input_fingerprint(connection, processing_id_type, processing_id, input_fingerprint, date_window)
+        return diffs
+
+
+def process_processing_id_in_two_phases(connection, processing_id_type, processing_id, date_window=None):
+    """
+    Builds the expected data in a read only REPEATABLE READ transaction, which takes no locks, then locks, diffs
+    and writes it in a second, short transaction. Output table locks are only held for the second transaction.
+
+    The input fingerprint of the processing_id is taken in both transactions, the second time once the flights are locked.
+    If the inputs changed in between, the expected data may be stale, so the unit is processed again in one transaction.
+    """
+    # Prepared in its own autocommitted transaction, so the read only transaction below doesn't need to write the session setup
+    prepare_connection(connection)
+    with connection.begin() as transaction:
+        connection.execute(READ_ONLY_SNAPSHOT_TRANSACTION_QUERY)
+        # the snapshot is taken by the first statement, so the fingerprint is of the same inputs the expected data is built from
+        with time_phase('input_fingerprint'):
+            input_fingerprint = get_input_fingerprint(connection, processing_id_type, processing_id)
+        if is_input_fingerprint_cached(connection, processing_id_type, processing_id, input_fingerprint):
+            return ([], [])
+        temp_table = generate_expected_data_temp_table(connection, processing_id_type, processing_id, date_window)
+        with time_phase('save_expected_data'):
+            connection.execute(SAVE_EXPECTED_DATA_QUERY)
+
+    def check_inputs_unchanged(connection):
+        with time_phase('check_inputs'):
+            if get_input_fingerprint(connection, processing_id_type, processing_id) != input_fingerprint:
+                raise InputsChangedError()
+
+    try:
+        with connection.begin() as transaction:
+            with time_phase('restore_expected_data'):
+                connection.execute(RESTORE_EXPECTED_DATA_QUERY)
+            diffs = write_expected_data_to_output_table(connection, temp_table, processing_id_type, processing_id, check_inputs_unchanged, date_window)
+            cache_input_fingerprint(connection, processing_id_type, processing_id, input_fingerprint, date_window)
+            return diffs
+    except InputsChangedError:
+        increment('inputs_changed')
+        return process_processing_id_in_one_transaction(connection, processing_id_type, processing_id, date_window)
+
+
+def write_expected_data_to_output_table(connection, temp_table, processing_id_type, processing_id, check_inputs=None, date_window=None):
+    """
+    Diffs the expected data of the temp table against the output table and writes it, within the caller's transaction.
 
-# Change lock timeout for current transaction
+    :param check_inputs: Function(connection), called once the flights are locked; raises to abandon the writes
+    :param date_window: DateWindow the temp table was built for; only output rows within it are diffed
+    """
+    flight_ids_affected = []
+    if processing_id_type in (LI_CODE_STRING, FLIGHT_ID_STRING):
+        flight_ids_affected = [get_flight_id_of_processing_id(processing_id_type, processing_id)]
+        perform_deletions = True
+    else:
+        with time_phase('select_flight_ids'):
+            flight_ids_affected = [row[temp_table.c.flight_id] for row in connection.execute(select([temp_table.c.flight_id]).distinct()).fetchall()]
+        perform_deletions = False
+    if not perform_deletions and not flight_ids_affected:
+        # processing import_id, but no data in the temp table
+        return ([], [])
+
+    try:
+        return calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_ids_affected, perform_deletions, check_inputs,
+                                                          get_flight_date_window(processing_id_type, date_window))
+    except sa_exc.ProgrammingError:
+        # The output table may have changed since it was reflected; reflect it again on the next attempt
+        invalidate_output_table()
+        raise
+
+
+# Lock timeout of every session, set with the other session settings; lock timeouts are retried
 LOCK_TIMEOUT_MS = 3000
 LOCK_TIMEOUT_QUERY = "SET lock_timeout = {};".format(LOCK_TIMEOUT_MS)
-LOCK_ERROR_MESSAGE = 'lock timeout'
 
 
-def set_lock_timeout_for_transaction(connection):
-    connection.execute(LOCK_TIMEOUT_QUERY)
+# Connection lifecycle
+# Session settings are set once when the pool opens a connection, rather than in every transaction
+APPLICATION_NAME = 'kinesis-lambda-processor'
+STATEMENT_TIMEOUT_MS = 60000
+WORK_MEM = '16MB'
+SESSION_SETTINGS_QUERY = "{0} SET statement_timeout = {1}; SET work_mem = '{2}'; SET application_name = '{3}';".format(
+    LOCK_TIMEOUT_QUERY, STATEMENT_TIMEOUT_MS, WORK_MEM, APPLICATION_NAME)
+# A connection idle for longer than this may have been cut while the lambda container was frozen,
+# so it is pinged before being handed out; connections used more recently are handed out without a round trip
+LIVENESS_CHECK_IDLE_SECONDS = 30
+CONNECTION_CHECKIN_TIME_INFO_KEY = 'checkin_time'
+
+
+def set_session_settings(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(SESSION_SETTINGS_QUERY)
+    cursor.close()
+    dbapi_connection.commit()
+
+
+def record_connection_checkin(dbapi_connection, connection_record):
+    connection_record.info[CONNECTION_CHECKIN_TIME_INFO_KEY] = time.time()
+
+
+def check_idle_connection_is_alive(dbapi_connection, connection_record, connection_proxy):
+    """
+    Raising DisconnectionError makes the pool discard the connection and transparently open a new one,
+    which runs set_session_settings again.
+    """
+    checkin_time = connection_record.info.get(CONNECTION_CHECKIN_TIME_INFO_KEY)
+    if checkin_time is None or time.time() - checkin_time < LIVENESS_CHECK_IDLE_SECONDS:
+        return
+    try:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        dbapi_connection.rollback()
+    except (dbapi_connection.OperationalError, dbapi_connection.InterfaceError) as e:
+        log_warning('idle_connection_reconnecting', idle_seconds=round(time.time() - checkin_time), error=str(e))
+        raise sa_exc.DisconnectionError()
 
 
 # Generating expected data temp table
-TEMP_TABLE_BASE_NAME = 'expected_temp_table_{}'
+# The temp table lives for the whole session and is emptied on commit, so statements prepared against it stay valid
+TEMP_TABLE_NAME = 'expected_data_temp_table'
 LI_CODE_STRING = "li_code"
 FLIGHT_ID_STRING = "flight_id"
 IMPORT_ID_STRING = "import_id"
+PROCESSING_ID_TYPES = (LI_CODE_STRING, FLIGHT_ID_STRING, IMPORT_ID_STRING)
+
+# Conditions are bound to the processing_id through the prepared statements' $1 text parameter
+# substring(li_code, 4) lookups are served by the maps_flight_id_idx expression index; li_code lookups
+# repeat that condition so they can use the same index
 CONDITION_STRING_BY_PROCESSING_ID_TYPE = {
-    LI_CODE_STRING : "m.li_code = '{}'",
-    FLIGHT_ID_STRING : "substring(m.li_code, 4) = '{}'",
-    IMPORT_ID_STRING : "im.import_record_id = '{}'"
+    LI_CODE_STRING : "substring(m.li_code, 4) = substring($1, 4) AND m.li_code = $1",
+    FLIGHT_ID_STRING : "substring(m.li_code, 4) = $1",
+    IMPORT_ID_STRING : "im.import_record_id = $1::int"
 }
 
+CREATE_TEMP_TABLE_QUERY = """
+    CREATE TEMP TABLE IF NOT EXISTS {0} (
+        date date, flight_id text, creative_id text, impressions bigint, clicks bigint,
+        provider text, time_zone text, updated_at timestamptz, is_deleted boolean
+    ) ON COMMIT DELETE ROWS;
+""".format(TEMP_TABLE_NAME)
+
 # Temporarily hard coding DoubleClick as the provider, and not joining to import.records table
 # Work is needed to fix import_record_ids such that they are consistent for double_click and import schema
-BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY = """
-    CREATE TEMP TABLE {0} ON COMMIT DROP AS
+BUILD_EXPECTED_DATA_SELECT_BASE_QUERY = """
     SELECT rd.date, substring(m.li_code, 4) as flight_id, m.creative_rtb_id::text as creative_id, SUM(rd.impressions) as impressions, SUM(rd.clicks) as clicks, 'doubleclick'::TEXT as provider,
     im.report_time_zone as time_zone, now() as updated_at, FALSE as is_deleted
     FROM double_click.raw_delivery rd
     JOIN vendor_ids.maps m ON m.vendor_id = rd.placement_id::text AND rd.date BETWEEN m.date_start AND m.date_end
     JOIN double_click.import_metadata im USING (import_record_id)
     LEFT JOIN vendor_ids.alignment_conflicts c ON m.li_code = c.li_code AND (rd.date BETWEEN c.date_start AND c.date_end)
-    WHERE {1} AND m.is_deleted = false AND c.li_code IS NULL
+    WHERE {0} AND m.is_deleted = false AND c.li_code IS NULL
     group by rd.date, m.li_code, m.creative_rtb_id, im.report_time_zone
-    order by date desc;
+    order by date desc
 """
+BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY = """
+    INSERT INTO """ + TEMP_TABLE_NAME + BUILD_EXPECTED_DATA_SELECT_BASE_QUERY
+
+
+def get_flight_id_of_processing_id(processing_id_type, processing_id):
+    """
+    Returns the flight a li_code/flight_id processing_id is scoped to.
+    An import_id is not scoped to a single flight, so None is returned for it.
+    """
+    if processing_id_type == LI_CODE_STRING:
+        return processing_id[3:]
+    elif processing_id_type == FLIGHT_ID_STRING:
+        return processing_id
+    return None
 
 
-def generate_expected_data_temp_table(connection, processing_id_type, processing_id):
-    temp_table_name = (TEMP_TABLE_BASE_NAME + processing_id_type).format(processing_id.replace("-","")).lower()
-    where_clause_string = CONDITION_STRING_BY_PROCESSING_ID_TYPE[processing_id_type].format(processing_id)
+def generate_expected_data_temp_table(connection, processing_id_type, processing_id, date_window=None):
+    prepare_connection(connection)
+    date_window = get_flight_date_window(processing_id_type, date_window)
 
     # Insert records for flights with no creative conflicts of any kind
-    build_expected_data_temp_table_base_query = BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY.format(temp_table_name, where_clause_string)
-    connection.execute(build_expected_data_temp_table_base_query)
+    with time_phase('build_expected_data'):
+        if date_window is None:
+            result = connection.execute(text("EXECUTE {0}(:processing_id)".format(BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type])),
+                                        processing_id=str(processing_id))
+        else:
+            result = connection.execute(text(EXECUTE_DATE_WINDOW_STATEMENT_QUERY.format(DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type])),
+                                        processing_id=str(processing_id), date_start=date_window.date_start, date_end=date_window.date_end)
+    add_phase_rows('build_expected_data', result.rowcount)
 
     # Insert records for flights with within flight creative conflict only
-    insert_within_flight_creative_conflict_data_to_temp_table(connection, temp_table_name, processing_id_type, processing_id)
+    insert_within_flight_creative_conflict_data_to_temp_table(connection, TEMP_TABLE_NAME, processing_id_type, processing_id, date_window)
 
-    metadata = MetaData(connection, reflect=True)
-    return Table(temp_table_name, metadata, autoload=True, autoload_with=connection)
+    return EXPECTED_DATA_TEMP_TABLE
+
+
+# Date windows
+# A li_code/flight_id processing_id can be limited to the dates that changed, e.g. the date span of the import that
+# changed them, instead of rebuilding and rewriting the flight's whole history. Both dates are inclusive.
+DateWindow = namedtuple('DateWindow', ['date_start', 'date_end'])
+DATE_WINDOW_PROCESSING_ID_TYPES = (LI_CODE_STRING, FLIGHT_ID_STRING)
+DATE_WINDOW_CONDITION = " AND {0}.date BETWEEN $2 AND $3"
+EXECUTE_DATE_WINDOW_STATEMENT_QUERY = "EXECUTE {0}(:processing_id, :date_start, :date_end)"
+IMPORT_DATE_WINDOW_QUERY = text("SELECT MIN(date), MAX(date) FROM double_click.raw_delivery WHERE import_record_id = :import_record_id")
+
+
+def get_flight_date_window(processing_id_type, date_window):
+    """ An import_id is already limited to the rows of its import, so it is never limited to a date window """
+    return date_window if processing_id_type in DATE_WINDOW_PROCESSING_ID_TYPES else None
+
+
+def get_date_window_of_import(connection, import_record_id):
+    """ :return: DateWindow spanning the dates of the import's raw delivery, or None if it has none """
+    date_start, date_end = connection.execute(IMPORT_DATE_WINDOW_QUERY, import_record_id=int(import_record_id)).fetchone()
+    return DateWindow(date_start, date_end) if date_start is not None else None
+
+
+def resolve_date_window(connection, date_window_specs):
+    """
+    :param date_window_specs: List(DateWindow or String import_record_id), or None
+    :return: the smallest DateWindow covering every spec, or None to process the whole history
+    """
+    if not date_window_specs:
+        return None
+    return merge_date_windows([date_window_spec if isinstance(date_window_spec, DateWindow) else get_date_window_of_import(connection, date_window_spec)
+                               for date_window_spec in date_window_specs])
+
+
+def merge_date_windows(date_windows):
+    """ :return: the smallest DateWindow covering every date window, or None if any of them is None (no window) """
+    if not date_windows or any(date_window is None for date_window in date_windows):
+        return None
+    return DateWindow(min(date_window.date_start for date_window in date_windows), max(date_window.date_end for date_window in date_windows))
+
+
+# Columns of the expected data temp table, in the order CREATE_TEMP_TABLE_QUERY creates them
+TEMP_TABLE_COLUMNS = (
+    ('date', Date),
+    ('flight_id', Text),
+    ('creative_id', Text),
+    ('impressions', BigInteger),
+    ('clicks', BigInteger),
+    ('provider', Text),
+    ('time_zone', Text),
+    ('updated_at', DateTime(timezone=True)),
+    ('is_deleted', Boolean)
+)
+
+
+def build_temp_table(temp_table_name):
+    """
+    Builds the Table object for an expected data temp table from its known columns, without reflection.
+    The Table is not bound to any connection, so statements built from it must be run with connection.execute.
+    """
+    return Table(temp_table_name, MetaData(), *[Column(name, column_type) for name, column_type in TEMP_TABLE_COLUMNS])
+
+
+EXPECTED_DATA_TEMP_TABLE = build_temp_table(TEMP_TABLE_NAME)
 
 
 # This query has two conditions that are dependent upon whether or not the processing id is li_code or import_id
 # See WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE
-INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY = """
-    INSERT INTO {0} (
+WITHIN_FLIGHT_CREATIVE_CONFLICT_SELECT_BASE_QUERY = """
         SELECT rd2.date, substring(tups.li_code, 4) as flight_id, NULL as creative_id, SUM(rd2.impressions) as impressions, 
             SUM(rd2.clicks) as clicks, 'doubleclick'::TEXT as provider, im.report_time_zone as time_zone, 
             now() as updated_at, FALSE as is_deleted 
@@ -102,7 +313,7 @@ INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY = """
         JOIN (
             SELECT m.vendor_id, c.report_date AS date, m.li_code, m.vendor FROM static.calendar c 
             JOIN vendor_ids.maps m ON c.report_date BETWEEN m.date_start AND m.date_end
-            JOIN {1} i on i.vendor_id =  m.vendor_id AND m.date_start <= max_date AND m.date_end >= min_date 
+            JOIN {0} i on i.vendor_id =  m.vendor_id AND m.date_start <= max_date AND m.date_end >= min_date 
             JOIN vendor_ids.alignment_conflicts cf on m.li_code = cf.li_code 
                 AND (c.report_date BETWEEN cf.date_start AND cf.date_end)
             WHERE m.is_deleted = FALSE AND cf.li_code = cf.li_code_2
@@ -110,34 +321,36 @@ INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY = """
             GROUP BY 1, 2, 3, 4
             ) tups ON rd2.placement_id::text = tups.vendor_id AND rd2.date = tups.date
         JOIN double_click.import_metadata im ON rd2.import_record_id = im.import_record_id
-        WHERE {2}
+        WHERE {1}
         GROUP BY rd2.date, tups.li_code, im.report_time_zone
-    );
+"""
+INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY = """
+    INSERT INTO {0} (""" + WITHIN_FLIGHT_CREATIVE_CONFLICT_SELECT_BASE_QUERY.format('{1}', '{2}') + """    )
 """
 RELEVANT_ID_MAPS_FOR_LI_CODE =   """(
                             SELECT vendor_id, MIN(date_start) as min_date, MAX(date_end) as max_date FROM vendor_ids.maps
-                            WHERE li_code = '{0}'
+                            WHERE substring(li_code, 4) = substring($1, 4) AND li_code = $1
                             GROUP BY 1 )
                         """
 LI_CODE_CONDITION =   """ 
-                            tups.li_code = '{0}' 
+                            tups.li_code = $1 
                         """
 RELEVANT_ID_MAPS_FOR_FLIGHT_ID =   """(
                             SELECT vendor_id, MIN(date_start) as min_date, MAX(date_end) as max_date FROM vendor_ids.maps
-                            WHERE substring(li_code, 4) = '{0}'
+                            WHERE substring(li_code, 4) = $1
                             GROUP BY 1 )
                         """
 FLIGHT_ID_CONDITION =   """ 
-                            substring(tups.li_code, 4) = '{0}' 
+                            substring(tups.li_code, 4) = $1 
                         """
 RELEVANT_ID_MAPS_FOR_IMPORT_ID = """ (
                             SELECT placement_id::text as vendor_id, MIN(date) as min_date , MAX(date) as max_date 
                                 FROM double_click.raw_delivery
-                            WHERE import_record_id = {0}
+                            WHERE import_record_id = $1::int
                             GROUP BY 1 )
                         """
 IMPORT_ID_CONDITION = """ 
-                            rd2.import_record_id = {0} 
+                            rd2.import_record_id = $1::int 
                         """
 WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE = {
     LI_CODE_STRING : (RELEVANT_ID_MAPS_FOR_LI_CODE, LI_CODE_CONDITION),
@@ -147,14 +360,215 @@ WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE = {
 
 
 # Inserts records for flights with within flight creative conflicts only
-def insert_within_flight_creative_conflict_data_to_temp_table(connection, temp_table_name, processing_id_type, processing_id):
-    conditional_query_tuple = WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE[processing_id_type]
-    insert_within_flight_creative_conflict_query = INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY.format(
-        temp_table_name,
-        conditional_query_tuple[0].format(processing_id),
-        conditional_query_tuple[1].format(processing_id)
+def insert_within_flight_creative_conflict_data_to_temp_table(connection, temp_table_name, processing_id_type, processing_id, date_window=None):
+    prepare_connection(connection)
+    date_window = get_flight_date_window(processing_id_type, date_window)
+    with time_phase('insert_within_flight_creative_conflict'):
+        if date_window is None:
+            statement_name = INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type]
+            result = connection.execute(text("EXECUTE {0}(:processing_id)".format(statement_name)), processing_id=str(processing_id))
+        else:
+            statement_name = DATE_WINDOW_INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type]
+            result = connection.execute(text(EXECUTE_DATE_WINDOW_STATEMENT_QUERY.format(statement_name)),
+                                        processing_id=str(processing_id), date_start=date_window.date_start, date_end=date_window.date_end)
+    add_phase_rows('insert_within_flight_creative_conflict', result.rowcount)
+
+
+# Input fingerprints
+# Identifies the version of every input row the expected data of a processing_id is built from, by row location and
+# creating transaction, so any insert, update or delete of those rows changes it without comparing row contents.
+# The calendar dates the maps of the processing_id span are inputs too, as the expected data joins them
+INPUT_FINGERPRINT_BASE_QUERY = """
+    WITH {0},
+    scoped_import_metadata AS (
+        SELECT im.ctid, im.xmin FROM double_click.import_metadata im
+        WHERE im.import_record_id IN (SELECT import_record_id FROM scoped_raw_delivery)
+    ),
+    scoped_alignment_conflicts AS (
+        SELECT c.ctid, c.xmin FROM vendor_ids.alignment_conflicts c WHERE c.li_code IN (SELECT li_code FROM scoped_maps)
+    ),
+    scoped_calendar AS (
+        SELECT cal.ctid, cal.xmin FROM static.calendar cal
+        WHERE cal.report_date BETWEEN (SELECT MIN(date_start) FROM scoped_maps) AND (SELECT MAX(date_end) FROM scoped_maps)
     )
-    connection.execute(insert_within_flight_creative_conflict_query)
+    SELECT md5(string_agg(row_version, ',' ORDER BY row_version)) FROM (
+        SELECT 'm' || ctid::text || xmin::text AS row_version FROM scoped_maps
+        UNION ALL SELECT 'rd' || ctid::text || xmin::text FROM scoped_raw_delivery
+        UNION ALL SELECT 'im' || ctid::text || xmin::text FROM scoped_import_metadata
+        UNION ALL SELECT 'c' || ctid::text || xmin::text FROM scoped_alignment_conflicts
+        UNION ALL SELECT 'cal' || ctid::text || xmin::text FROM scoped_calendar
+    ) row_versions
+"""
+FLIGHT_SCOPED_INPUT_ROWS = """
+    scoped_maps AS (
+        SELECT m.ctid, m.xmin, m.li_code, m.vendor_id, m.date_start, m.date_end FROM vendor_ids.maps m WHERE {0}
+    ),
+    scoped_raw_delivery AS (
+        SELECT rd.ctid, rd.xmin, rd.import_record_id FROM double_click.raw_delivery rd
+        WHERE rd.placement_id::text IN (SELECT vendor_id FROM scoped_maps)
+    )
+"""
+IMPORT_SCOPED_INPUT_ROWS = """
+    scoped_raw_delivery AS (
+        SELECT rd.ctid, rd.xmin, rd.import_record_id, rd.placement_id FROM double_click.raw_delivery rd
+        WHERE rd.import_record_id = $1::int
+    ),
+    scoped_maps AS (
+        SELECT m.ctid, m.xmin, m.li_code, m.date_start, m.date_end FROM vendor_ids.maps m
+        WHERE m.vendor_id IN (SELECT DISTINCT placement_id::text FROM scoped_raw_delivery)
+    )
+"""
+SCOPED_INPUT_ROWS_BY_PROCESSING_ID_TYPE = {
+    LI_CODE_STRING : FLIGHT_SCOPED_INPUT_ROWS.format(CONDITION_STRING_BY_PROCESSING_ID_TYPE[LI_CODE_STRING]),
+    FLIGHT_ID_STRING : FLIGHT_SCOPED_INPUT_ROWS.format(CONDITION_STRING_BY_PROCESSING_ID_TYPE[FLIGHT_ID_STRING]),
+    IMPORT_ID_STRING : IMPORT_SCOPED_INPUT_ROWS
+}
+
+
+def get_input_fingerprint(connection, processing_id_type, processing_id):
+    """ :return: String, md5 of the versions of every input row of the processing_id; None if it has no input rows """
+    prepare_connection(connection)
+    statement_name = INPUT_FINGERPRINT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type]
+    return connection.execute(text("EXECUTE {0}(:processing_id)".format(statement_name)), processing_id=str(processing_id)).scalar()
+
+
+# Input fingerprint cache
+# The input fingerprint of the last full processing of each processing_id is kept in a side table, with the flights
+# whose output rows it covers. While its inputs keep that fingerprint and no write changed those flights' output rows
+# since, the output table already holds their expected data, so the unit of work writes nothing.
+# The fingerprint is stored in the transaction that wrote the output, and only for units not limited to a date window,
+# as those leave the rest of the history as it was. Triggers on the output table drop the fingerprints covering every
+# flight written, by any engine or out of band, in the writing transaction; see 06-create-input-fingerprint-cache.sql.
+# Only the python engine skips units; the psycopg2 and server_function engines never read the cache.
+# Computing a fingerprint reads the versions of every input row of the unit, so a check costs a scan of the unit's whole
+# input history through the same indexes as building its expected data, on hits too; a hit saves the joins, aggregation,
+# locks and writes of the unit, not its reads. The time is recorded as the input_fingerprint phase.
+INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME = 'snoopy.input_fingerprint_cache'
+SELECT_CACHED_INPUT_FINGERPRINT_QUERY = text("""
+    SELECT input_fingerprint FROM {0} WHERE processing_id_type = :processing_id_type AND processing_id = :processing_id
+""".format(INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME))
+# The flights covered are those of the expected data, still in the temp table, and the flight of a li_code/flight_id
+CACHE_INPUT_FINGERPRINT_QUERY = text("""
+    INSERT INTO {0} (processing_id_type, processing_id, input_fingerprint, flight_ids, updated_at)
+    VALUES (:processing_id_type, :processing_id, :input_fingerprint,
+        ARRAY(SELECT flight_id FROM {1} WHERE flight_id IS NOT NULL UNION SELECT CAST(:flight_id AS text) WHERE CAST(:flight_id AS text) IS NOT NULL),
+        now())
+    ON CONFLICT (processing_id_type, processing_id) DO UPDATE SET input_fingerprint = EXCLUDED.input_fingerprint,
+        flight_ids = EXCLUDED.flight_ids, updated_at = EXCLUDED.updated_at
+""".format(INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME, TEMP_TABLE_NAME))
+def is_input_fingerprint_cached(connection, processing_id_type, processing_id, input_fingerprint):
+    """ :return: Boolean, whether the inputs were already processed; counted as a cache hit or miss when the cache is on """
+    if not processor_config.input_fingerprint_cache:
+        return False
+    with time_phase('input_fingerprint_cache'):
+        cached_input_fingerprint = connection.execute(SELECT_CACHED_INPUT_FINGERPRINT_QUERY, processing_id_type=processing_id_type,
+                                                      processing_id=str(processing_id)).scalar()
+    # a processing_id without any input rows has no fingerprint and is never cached
+    if input_fingerprint is not None and cached_input_fingerprint == input_fingerprint:
+        increment('input_fingerprint_cache_hits')
+        return True
+    increment('input_fingerprint_cache_misses')
+    return False
+
+
+def cache_input_fingerprint(connection, processing_id_type, processing_id, input_fingerprint, date_window=None):
+    if not processor_config.input_fingerprint_cache or input_fingerprint is None or get_flight_date_window(processing_id_type, date_window) is not None:
+        return
+    flight_id = get_flight_id_of_processing_id(processing_id_type, processing_id) if processing_id_type in (LI_CODE_STRING, FLIGHT_ID_STRING) else None
+    with time_phase('input_fingerprint_cache'):
+        connection.execute(CACHE_INPUT_FINGERPRINT_QUERY, processing_id_type=processing_id_type, processing_id=str(processing_id),
+                           input_fingerprint=input_fingerprint, flight_id=flight_id)
+
+
+# Two phase transaction mode
+# The expected data is carried from the read only transaction to the write transaction in a session temp table
+# that, unlike the expected data temp table, keeps its rows on commit
+EXPECTED_DATA_SNAPSHOT_TABLE_NAME = 'expected_data_snapshot_temp_table'
+CREATE_EXPECTED_DATA_SNAPSHOT_TABLE_QUERY = "CREATE TEMP TABLE IF NOT EXISTS {0} (LIKE {1}) ON COMMIT PRESERVE ROWS;".format(
+    EXPECTED_DATA_SNAPSHOT_TABLE_NAME, TEMP_TABLE_NAME)
+READ_ONLY_SNAPSHOT_TRANSACTION_QUERY = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+SAVE_EXPECTED_DATA_QUERY = "DELETE FROM {0}; INSERT INTO {0} SELECT * FROM {1};".format(EXPECTED_DATA_SNAPSHOT_TABLE_NAME, TEMP_TABLE_NAME)
+RESTORE_EXPECTED_DATA_QUERY = "INSERT INTO {1} SELECT * FROM {0}; DELETE FROM {0};".format(EXPECTED_DATA_SNAPSHOT_TABLE_NAME, TEMP_TABLE_NAME)
+
+
+class InputsChangedError(Exception):
+    """ Raised in the write transaction of the two phase mode when the inputs changed after the expected data was built """
+    pass
+
+
+# Prepared statements
+# Every query above is prepared once per database session, so Postgres parses and plans it once per warm connection
+BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : 'build_expected_data_' + processing_id_type for processing_id_type in PROCESSING_ID_TYPES
+}
+INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : 'insert_within_flight_creative_conflict_' + processing_id_type for processing_id_type in PROCESSING_ID_TYPES
+}
+INPUT_FINGERPRINT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : 'input_fingerprint_' + processing_id_type for processing_id_type in PROCESSING_ID_TYPES
+}
+# Date window variants of the expected data statements, for li_code/flight_id; $2 and $3 bound the dates of raw delivery
+DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : 'build_expected_data_date_window_' + processing_id_type for processing_id_type in DATE_WINDOW_PROCESSING_ID_TYPES
+}
+DATE_WINDOW_INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : 'insert_within_flight_creative_conflict_date_window_' + processing_id_type
+    for processing_id_type in DATE_WINDOW_PROCESSING_ID_TYPES
+}
+PREPARE_STATEMENT_QUERY = "PREPARE {0}(text) AS {1};"
+PREPARE_DATE_WINDOW_STATEMENT_QUERY = "PREPARE {0}(text, date, date) AS {1};"
+CONNECTION_PREPARED_INFO_KEY = 'kinesis_lambda_processor_prepared'
+
+
+def get_prepare_connection_query():
+    """ Returns the session setup: the expected data temp tables plus every prepared statement """
+    queries = [CREATE_TEMP_TABLE_QUERY, CREATE_EXPECTED_DATA_SNAPSHOT_TABLE_QUERY, "DEALLOCATE ALL;"]
+    for processing_id_type in PROCESSING_ID_TYPES:
+        queries.append(PREPARE_STATEMENT_QUERY.format(
+            BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+            BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY.format(CONDITION_STRING_BY_PROCESSING_ID_TYPE[processing_id_type])
+        ))
+        conditional_query_tuple = WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE[processing_id_type]
+        queries.append(PREPARE_STATEMENT_QUERY.format(
+            INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+            INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY.format(TEMP_TABLE_NAME, *conditional_query_tuple)
+        ))
+        queries.append(PREPARE_STATEMENT_QUERY.format(
+            INPUT_FINGERPRINT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+            INPUT_FINGERPRINT_BASE_QUERY.format(SCOPED_INPUT_ROWS_BY_PROCESSING_ID_TYPE[processing_id_type])
+        ))
+    for processing_id_type in DATE_WINDOW_PROCESSING_ID_TYPES:
+        queries.append(PREPARE_DATE_WINDOW_STATEMENT_QUERY.format(
+            DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+            BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY.format(CONDITION_STRING_BY_PROCESSING_ID_TYPE[processing_id_type] + DATE_WINDOW_CONDITION.format('rd'))
+        ))
+        relevant_id_maps, condition = WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE[processing_id_type]
+        queries.append(PREPARE_DATE_WINDOW_STATEMENT_QUERY.format(
+            DATE_WINDOW_INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+            INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY.format(TEMP_TABLE_NAME, relevant_id_maps, condition + DATE_WINDOW_CONDITION.format('rd2'))
+        ))
+    return "\n".join(queries)
+
+
+PREPARE_CONNECTION_QUERY = get_prepare_connection_query()
+
+
+def prepare_connection(connection):
+    """
+    Sets up the session of the connection's DBAPI connection the first time it is used, in one round trip.
+    The flag lives on the DBAPI connection, so it is reset whenever the pool replaces that connection.
+    """
+    connection_info = connection.connection.info
+    if not connection_info.get(CONNECTION_PREPARED_INFO_KEY):
+        with time_phase('prepare_connection'):
+            connection.execute(PREPARE_CONNECTION_QUERY)
+        connection_info[CONNECTION_PREPARED_INFO_KEY] = True
+
+
+def forget_prepared_connection(connection):
+    """ A rollback may undo the temp table created by prepare_connection, so set up the session again on next use """
+    if not connection.invalidated:
+        connection.connection.info.pop(CONNECTION_PREPARED_INFO_KEY, None)
 
 
 # Calculate diffs against final results table
@@ -163,7 +577,36 @@ OUTPUT_TABLE = 'delivery_by_flight_creative_day'
 DCM_PROVIDER_STR = 'doubleclick'
 
 
-def calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_ids_affected, perform_deletions):
+# Output table is reflected once per execution context and reused by warm invocations
+_output_table = None
+_output_table_lock = threading.Lock()
+
+
+def get_output_table(connection):
+    """
+    Returns the reflected output table, reflecting only that table the first time it is needed.
+    The Table is not bound to any connection, so statements built from it must be run with connection.execute.
+    """
+    global _output_table
+    with _output_table_lock:
+        if _output_table is None:
+            # Filter warnings due to partial index reflection in SqlAlchemy
+            with warnings.catch_warnings(), time_phase('reflect_output_table'):
+                warnings.simplefilter("ignore", category=sa_exc.SAWarning)
+
+                metadata = MetaData(schema=OUTPUT_SCHEMA)
+                _output_table = Table(OUTPUT_TABLE, metadata, autoload=True, autoload_with=connection)
+        return _output_table
+
+
+def invalidate_output_table():
+    """ Drops the cached output table so it is reflected again; call after the output table's schema changes """
+    global _output_table
+    with _output_table_lock:
+        _output_table = None
+
+
+def calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_ids_affected, perform_deletions, check_inputs=None, date_window=None):
     """
     Calculates deletions and upserts from the temp_table to final output table.
     Unique key to update on is (flight_id, creative_id, date, provider, time_zone)
@@ -180,32 +623,40 @@ def calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_id
     :param temp_table: SqlAlchemy table object
     :param flight_ids_affected: List(String); can be empty
     :param perform_deletions: Boolean; only true if processing_id_type was li_code/flight_id
-    :return: 2 element tuple, (List(deleted rows), List(inserted rows))
+    :param check_inputs: Function(connection), called once the flights are locked; raises to abandon the writes
+    :param date_window: DateWindow the temp_table was built for, or None; deletions only mark rows within it
+    :return: 2 element tuple, (List(rows marked deleted), List(rows written)). Which rows are written depends on the upsert_strategy:
+        - delete_insert: every row of the temp_table, and every vanished row is marked deleted again
+        - on_conflict: only the temp_table rows that were new or had changed values
+        - diff: as on_conflict, and vanished rows that were already marked deleted are left out
     """
-    flight_ids_affected_string = "(" + ",".join(["'" + str(id) + "'" for id in flight_ids_affected]) + ")"
-
-    # Filter warnings due to partial index reflection in SqlAlchemy
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=sa_exc.SAWarning)
+    output_table = get_output_table(connection)
 
-        metadata = MetaData(connection, reflect=True, schema=OUTPUT_SCHEMA)
-        output_table = Table(OUTPUT_TABLE, metadata, autoload=True, autoload_with=connection)
-
-    # Lock rows; lock timeout should be caught, and force a retry
-    output_table.select().where(output_table.c.flight_id.in_([str(id) for id in flight_ids_affected])).with_for_update().execute()
+    # Lock flights; lock timeout should be caught, and force a retry
+    lock_function = LOCK_FUNCTION_BY_LOCKING_MODE[processor_config.locking_mode]
+    with time_phase('lock'):
+        lock_function(connection, output_table, [str(id) for id in flight_ids_affected])
+    if check_inputs:
+        check_inputs(connection)
 
     deleted = []
     if perform_deletions:
         # Deletions should only be performed when processing_id_type is li_code/flight_id (one flight affected)
         flight_id_affected = flight_ids_affected[0]
+        # Only the dates the temp table was built for can be missing from it
+        vanished_conditions = [] if date_window is None else [output_table.c.date.between(date_window.date_start, date_window.date_end)]
+        if processor_config.upsert_strategy == DIFF_UPSERT_STRATEGY:
+            # Rows already marked deleted are unchanged, so they aren't written again
+            vanished_conditions.append(output_table.c.is_deleted.isnot(True))
 
-        if not temp_table.select().execute().fetchone():
+        if not connection.execute(temp_table.select()).fetchone():
             # If no data in temp table, mark is_deleted for all of the flight's Doubleclick data
             deleted_query = \
                 output_table.update().returning(output_table.c.flight_id, output_table.c.creative_id, output_table.c.date).where(
                     and_(
                         output_table.c.flight_id == str(flight_id_affected),
-                        output_table.c.provider == DCM_PROVIDER_STR
+                        output_table.c.provider == DCM_PROVIDER_STR,
+                        *vanished_conditions
                     )
                 ).values(is_deleted=True, updated_at=current_timestamp())
             pass
@@ -227,12 +678,27 @@ def calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_id
                                 output_table.c.provider == DCM_PROVIDER_STR
                             )
                         ),
-                        output_table.c.provider == DCM_PROVIDER_STR
+                        output_table.c.provider == DCM_PROVIDER_STR,
+                        *vanished_conditions
                     )
                 ).values(is_deleted=True, updated_at=current_timestamp())
-        deleted = [dict(row) for row in deleted_query.execute().fetchall()]
+        with time_phase('soft_delete'):
+            deleted = [dict(row) for row in connection.execute(deleted_query).fetchall()]
+        add_phase_rows('soft_delete', len(deleted))
 
     # Do updates / insertions together
+    upsert_function = UPSERT_FUNCTION_BY_STRATEGY[processor_config.upsert_strategy]
+    written = upsert_function(connection, output_table, temp_table)
+
+    return (deleted, written)
+
+
+def upsert_with_delete_and_insert(connection, output_table, temp_table):
+    """
+    Upserts the temp_table into the output table by deleting every matching row and inserting the whole temp_table.
+
+    :return: List(rows written); every row of the temp_table
+    """
     delete_for_update_query = output_table.delete().where(
         and_(
             output_table.c.flight_id == temp_table.c.flight_id,
@@ -245,9 +711,143 @@ def calculate_diffs_and_writes_to_output_table(connection, temp_table, flight_id
             output_table.c.provider == DCM_PROVIDER_STR
         )
     )
-    delete_for_update_query.execute()
+    with time_phase('delete'):
+        result = connection.execute(delete_for_update_query)
+    add_phase_rows('delete', result.rowcount)
 
     insert_for_update_query = output_table.insert().returning(text('*')).from_select(temp_table.c, temp_table.select())
-    inserted = [dict(row) for row in insert_for_update_query.execute().fetchall()]
+    with time_phase('insert'):
+        inserted = [dict(row) for row in connection.execute(insert_for_update_query).fetchall()]
+    add_phase_rows('insert', len(inserted))
+    return inserted
+
+
+# Each partial unique index on the output table can only be the arbiter of its own half of the rows,
+# so the ON CONFLICT upsert runs once for rows with a creative_id and once for rows without one
+ON_CONFLICT_VALUES_COLUMNS = ('impressions', 'clicks', 'is_deleted')
+ON_CONFLICT_UPDATED_COLUMNS = ON_CONFLICT_VALUES_COLUMNS + ('updated_at',)
 
-    return (deleted, inserted)
\ No newline at end of file
+
+def upsert_with_on_conflict(connection, output_table, temp_table):
+    """
+    Upserts the temp_table into the output table with INSERT ... ON CONFLICT DO UPDATE.
+    Rows whose values are unchanged are not touched, so reprocessing unchanged data writes nothing.
+    Requires PostgreSQL 9.5+.
+
+    :return: List(rows written); only the rows that were new or had changed values
+    """
+    written = []
+    for creative_id_is_null in (False, True):
+        if creative_id_is_null:
+            index_where = output_table.c.creative_id.is_(None)
+            index_elements = ['date', 'flight_id', 'time_zone', 'provider']
+        else:
+            index_where = output_table.c.creative_id.isnot(None)
+            index_elements = ['date', 'flight_id', 'time_zone', 'provider', 'creative_id']
+
+        temp_table_condition = temp_table.c.creative_id.is_(None) if creative_id_is_null else temp_table.c.creative_id.isnot(None)
+        insert_query = postgresql.insert(output_table).from_select(temp_table.c, temp_table.select().where(temp_table_condition))
+        upsert_query = insert_query.on_conflict_do_update(
+            index_elements=index_elements,
+            index_where=index_where,
+            set_={column_name: insert_query.excluded[column_name] for column_name in ON_CONFLICT_UPDATED_COLUMNS},
+            where=or_(*[output_table.c[column_name].is_distinct_from(insert_query.excluded[column_name])
+                        for column_name in ON_CONFLICT_VALUES_COLUMNS])
+        ).returning(text('*'))
+        with time_phase('upsert'):
+            written.extend(dict(row) for row in connection.execute(upsert_query).fetchall())
+    add_phase_rows('upsert', len(written))
+    return written
+
+
+def upsert_with_diff(connection, output_table, temp_table):
+    """
+    Upserts the temp_table into the output table by diffing it on the unique key (flight_id, creative_id, date, time_zone, provider):
+        - changed: rows whose values differ are updated in place. None of the updated columns are indexed,
+          so Postgres can keep them on the same page as a HOT update, without new index entries
+        - new: temp_table rows without an output row are inserted
+        - unchanged: rows whose values are the same are not touched
+    Rows that vanished from the temp_table are marked deleted by the soft delete step.
+    Works on any PostgreSQL version, as it needs no ON CONFLICT arbiter index.
+
+    :return: List(rows written); only the rows that were new or had changed values
+    """
+    row_matches_condition = and_(
+        output_table.c.flight_id == temp_table.c.flight_id,
+        or_(
+            output_table.c.creative_id == temp_table.c.creative_id,
+            output_table.c.creative_id.isnot_distinct_from(temp_table.c.creative_id)
+        ),
+        output_table.c.date == temp_table.c.date,
+        output_table.c.time_zone == temp_table.c.time_zone,
+        output_table.c.provider == DCM_PROVIDER_STR
+    )
+
+    update_changed_query = output_table.update().returning(*output_table.c).where(
+        and_(
+            row_matches_condition,
+            or_(*[output_table.c[column_name].is_distinct_from(temp_table.c[column_name]) for column_name in ON_CONFLICT_VALUES_COLUMNS])
+        )
+    ).values({column_name: temp_table.c[column_name] for column_name in ON_CONFLICT_UPDATED_COLUMNS})
+    with time_phase('update_changed'):
+        updated = [dict(row) for row in connection.execute(update_changed_query).fetchall()]
+    add_phase_rows('update_changed', len(updated))
+
+    insert_new_query = output_table.insert().returning(text('*')).from_select(
+        temp_table.c, temp_table.select().where(~exists().where(row_matches_condition)))
+    with time_phase('insert_new'):
+        new_rows = [dict(row) for row in connection.execute(insert_new_query).fetchall()]
+    add_phase_rows('insert_new', len(new_rows))
+    return updated + new_rows
+
+
+DELETE_INSERT_UPSERT_STRATEGY = 'delete_insert'
+ON_CONFLICT_UPSERT_STRATEGY = 'on_conflict'
+DIFF_UPSERT_STRATEGY = 'diff'
+UPSERT_FUNCTION_BY_STRATEGY = {
+    DELETE_INSERT_UPSERT_STRATEGY : upsert_with_delete_and_insert,
+    ON_CONFLICT_UPSERT_STRATEGY : upsert_with_on_conflict,
+    DIFF_UPSERT_STRATEGY : upsert_with_diff
+}
+
+
+def lock_flights_with_row_locks(connection, output_table, flight_ids):
+    """ Locks every existing output table row of the flights; flights without rows yet are not locked """
+    connection.execute(output_table.select().where(output_table.c.flight_id.in_(flight_ids)).with_for_update())
+
+
+# Advisory locks are keyed on (ADVISORY_LOCK_NAMESPACE, hashtext(flight_id)), so they can't collide with
+# single key advisory locks taken by other applications on the same database
+ADVISORY_LOCK_NAMESPACE = 5001
+ADVISORY_LOCK_FLIGHTS_QUERY = text("""
+    SELECT pg_advisory_xact_lock(:namespace, flight_id_hash)
+    FROM (
+        SELECT DISTINCT hashtext(flight_id) AS flight_id_hash FROM unnest(CAST(:flight_ids AS text[])) flight_id
+        ORDER BY 1
+    ) flight_id_hashes
+""")
+
+
+def lock_flights_with_advisory_locks(connection, output_table, flight_ids):
+    """
+    Takes one transaction level advisory lock per flight, whether or not the flight has rows yet.
+    Locks are taken in hash order, so writers locking overlapping sets of flights can't deadlock.
+    Only writers using advisory locks exclude each other, so every writer must use the same locking mode.
+    """
+    connection.execute(ADVISORY_LOCK_FLIGHTS_QUERY, namespace=ADVISORY_LOCK_NAMESPACE, flight_ids=flight_ids).fetchall()
+
+
+ROW_LOCKING_MODE = 'row_lock'
+ADVISORY_LOCKING_MODE = 'advisory'
+LOCK_FUNCTION_BY_LOCKING_MODE = {
+    ROW_LOCKING_MODE : lock_flights_with_row_locks,
+    ADVISORY_LOCKING_MODE : lock_flights_with_advisory_locks
+}
+
+
+ONE_TRANSACTION_MODE = 'one_transaction'
+TWO_PHASE_TRANSACTION_MODE = 'two_phase'
+PROCESS_FUNCTION_BY_TRANSACTION_MODE = {
+    ONE_TRANSACTION_MODE : process_processing_id_in_one_transaction,
+    TWO_PHASE_TRANSACTION_MODE : process_processing_id_in_two_phases
+}
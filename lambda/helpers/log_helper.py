@@ -0,0 +1,71 @@
+"""
+Structured logging for the hot path: every line is one JSON object, {'message': event, **fields}.
+
+Lines are only serialized when a handler formats them, so lines below the logger's level cost no string building.
+Per unit of work info lines go through log_sampled, which only logs a processor_config.log_sample_rate share of them;
+batch summaries (log_info) and errors (log_error) are always logged. Warnings (log_warning) are always logged unless
+processor_config.log_sample_rate_by_event gives their event a rate, which also overrides log_sample_rate for log_sampled. Errors logged while a unit of work records its
+phase metrics carry its dimensions, properties (e.g. processing_id) and the phase timings so far.
+"""
+import json
+import logging
+import random
+from collections import OrderedDict
+
+from config import processor_config
+from helpers.metrics_helper import get_current_phase_metrics
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class StructuredMessage(object):
+    """ Log message serialized to JSON on first use, by the handler formatting the record """
+
+    def __init__(self, event, fields):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        document = OrderedDict([('message', self.event)])
+        document.update(sorted(self.fields.items()))
+        return json.dumps(document, default=str)
+
+
+def log(level, event, fields, exc_info=False):
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s', StructuredMessage(event, fields), exc_info=exc_info)
+
+
+def log_info(event, **fields):
+    log(logging.INFO, event, fields)
+
+
+def log_with_sample_rate(level, event, fields, sample_rate):
+    if random.random() < sample_rate:
+        fields['sample_rate'] = sample_rate
+        log(level, event, fields)
+
+
+def log_sampled(event, **fields):
+    sample_rate = processor_config.log_sample_rate_by_event.get(event, processor_config.log_sample_rate)
+    log_with_sample_rate(logging.INFO, event, fields, sample_rate)
+
+
+def log_warning(event, **fields):
+    sample_rate = processor_config.log_sample_rate_by_event.get(event)
+    if sample_rate is None:
+        log(logging.WARNING, event, fields)
+    else:
+        log_with_sample_rate(logging.WARNING, event, fields, sample_rate)
+
+
+def log_error(event, exc_info=True, **fields):
+    """ :param exc_info: Boolean, whether to log the traceback of the exception being handled """
+    phase_metrics = get_current_phase_metrics()
+    if phase_metrics is not None:
+        fields.update(phase_metrics.dimensions)
+        fields.update(phase_metrics.properties)
+        fields['phase_ms'] = OrderedDict((phase, round(duration_ms, 3)) for phase, duration_ms in phase_metrics.duration_ms_by_phase.items())
+    log(logging.ERROR, event, fields, exc_info=exc_info)
@@ -0,0 +1,129 @@
+"""
+Per-phase timing of a unit of work, emitted as one CloudWatch Embedded Metric Format (EMF) line per unit of work,
+plus one line per batch for the handler's own phases.
+
+The handler wraps each unit of work in record_phase_metrics; anything it calls, on the same thread,
+times its phases with time_phase and adds row counts with add_phase_rows. Outside of record_phase_metrics
+both are no-ops, so helpers can be used without a handler (tests, benchmarks, the CLI).
+
+EMF lines are printed to stdout as bare JSON, as CloudWatch only extracts metrics from log events that are JSON.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from config import processor_config
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+METRICS_NAMESPACE = 'KinesisLambdaProcessor'
+DURATION_METRIC_SUFFIX = '_ms'
+ROWS_METRIC_SUFFIX = '_rows'
+
+# Phase metrics being recorded by the current thread's unit of work
+_current = threading.local()
+
+
+class PhaseMetrics(object):
+
+    def __init__(self, dimensions, properties=None):
+        self.dimensions = OrderedDict(dimensions)
+        self.properties = OrderedDict(properties or {})
+        self.duration_ms_by_phase = OrderedDict()
+        self.rows_by_phase = OrderedDict()
+        self.count_by_name = OrderedDict()
+
+    def add_duration(self, phase, duration_ms):
+        self.duration_ms_by_phase[phase] = self.duration_ms_by_phase.get(phase, 0.0) + duration_ms
+
+    def add_rows(self, phase, rows):
+        self.rows_by_phase[phase] = self.rows_by_phase.get(phase, 0) + rows
+
+    def increment(self, name, count=1):
+        self.count_by_name[name] = self.count_by_name.get(name, 0) + count
+
+    def to_embedded_metric_format(self, timestamp_ms=None):
+        """ :return: Dict, the EMF document; every phase duration, row count and count is a metric """
+        values = OrderedDict()
+        units = OrderedDict()
+        for phase, duration_ms in self.duration_ms_by_phase.items():
+            values[phase + DURATION_METRIC_SUFFIX] = round(duration_ms, 3)
+            units[phase + DURATION_METRIC_SUFFIX] = 'Milliseconds'
+        for phase, rows in self.rows_by_phase.items():
+            values[phase + ROWS_METRIC_SUFFIX] = rows
+            units[phase + ROWS_METRIC_SUFFIX] = 'Count'
+        for name, count in self.count_by_name.items():
+            values[name] = count
+            units[name] = 'Count'
+
+        document = OrderedDict([('_aws', OrderedDict([
+            ('Timestamp', int(time.time() * 1000) if timestamp_ms is None else timestamp_ms),
+            ('CloudWatchMetrics', [OrderedDict([
+                ('Namespace', METRICS_NAMESPACE),
+                ('Dimensions', [list(self.dimensions)]),
+                ('Metrics', [{'Name': name, 'Unit': unit} for name, unit in units.items()])
+            ])])
+        ]))])
+        document.update(self.dimensions)
+        document.update(self.properties)
+        document.update(values)
+        return document
+
+
+def get_current_phase_metrics():
+    return getattr(_current, 'phase_metrics', None)
+
+
+@contextmanager
+def record_phase_metrics(dimensions, properties=None):
+    """
+    Records the phases of one unit of work run on this thread, and emits them when it finishes, whether or not it failed.
+
+    :param dimensions: Dict, low cardinality EMF dimensions, e.g. processing_id_type
+    :param properties: Dict, logged with the metrics but not metrics themselves, e.g. processing_id
+    """
+    phase_metrics = PhaseMetrics(dimensions, properties)
+    # a unit of work processed on the thread recording its batch takes over until it finishes
+    outer_phase_metrics = get_current_phase_metrics()
+    _current.phase_metrics = phase_metrics
+    try:
+        with time_phase('total'):
+            yield phase_metrics
+    finally:
+        _current.phase_metrics = outer_phase_metrics
+        if processor_config.phase_metrics:
+            emit(phase_metrics)
+
+
+@contextmanager
+def time_phase(phase):
+    phase_metrics = get_current_phase_metrics()
+    if phase_metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_metrics.add_duration(phase, (time.perf_counter() - start) * 1000)
+
+
+def add_phase_rows(phase, rows):
+    phase_metrics = get_current_phase_metrics()
+    if phase_metrics is not None and rows is not None and rows >= 0:
+        phase_metrics.add_rows(phase, rows)
+
+
+def increment(name, count=1):
+    phase_metrics = get_current_phase_metrics()
+    if phase_metrics is not None:
+        phase_metrics.increment(name, count)
+
+
+def emit(phase_metrics):
+    print(json.dumps(phase_metrics.to_embedded_metric_format(), default=str), flush=True)
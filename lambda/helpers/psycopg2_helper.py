@@ -0,0 +1,230 @@
+"""
+psycopg2 processing engine: the process_processing_id pipeline of database_helper, run as precompiled SQL text
+directly on the connection's psycopg2 cursor, without building, compiling or wrapping SQLAlchemy statements.
+
+The SQLAlchemy connection is still used for pooling, session setup and error handling, so both engines
+share the pool, the prepared expected data statements and the retry behaviour. Units of work are never skipped
+by the input fingerprint cache; the output table's triggers still drop the fingerprints of the flights written.
+"""
+import logging
+
+import psycopg2
+from sqlalchemy import exc as sa_exc
+
+from config import processor_config
+from helpers.database_helper import (OUTPUT_SCHEMA, OUTPUT_TABLE, DCM_PROVIDER_STR, TEMP_TABLE_NAME, TEMP_TABLE_COLUMNS,
+                                     LI_CODE_STRING, FLIGHT_ID_STRING, ON_CONFLICT_VALUES_COLUMNS, ON_CONFLICT_UPDATED_COLUMNS,
+                                     ADVISORY_LOCK_NAMESPACE, ROW_LOCKING_MODE, ADVISORY_LOCKING_MODE,
+                                     DELETE_INSERT_UPSERT_STRATEGY, ON_CONFLICT_UPSERT_STRATEGY, DIFF_UPSERT_STRATEGY,
+                                     BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE,
+                                     INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE,
+                                     get_flight_id_of_processing_id, prepare_connection)
+from helpers.metrics_helper import time_phase, add_phase_rows
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+OUTPUT_TABLE_FULL_NAME = OUTPUT_SCHEMA + '.' + OUTPUT_TABLE
+TEMP_TABLE_COLUMN_NAMES = ', '.join(name for name, column_type in TEMP_TABLE_COLUMNS)
+
+# Every statement below mirrors the SQLAlchemy statement of database_helper named in its comment
+# generate_expected_data_temp_table
+EXECUTE_STATEMENT_QUERY = "EXECUTE {0}(%(processing_id)s);"
+EXECUTE_EXPECTED_DATA_STATEMENTS_QUERY_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : EXECUTE_STATEMENT_QUERY.format(statement_name) + EXECUTE_STATEMENT_QUERY.format(
+        INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type])
+    for processing_id_type, statement_name in BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.items()
+}
+SELECT_TEMP_TABLE_FLIGHT_IDS_QUERY = "SELECT DISTINCT flight_id FROM " + TEMP_TABLE_NAME
+TEMP_TABLE_HAS_ROWS_QUERY = "SELECT EXISTS (SELECT 1 FROM " + TEMP_TABLE_NAME + ")"
+
+# lock_flights_with_row_locks and lock_flights_with_advisory_locks
+LOCK_FLIGHTS_QUERY_BY_LOCKING_MODE = {
+    ROW_LOCKING_MODE : "SELECT 1 FROM " + OUTPUT_TABLE_FULL_NAME + " WHERE flight_id = ANY(%(flight_ids)s) FOR UPDATE",
+    ADVISORY_LOCKING_MODE : """
+        SELECT pg_advisory_xact_lock(%(namespace)s, flight_id_hash)
+        FROM (
+            SELECT DISTINCT hashtext(flight_id) AS flight_id_hash FROM unnest(CAST(%(flight_ids)s AS text[])) flight_id
+            ORDER BY 1
+        ) flight_id_hashes
+    """
+}
+
+# calculate_diffs_and_writes_to_output_table
+# A temp table row matches an output row on (flight_id, creative_id, date, time_zone) of a Doubleclick output row
+TEMP_TABLE_ROW_MATCHES_OUTPUT_ROW_CONDITION = """
+    o.flight_id = t.flight_id AND (o.creative_id = t.creative_id OR o.creative_id IS NOT DISTINCT FROM t.creative_id)
+    AND o.date = t.date AND o.time_zone = t.time_zone AND o.provider = '""" + DCM_PROVIDER_STR + "'"
+MARK_FLIGHT_DELETED_BASE_QUERY = """
+    UPDATE """ + OUTPUT_TABLE_FULL_NAME + """ o SET is_deleted = TRUE, updated_at = CURRENT_TIMESTAMP
+    WHERE o.flight_id = %(flight_id)s AND o.provider = '""" + DCM_PROVIDER_STR + """'{0}
+    RETURNING o.flight_id, o.creative_id, o.date
+"""
+MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_BASE_QUERY = """
+    UPDATE """ + OUTPUT_TABLE_FULL_NAME + """ o SET is_deleted = TRUE, updated_at = CURRENT_TIMESTAMP
+    WHERE o.flight_id = %(flight_id)s
+    AND NOT EXISTS (SELECT 1 FROM """ + TEMP_TABLE_NAME + " t WHERE " + TEMP_TABLE_ROW_MATCHES_OUTPUT_ROW_CONDITION + """)
+    AND o.provider = '""" + DCM_PROVIDER_STR + """'{0}
+    RETURNING o.flight_id, o.creative_id, o.date
+"""
+MARK_FLIGHT_DELETED_QUERY = MARK_FLIGHT_DELETED_BASE_QUERY.format('')
+MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_QUERY = MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_BASE_QUERY.format('')
+# The diff strategy doesn't write rows already marked deleted again
+NOT_ALREADY_DELETED_CONDITION = " AND o.is_deleted IS NOT TRUE"
+# (query when the temp table has rows, query when it has none)
+SOFT_DELETE_QUERIES_BY_UPSERT_STRATEGY = {
+    DELETE_INSERT_UPSERT_STRATEGY : (MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_QUERY, MARK_FLIGHT_DELETED_QUERY),
+    ON_CONFLICT_UPSERT_STRATEGY : (MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_QUERY, MARK_FLIGHT_DELETED_QUERY),
+    DIFF_UPSERT_STRATEGY : (MARK_FLIGHT_ROWS_NOT_IN_TEMP_TABLE_DELETED_BASE_QUERY.format(NOT_ALREADY_DELETED_CONDITION),
+                            MARK_FLIGHT_DELETED_BASE_QUERY.format(NOT_ALREADY_DELETED_CONDITION))
+}
+
+# upsert_with_delete_and_insert
+DELETE_TEMP_TABLE_ROWS_QUERY = "DELETE FROM " + OUTPUT_TABLE_FULL_NAME + " o USING " + TEMP_TABLE_NAME + " t WHERE " + \
+    TEMP_TABLE_ROW_MATCHES_OUTPUT_ROW_CONDITION
+INSERT_TEMP_TABLE_ROWS_QUERY = "INSERT INTO {0} ({1}) SELECT {1} FROM {2} RETURNING *".format(
+    OUTPUT_TABLE_FULL_NAME, TEMP_TABLE_COLUMN_NAMES, TEMP_TABLE_NAME)
+
+# upsert_with_on_conflict, run once per partial unique index
+ON_CONFLICT_UPSERT_BASE_QUERY = """
+    INSERT INTO {0} AS o ({1}) SELECT {1} FROM {2} WHERE creative_id {3}
+    ON CONFLICT ({4}) WHERE creative_id {3}
+    DO UPDATE SET {5}
+    WHERE {6}
+    RETURNING *
+""".format(
+    OUTPUT_TABLE_FULL_NAME, TEMP_TABLE_COLUMN_NAMES, TEMP_TABLE_NAME, '{0}', '{1}',
+    ', '.join('{0} = excluded.{0}'.format(column_name) for column_name in ON_CONFLICT_UPDATED_COLUMNS),
+    ' OR '.join('o.{0} IS DISTINCT FROM excluded.{0}'.format(column_name) for column_name in ON_CONFLICT_VALUES_COLUMNS)
+)
+ON_CONFLICT_UPSERT_QUERIES = (
+    ON_CONFLICT_UPSERT_BASE_QUERY.format('IS NOT NULL', 'date, flight_id, time_zone, provider, creative_id'),
+    ON_CONFLICT_UPSERT_BASE_QUERY.format('IS NULL', 'date, flight_id, time_zone, provider')
+)
+
+# upsert_with_diff
+UPDATE_CHANGED_TEMP_TABLE_ROWS_QUERY = """
+    UPDATE {0} o SET {1}
+    FROM {2} t
+    WHERE {3} AND ({4})
+    RETURNING o.*
+""".format(
+    OUTPUT_TABLE_FULL_NAME,
+    ', '.join('{0} = t.{0}'.format(column_name) for column_name in ON_CONFLICT_UPDATED_COLUMNS),
+    TEMP_TABLE_NAME, TEMP_TABLE_ROW_MATCHES_OUTPUT_ROW_CONDITION,
+    ' OR '.join('o.{0} IS DISTINCT FROM t.{0}'.format(column_name) for column_name in ON_CONFLICT_VALUES_COLUMNS)
+)
+INSERT_NEW_TEMP_TABLE_ROWS_QUERY = """
+    INSERT INTO {0} ({1}) SELECT {1} FROM {2} t
+    WHERE NOT EXISTS (SELECT 1 FROM {0} o WHERE {3})
+    RETURNING *
+""".format(OUTPUT_TABLE_FULL_NAME, TEMP_TABLE_COLUMN_NAMES, TEMP_TABLE_NAME, TEMP_TABLE_ROW_MATCHES_OUTPUT_ROW_CONDITION)
+
+
+def process_processing_id_with_psycopg2(connection, processing_id_type, processing_id):
+    """
+    Same pipeline and return value as database_helper.process_processing_id.
+    psycopg2 errors are re-raised as the SQLAlchemy errors the SQLAlchemy engine would raise, so callers handle both alike.
+
+    :param connection: SQLAlchemy Connection; the pipeline runs on its DBAPI connection
+    :return: 2 element tuple, (List(rows marked deleted), List(rows written)); rows are dicts
+    """
+    # Prepared in its own autocommitted transaction, so a rollback below can't undo the session setup
+    prepare_connection(connection)
+    dbapi_connection = connection.connection
+    cursor = dbapi_connection.cursor()
+    try:
+        result = process_processing_id_on_cursor(cursor, processing_id_type, str(processing_id))
+        dbapi_connection.commit()
+        return result
+    except psycopg2.Error as e:
+        if not dbapi_connection.closed:
+            dbapi_connection.rollback()
+        raise to_dbapi_error(connection, cursor, e)
+    except Exception:
+        dbapi_connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def to_dbapi_error(connection, cursor, error):
+    """
+    Converts a psycopg2 error raised on the DBAPI connection of a SQLAlchemy Connection into the SQLAlchemy error
+    the SQLAlchemy engine would raise, so retry_helper classifies both alike. A connection the error closed is invalidated.
+
+    :return: sqlalchemy.exc.DBAPIError, to be raised by the caller
+    """
+    connection_invalidated = bool(connection.connection.closed)
+    if connection_invalidated:
+        connection.invalidate(error)
+    return sa_exc.DBAPIError.instance(cursor.query, None, error, psycopg2.Error, connection_invalidated=connection_invalidated)
+
+
+def process_processing_id_on_cursor(cursor, processing_id_type, processing_id):
+    with time_phase('build_expected_data'):
+        cursor.execute(EXECUTE_EXPECTED_DATA_STATEMENTS_QUERY_BY_PROCESSING_ID_TYPE[processing_id_type], {'processing_id': processing_id})
+
+    if processing_id_type in (LI_CODE_STRING, FLIGHT_ID_STRING):
+        flight_ids_affected = [get_flight_id_of_processing_id(processing_id_type, processing_id)]
+        perform_deletions = True
+    else:
+        cursor.execute(SELECT_TEMP_TABLE_FLIGHT_IDS_QUERY)
+        flight_ids_affected = [row[0] for row in cursor.fetchall()]
+        perform_deletions = False
+    if not perform_deletions and not flight_ids_affected:
+        # processing import_id, but no data in the temp table
+        return ([], [])
+
+    # Lock flights; lock timeout should be caught, and force a retry
+    with time_phase('lock'):
+        cursor.execute(LOCK_FLIGHTS_QUERY_BY_LOCKING_MODE[processor_config.locking_mode],
+                       {'flight_ids': flight_ids_affected, 'namespace': ADVISORY_LOCK_NAMESPACE})
+
+    deleted = []
+    if perform_deletions:
+        with time_phase('soft_delete'):
+            mark_rows_not_in_temp_table_deleted_query, mark_flight_deleted_query = SOFT_DELETE_QUERIES_BY_UPSERT_STRATEGY[processor_config.upsert_strategy]
+            cursor.execute(TEMP_TABLE_HAS_ROWS_QUERY)
+            if cursor.fetchone()[0]:
+                cursor.execute(mark_rows_not_in_temp_table_deleted_query, {'flight_id': flight_ids_affected[0]})
+            else:
+                cursor.execute(mark_flight_deleted_query, {'flight_id': flight_ids_affected[0]})
+            deleted = fetch_all_as_dicts(cursor)
+        add_phase_rows('soft_delete', len(deleted))
+
+    if processor_config.upsert_strategy == ON_CONFLICT_UPSERT_STRATEGY:
+        written = []
+        with time_phase('upsert'):
+            for upsert_query in ON_CONFLICT_UPSERT_QUERIES:
+                cursor.execute(upsert_query)
+                written.extend(fetch_all_as_dicts(cursor))
+        add_phase_rows('upsert', len(written))
+    elif processor_config.upsert_strategy == DELETE_INSERT_UPSERT_STRATEGY:
+        with time_phase('delete'):
+            cursor.execute(DELETE_TEMP_TABLE_ROWS_QUERY)
+        add_phase_rows('delete', cursor.rowcount)
+        with time_phase('insert'):
+            cursor.execute(INSERT_TEMP_TABLE_ROWS_QUERY)
+            written = fetch_all_as_dicts(cursor)
+        add_phase_rows('insert', len(written))
+    elif processor_config.upsert_strategy == DIFF_UPSERT_STRATEGY:
+        with time_phase('update_changed'):
+            cursor.execute(UPDATE_CHANGED_TEMP_TABLE_ROWS_QUERY)
+            updated = fetch_all_as_dicts(cursor)
+        add_phase_rows('update_changed', len(updated))
+        with time_phase('insert_new'):
+            cursor.execute(INSERT_NEW_TEMP_TABLE_ROWS_QUERY)
+            new_rows = fetch_all_as_dicts(cursor)
+        add_phase_rows('insert_new', len(new_rows))
+        written = updated + new_rows
+    else:
+        raise ValueError('Unknown upsert_strategy: {}'.format(processor_config.upsert_strategy))
+
+    return (deleted, written)
+
+
+def fetch_all_as_dicts(cursor):
+    column_names = [column.name for column in cursor.description]
+    return [dict(zip(column_names, row)) for row in cursor.fetchall()]
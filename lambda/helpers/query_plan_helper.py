@@ -0,0 +1,105 @@
+"""
+Query plan capture for slow units of work.
+
+When a unit of work takes longer than processor_config.slow_invocation_threshold_ms, the statement building its
+expected data is explained with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) on the same connection, right after the unit
+finished. That statement only inserts into the session's temp table, and it runs in an explicit transaction that is
+always rolled back, so the output table is never touched. The plan is logged as one JSON line with the
+processing_id_type and processing_id it was captured for.
+
+Only the python and psycopg2 engines capture: the server_function engine's connections autocommit every statement,
+which would leave nothing to roll back. Captures are sampled by processor_config.query_plan_sample_rate and rate
+limited to one per processor_config.query_plan_capture_interval_seconds per execution context.
+"""
+import logging
+import random
+import threading
+import time
+
+from sqlalchemy import text
+
+from config import processor_config
+from helpers.database_helper import (BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE,
+                                     DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE,
+                                     EXECUTE_DATE_WINDOW_STATEMENT_QUERY, get_flight_date_window, prepare_connection)
+from helpers.log_helper import log_info, log_warning
+from helpers.metrics_helper import time_phase, increment
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+QUERY_PLAN_PROCESSING_ENGINES = ('python', 'psycopg2')
+EXPLAIN_QUERY_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+# time.monotonic() of the last capture of this execution context
+_last_capture_time = None
+_last_capture_time_lock = threading.Lock()
+
+
+def maybe_capture_query_plan(connection, processing_id_type, processing_id, duration_ms, date_window=None):
+    """
+    Captures and logs the expected data query plan of a unit of work if it was slow, and it is sampled and not rate limited.
+    Never raises; a failed capture is only logged.
+
+    :param connection: SQLAlchemy Connection the unit of work ran on, with no transaction open
+    :param duration_ms: Float, how long the unit of work took
+    :param date_window: DateWindow the unit of work was limited to, or None
+    :return: Boolean, whether the plan was captured
+    """
+    if not processor_config.slow_invocation_threshold_ms or duration_ms < processor_config.slow_invocation_threshold_ms:
+        return False
+    if processor_config.processing_engine not in QUERY_PLAN_PROCESSING_ENGINES:
+        return False
+    if random.random() >= processor_config.query_plan_sample_rate or not acquire_capture_slot():
+        return False
+
+    try:
+        with time_phase('query_plan_capture'):
+            query_plan = capture_query_plan(connection, processing_id_type, processing_id, date_window)
+    except Exception as e:
+        log_warning('query_plan_capture_failed', processing_id_type=processing_id_type, processing_id=processing_id, error=str(e))
+        return False
+
+    increment('query_plan_captures')
+    log_info('query_plan', processing_id_type=processing_id_type, processing_id=processing_id, duration_ms=round(duration_ms, 3),
+             statement='build_expected_data', plan=query_plan)
+    return True
+
+
+def acquire_capture_slot():
+    """ :return: Boolean, True if no capture happened within the capture interval; the caller then owns the next one """
+    global _last_capture_time
+    with _last_capture_time_lock:
+        now = time.monotonic()
+        if _last_capture_time is not None and now - _last_capture_time < processor_config.query_plan_capture_interval_seconds:
+            return False
+        _last_capture_time = now
+        return True
+
+
+def capture_query_plan(connection, processing_id_type, processing_id, date_window=None):
+    """
+    Runs the expected data statement of the unit of work under EXPLAIN ANALYZE in a transaction, then rolls it back.
+
+    :return: List, the plan as returned by EXPLAIN FORMAT JSON
+    """
+    # Prepared in its own autocommitted transaction, so the rollback below can't undo the session setup
+    prepare_connection(connection)
+    if connection.connection.autocommit:
+        raise RuntimeError('connection autocommits, so the explained statement could not be rolled back')
+
+    date_window = get_flight_date_window(processing_id_type, date_window)
+    if date_window is None:
+        query = "EXECUTE {0}(:processing_id)".format(BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type])
+        parameters = {'processing_id': str(processing_id)}
+    else:
+        query = EXECUTE_DATE_WINDOW_STATEMENT_QUERY.format(DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type])
+        parameters = {'processing_id': str(processing_id), 'date_start': date_window.date_start, 'date_end': date_window.date_end}
+
+    transaction = connection.begin()
+    try:
+        return connection.execute(text(EXPLAIN_QUERY_PREFIX + query), **parameters).scalar()
+    finally:
+        # EXPLAIN ANALYZE really ran the insert into the temp table; undo it
+        transaction.rollback()
@@ -0,0 +1,164 @@
+"""
+Read replica offload: the expected data of a unit of work is computed on a streaming replica of the database,
+copied to the primary's expected data temp table with COPY, then diffed and written on the primary in one short transaction.
+
+The replica is only used once it has replayed every transaction the primary had committed when the unit started,
+so it sees at least the upstream data the unit was sent for; it is waited on for at most
+processor_config.replica_max_wait_ms. The expected data and the input fingerprint of the processing_id are read in the
+same replica snapshot, and the fingerprint is checked again on the primary once the flights are locked;
+row versions are identical on a physical replica, so a mismatch means the inputs changed in between.
+Whenever the replica is lagging, unreachable, fails while waited on or read, or its inputs changed, the unit is
+processed on the primary.
+
+Hot standbys can't create temp tables, so the replica runs plain SELECTs with the processing_id bound as a literal,
+instead of the prepared statements of the primary.
+"""
+import io
+import logging
+import time
+
+import psycopg2
+from sqlalchemy import exc as sa_exc
+from sqlalchemy import text
+
+from config import processor_config
+from helpers.database_helper import (TEMP_TABLE_NAME, CONDITION_STRING_BY_PROCESSING_ID_TYPE, BUILD_EXPECTED_DATA_SELECT_BASE_QUERY,
+                                     WITHIN_FLIGHT_CREATIVE_CONFLICT_SELECT_BASE_QUERY, INPUT_FINGERPRINT_BASE_QUERY,
+                                     WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE,
+                                     SCOPED_INPUT_ROWS_BY_PROCESSING_ID_TYPE, InputsChangedError, process_processing_id,
+                                     process_processing_id_in_one_transaction, prepare_connection, get_input_fingerprint,
+                                     write_expected_data_to_output_table, EXPECTED_DATA_TEMP_TABLE, READ_ONLY_SNAPSHOT_TRANSACTION_QUERY)
+from helpers.log_helper import log_warning
+from helpers.metrics_helper import time_phase, add_phase_rows, increment
+from helpers.psycopg2_helper import to_dbapi_error
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REPLICA_LAG_POLL_MS = 20
+
+# WAL positions; the functions were renamed in PostgreSQL 10. Both run autocommitted, so neither connection
+# is left idle in a transaction while waiting
+CURRENT_WAL_LOCATION_QUERY_BY_WAL_NAMING = {
+    'wal' : text("SELECT pg_current_wal_lsn()::text").execution_options(autocommit=True),
+    'xlog' : text("SELECT pg_current_xlog_location()::text").execution_options(autocommit=True)
+}
+# A server that isn't in recovery is not a replica, so it has no lag
+REPLAYED_WAL_LOCATION_QUERY_BY_WAL_NAMING = {
+    'wal' : text("SELECT NOT pg_is_in_recovery() OR pg_wal_lsn_diff(pg_last_wal_replay_lsn(), CAST(:wal_location AS pg_lsn)) >= 0"
+                 ).execution_options(autocommit=True),
+    'xlog' : text("SELECT NOT pg_is_in_recovery() OR pg_xlog_location_diff(pg_last_xlog_replay_location(), CAST(:wal_location AS pg_lsn)) >= 0"
+                  ).execution_options(autocommit=True)
+}
+
+COPY_EXPECTED_DATA_FROM_REPLICA_QUERY_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : "COPY (({0}) UNION ALL ({1})) TO STDOUT".format(
+        BUILD_EXPECTED_DATA_SELECT_BASE_QUERY.format(CONDITION_STRING_BY_PROCESSING_ID_TYPE[processing_id_type]),
+        WITHIN_FLIGHT_CREATIVE_CONFLICT_SELECT_BASE_QUERY.format(*WITHIN_FLIGHT_CREATIVE_CONFLICT_QUERY_CONDITIONS_BY_PROCESSING_ID_TYPE[processing_id_type])
+    )
+    for processing_id_type in CONDITION_STRING_BY_PROCESSING_ID_TYPE
+}
+REPLICA_INPUT_FINGERPRINT_QUERY_BY_PROCESSING_ID_TYPE = {
+    processing_id_type : INPUT_FINGERPRINT_BASE_QUERY.format(scoped_input_rows)
+    for processing_id_type, scoped_input_rows in SCOPED_INPUT_ROWS_BY_PROCESSING_ID_TYPE.items()
+}
+COPY_EXPECTED_DATA_TO_PRIMARY_QUERY = "COPY {} FROM STDIN".format(TEMP_TABLE_NAME)
+
+
+def process_processing_id_with_replica(connection, processing_id_type, processing_id, replica_engine):
+    """
+    Same return value as database_helper.process_processing_id, which processes the unit on the primary
+    whenever the replica can't be used.
+
+    :param connection: SQLAlchemy Connection to the primary
+    :param replica_engine: SQLAlchemy Engine of the replica, made by database_helper.create_new_engine
+    """
+    try:
+        replica_connection = replica_engine.connect()
+        try:
+            with time_phase('replica_wait'):
+                replica_is_current = wait_for_replica(connection, replica_connection)
+            if replica_is_current:
+                with time_phase('replica_expected_data'):
+                    expected_data, input_fingerprint = read_expected_data_from_replica(replica_connection, processing_id_type, processing_id)
+        finally:
+            replica_connection.close()
+    except (psycopg2.Error, sa_exc.DBAPIError) as e:
+        # e.g. unreachable, restarted mid COPY, or a recovery conflict cancelling the replica's snapshot
+        log_warning('replica_unavailable', processing_id_type=processing_id_type, processing_id=processing_id, error=str(e))
+        increment('replica_unavailable')
+        return process_processing_id(connection, processing_id_type, processing_id)
+    if not replica_is_current:
+        increment('replica_lagging')
+        return process_processing_id(connection, processing_id_type, processing_id)
+
+    def check_inputs_unchanged(connection):
+        with time_phase('check_inputs'):
+            if get_input_fingerprint(connection, processing_id_type, processing_id) != input_fingerprint:
+                raise InputsChangedError()
+
+    # Prepared in its own autocommitted transaction, like every other entry point to the primary
+    prepare_connection(connection)
+    try:
+        with connection.begin() as transaction:
+            with time_phase('build_expected_data'):
+                cursor = connection.connection.cursor()
+                try:
+                    cursor.copy_expert(COPY_EXPECTED_DATA_TO_PRIMARY_QUERY, expected_data)
+                    add_phase_rows('build_expected_data', cursor.rowcount)
+                except psycopg2.Error as e:
+                    raise to_dbapi_error(connection, cursor, e)
+                finally:
+                    cursor.close()
+            return write_expected_data_to_output_table(connection, EXPECTED_DATA_TEMP_TABLE, processing_id_type, processing_id, check_inputs_unchanged)
+    except InputsChangedError:
+        increment('inputs_changed')
+        return process_processing_id_in_one_transaction(connection, processing_id_type, processing_id)
+
+
+def wait_for_replica(connection, replica_connection):
+    """ :return: Boolean, whether the replica replayed the primary's current WAL location within replica_max_wait_ms """
+    wal_location = connection.execute(CURRENT_WAL_LOCATION_QUERY_BY_WAL_NAMING[get_wal_naming(connection)]).scalar()
+    replayed_query = REPLAYED_WAL_LOCATION_QUERY_BY_WAL_NAMING[get_wal_naming(replica_connection)]
+    deadline = time.time() + processor_config.replica_max_wait_ms / 1000.0
+    while not replica_connection.execute(replayed_query, wal_location=wal_location).scalar():
+        if time.time() >= deadline:
+            return False
+        time.sleep(REPLICA_LAG_POLL_MS / 1000.0)
+    return True
+
+
+def get_wal_naming(connection):
+    return 'wal' if connection.dialect.server_version_info >= (10,) else 'xlog'
+
+
+def read_expected_data_from_replica(replica_connection, processing_id_type, processing_id):
+    """
+    Reads the expected data and the input fingerprint of the processing_id in one replica snapshot.
+
+    :return: 2 element tuple, (io.StringIO expected data in COPY text format, String input fingerprint)
+    """
+    dbapi_connection = replica_connection.connection
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(READ_ONLY_SNAPSHOT_TRANSACTION_QUERY)
+        expected_data = io.StringIO()
+        cursor.copy_expert(bind_processing_id(cursor, COPY_EXPECTED_DATA_FROM_REPLICA_QUERY_BY_PROCESSING_ID_TYPE[processing_id_type], processing_id),
+                           expected_data)
+        cursor.execute(bind_processing_id(cursor, REPLICA_INPUT_FINGERPRINT_QUERY_BY_PROCESSING_ID_TYPE[processing_id_type], processing_id))
+        input_fingerprint = cursor.fetchone()[0]
+    except psycopg2.Error as e:
+        raise to_dbapi_error(replica_connection, cursor, e)
+    finally:
+        # a connection the error closed can't be rolled back, and raising here would hide the error
+        if not replica_connection.invalidated and not dbapi_connection.closed:
+            dbapi_connection.rollback()
+        cursor.close()
+    expected_data.seek(0)
+    return (expected_data, input_fingerprint)
+
+
+def bind_processing_id(cursor, query, processing_id):
+    """ Replaces the $1 parameter of a query written for the prepared statements with the quoted processing_id """
+    return query.replace('$1', cursor.mogrify('%s', (str(processing_id),)).decode('utf-8'))
@@ -0,0 +1,104 @@
+import logging
+import random
+import time
+from collections import namedtuple
+
+from psycopg2 import errorcodes
+from sqlalchemy.exc import DBAPIError
+
+from helpers.log_helper import log_warning
+from helpers.metrics_helper import time_phase, increment
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Retryable classes of database errors
+LOCK_TIMEOUT_ERROR_CLASS = 'lock_timeout'
+DEADLOCK_ERROR_CLASS = 'deadlock'
+SERIALIZATION_FAILURE_ERROR_CLASS = 'serialization_failure'
+CONNECTION_ERROR_CLASS = 'connection'
+
+ERROR_CLASS_BY_PGCODE = {
+    errorcodes.LOCK_NOT_AVAILABLE : LOCK_TIMEOUT_ERROR_CLASS,
+    errorcodes.DEADLOCK_DETECTED : DEADLOCK_ERROR_CLASS,
+    errorcodes.SERIALIZATION_FAILURE : SERIALIZATION_FAILURE_ERROR_CLASS,
+    errorcodes.ADMIN_SHUTDOWN : CONNECTION_ERROR_CLASS,
+    errorcodes.CRASH_SHUTDOWN : CONNECTION_ERROR_CLASS,
+    errorcodes.CANNOT_CONNECT_NOW : CONNECTION_ERROR_CLASS
+}
+ERROR_CLASS_BY_PGCODE_CLASS = {
+    errorcodes.CLASS_CONNECTION_EXCEPTION : CONNECTION_ERROR_CLASS
+}
+
+# Retries of a class are spread over [0, min(max_delay_ms, base_delay_ms * 2 ** attempt)] ms (full jitter),
+# so writers that failed on each other's locks don't all come back at the same moment
+RetryPolicy = namedtuple('RetryPolicy', ['max_retries', 'base_delay_ms', 'max_delay_ms'])
+RETRY_POLICY_BY_ERROR_CLASS = {
+    LOCK_TIMEOUT_ERROR_CLASS : RetryPolicy(max_retries=3, base_delay_ms=200, max_delay_ms=2000),
+    DEADLOCK_ERROR_CLASS : RetryPolicy(max_retries=3, base_delay_ms=50, max_delay_ms=1000),
+    SERIALIZATION_FAILURE_ERROR_CLASS : RetryPolicy(max_retries=3, base_delay_ms=50, max_delay_ms=1000),
+    CONNECTION_ERROR_CLASS : RetryPolicy(max_retries=2, base_delay_ms=500, max_delay_ms=4000)
+}
+
+# Don't start another attempt unless it can wait out a lock timeout before the invocation times out
+MINIMUM_REMAINING_TIME_TO_RETRY_MS = 5000
+
+
+def classify_error(error):
+    """
+    Classifies a database error by the SQLSTATE psycopg2 reports for it.
+    Errors without a SQLSTATE are connection errors if SQLAlchemy invalidated the connection for them.
+
+    :return: String retryable error class, or None if the error should not be retried
+    """
+    if not isinstance(error, DBAPIError):
+        return None
+    pgcode = getattr(error.orig, 'pgcode', None)
+    if pgcode:
+        return ERROR_CLASS_BY_PGCODE.get(pgcode) or ERROR_CLASS_BY_PGCODE_CLASS.get(pgcode[:2])
+    if error.connection_invalidated:
+        return CONNECTION_ERROR_CLASS
+    return None
+
+
+def get_backoff_ms(retry_policy, retry_number):
+    """ :param retry_number: Int, 0 for the first retry """
+    return random.uniform(0, min(retry_policy.max_delay_ms, retry_policy.base_delay_ms * 2 ** retry_number))
+
+
+def call_with_retries(function, description, get_remaining_time_in_millis=None):
+    """
+    Calls function until it succeeds, retrying retryable database errors as allowed by the error class's RetryPolicy.
+    Each error class keeps its own count of retries.
+
+    :param description: String naming the unit of work in log messages
+    :param get_remaining_time_in_millis: lambda context's get_remaining_time_in_millis, None for no time limit
+    """
+    retries_by_error_class = {}
+    while True:
+        try:
+            return function()
+        except DBAPIError as e:
+            error_class = classify_error(e)
+            if error_class is None:
+                raise
+
+            retry_policy = RETRY_POLICY_BY_ERROR_CLASS[error_class]
+            retry_number = retries_by_error_class.get(error_class, 0)
+            if retry_number >= retry_policy.max_retries:
+                raise
+
+            backoff_ms = get_backoff_ms(retry_policy, retry_number)
+            if get_remaining_time_in_millis and get_remaining_time_in_millis() - backoff_ms < MINIMUM_REMAINING_TIME_TO_RETRY_MS:
+                log_warning('retry_skipped', description=description, error_class=error_class, backoff_ms=round(backoff_ms),
+                            reason='not_enough_time_left')
+                raise
+
+            retries_by_error_class[error_class] = retry_number + 1
+            log_warning('retrying', description=description, error_class=error_class, backoff_ms=round(backoff_ms),
+                        attempts_left=retry_policy.max_retries - retry_number)
+            increment('retries')
+            increment(error_class + '_retries')
+            with time_phase('backoff'):
+                time.sleep(backoff_ms / 1000.0)
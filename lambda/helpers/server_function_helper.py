@@ -0,0 +1,131 @@
+"""
+Server side processing engine: runs the whole process_processing_id pipeline as one PL/pgSQL function call.
+
+The function is defined in sql/snoopy_process_processing_id.sql and must be installed before use:
+    $ python -m helpers.server_function_helper install
+    $ python -m helpers.server_function_helper version
+
+Units of work are never skipped by the input fingerprint cache; the output table's triggers still drop the
+fingerprints of the flights written.
+"""
+import logging
+import os
+import re
+import threading
+
+from sqlalchemy import text
+
+from config import processor_config
+from helpers.database_helper import OUTPUT_SCHEMA, LOCK_TIMEOUT_MS
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Bump whenever sql/snoopy_process_processing_id.sql changes
+SERVER_FUNCTION_VERSION = 3
+SERVER_FUNCTION_SIGNATURE = OUTPUT_SCHEMA + '.process_processing_id(text, text, integer, text, text)'
+# Signatures of earlier versions, dropped on install so only one version is ever installed
+PREVIOUS_SERVER_FUNCTION_SIGNATURES = (OUTPUT_SCHEMA + '.process_processing_id(text, text, integer)',)
+SERVER_FUNCTION_COMMENT = 'kinesis-lambda-processor server function version {}'
+SERVER_FUNCTION_SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql', 'snoopy_process_processing_id.sql')
+
+SERVER_FUNCTION_VERSION_QUERY = "SELECT obj_description(to_regprocedure(:signature), 'pg_proc')"
+PROCESS_PROCESSING_ID_ON_SERVER_QUERY = text(
+    "SELECT deleted, inserted FROM " + OUTPUT_SCHEMA + ".process_processing_id(:processing_id_type, :processing_id, :lock_timeout_ms, "
+    ":locking_mode, :upsert_strategy)"
+)
+
+
+class ServerFunctionVersionError(Exception):
+    pass
+
+
+def get_installed_server_function_version(connection):
+    """ Returns the version of the installed server function, or None if it is not installed """
+    comment = connection.execute(text(SERVER_FUNCTION_VERSION_QUERY), signature=SERVER_FUNCTION_SIGNATURE).scalar()
+    match = re.match(SERVER_FUNCTION_COMMENT.format(r'(\d+)') + '$', comment or '')
+    return int(match.group(1)) if match else None
+
+
+def install_server_function(connection):
+    """
+    Installs the server function, replacing any other installed version, and records SERVER_FUNCTION_VERSION.
+    Needs CREATE privilege on the output schema, so it is run as a deployment step rather than by the lambda.
+    """
+    with open(SERVER_FUNCTION_SQL_PATH) as sql_file:
+        create_function_query = sql_file.read()
+
+    with connection.begin() as transaction:
+        # Run on the DBAPI cursor directly, as the function body contains % characters
+        cursor = connection.connection.cursor()
+        for signature in PREVIOUS_SERVER_FUNCTION_SIGNATURES + (SERVER_FUNCTION_SIGNATURE,):
+            cursor.execute("DROP FUNCTION IF EXISTS " + signature + ";")
+        cursor.execute(create_function_query)
+        cursor.execute("COMMENT ON FUNCTION " + SERVER_FUNCTION_SIGNATURE + " IS %(comment)s;",
+                       {'comment': SERVER_FUNCTION_COMMENT.format(SERVER_FUNCTION_VERSION)})
+        cursor.close()
+    invalidate_server_function_version()
+
+
+# Installed version is checked once per execution context and reused by warm invocations
+_server_function_version_checked = False
+_server_function_version_lock = threading.Lock()
+
+
+def check_server_function_version(connection):
+    global _server_function_version_checked
+    with _server_function_version_lock:
+        if not _server_function_version_checked:
+            installed_version = get_installed_server_function_version(connection)
+            if installed_version != SERVER_FUNCTION_VERSION:
+                raise ServerFunctionVersionError('Expected {0} version {1}, but found version {2}'.format(
+                    SERVER_FUNCTION_SIGNATURE, SERVER_FUNCTION_VERSION, installed_version))
+            _server_function_version_checked = True
+
+
+def invalidate_server_function_version():
+    global _server_function_version_checked
+    with _server_function_version_lock:
+        _server_function_version_checked = False
+
+
+def process_processing_id_on_server(connection, processing_id_type, processing_id):
+    """
+    Same pipeline as database_helper.process_processing_id, run by the server function in one round trip.
+    The call runs as a single autocommit statement, so no separate BEGIN/COMMIT is sent.
+    Flights are locked with processor_config.locking_mode and written with processor_config.upsert_strategy,
+    like the other engines, so writers of every engine exclude each other.
+
+    :return: 2 element tuple, (Int number of rows marked deleted, Int number of rows written)
+    """
+    check_server_function_version(connection)
+    result = connection.execution_options(isolation_level="AUTOCOMMIT").execute(
+        PROCESS_PROCESSING_ID_ON_SERVER_QUERY,
+        processing_id_type=processing_id_type, processing_id=str(processing_id), lock_timeout_ms=LOCK_TIMEOUT_MS,
+        locking_mode=processor_config.locking_mode, upsert_strategy=processor_config.upsert_strategy
+    ).fetchone()
+    return (result['deleted'], result['inserted'])
+
+
+def main():
+    import argparse
+    from sqlalchemy import create_engine
+    from config import db_config
+
+    parser = argparse.ArgumentParser(description='Installs or inspects the ' + SERVER_FUNCTION_SIGNATURE + ' server function')
+    parser.add_argument('command', choices=['install', 'version'])
+    parser.add_argument('--test', action='store_true', help='use the test database endpoint')
+    args = parser.parse_args()
+
+    db_endpoint = db_config.db_test_endpoint if args.test else db_config.db_endpoint
+    db_postgres_string = "postgres://" + db_config.db_username + ":" + db_config.db_password + "@" + db_endpoint + "/" + db_config.db_name
+    connection = create_engine(db_postgres_string).connect()
+
+    if args.command == 'install':
+        install_server_function(connection)
+    print('Installed version: {0}, expected version: {1}'.format(get_installed_server_function_version(connection), SERVER_FUNCTION_VERSION))
+
+
+if __name__ == '__main__':
+    main()
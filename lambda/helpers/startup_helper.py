@@ -0,0 +1,131 @@
+"""
+Cold start report: how long each module took to import while the lambda's execution context was initialized,
+how long the init phase spent opening its first db connection, and how long the whole init phase took.
+
+Enabled in the lambda with import_time_report=true, which logs the report once per execution context.
+To check a change's effect on cold start locally or in CI, from the lambda/ directory:
+    $ python -m helpers.startup_helper --budget-ms 1500 --connect-budget-ms 500
+which imports the handler module under the timer and exits non-zero when the init phase is over budget. The first db
+connection depends on the network and the db rather than on the code, so it has its own budget and --budget-ms covers
+the rest of the init phase.
+
+Only the standard library may be imported here, so the report can be started before everything else.
+"""
+import builtins
+import importlib.util
+import logging
+import sys
+import time
+
+# Logger settings
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+REPORTED_MODULE_COUNT = 25
+# Module global of the handler module holding how long its first db connection took, in seconds
+CONNECT_DURATION_GLOBAL = 'initial_connection_duration'
+
+
+class ImportTimer(object):
+    """
+    Times the import statements run while started, by wrapping builtins.__import__.
+    Only import statements that load new modules are recorded; a module's self time excludes the imports it triggered.
+    """
+
+    def __init__(self):
+        self.start_time = None
+        self.init_duration = None
+        self.connect_duration = 0.0
+        self.cumulative_seconds_by_module = {}
+        self.self_seconds_by_module = {}
+        self._child_seconds_stack = []
+        self._active_names = []
+        self._original_import = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        builtins.__import__ = self._original_import
+        self.init_duration = time.perf_counter() - self.start_time
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        loaded_module_count = len(sys.modules)
+        self._active_names.append(resolve_name(name, globals, level) if level else name)
+        self._child_seconds_stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            child_seconds = self._child_seconds_stack.pop()
+            module = self._active_names.pop()
+            if len(sys.modules) > loaded_module_count:
+                # a package importing its own submodules by the package name is only counted once
+                if module not in self._active_names:
+                    self.cumulative_seconds_by_module[module] = self.cumulative_seconds_by_module.get(module, 0.0) + elapsed
+                self.self_seconds_by_module[module] = self.self_seconds_by_module.get(module, 0.0) + elapsed - child_seconds
+                if self._child_seconds_stack:
+                    self._child_seconds_stack[-1] += elapsed
+
+    def get_report(self, module_count=REPORTED_MODULE_COUNT):
+        """ :return: String, the init phase duration and the module_count slowest imports by cumulative time """
+        lines = ['Init phase: {0:.1f} ms, {1:.1f} ms importing, {2:.1f} ms connecting to the db'.format(
+            self.init_duration * 1000, sum(self.self_seconds_by_module.values()) * 1000, self.connect_duration * 1000)]
+        lines.append('{:>10} {:>10}  {}'.format('cumulative', 'self', 'module'))
+        slowest_modules = sorted(self.cumulative_seconds_by_module, key=self.cumulative_seconds_by_module.get, reverse=True)
+        for module in slowest_modules[:module_count]:
+            lines.append('{0:>10.1f} {1:>10.1f}  {2}'.format(
+                self.cumulative_seconds_by_module[module] * 1000, self.self_seconds_by_module[module] * 1000, module))
+        return '\n'.join(lines)
+
+
+def get_budget_overruns(import_timer, budget_ms=None, connect_budget_ms=None):
+    """ :return: List(String), one line per budget the init phase went over; the budget_ms excludes the first db connection """
+    overruns = []
+    init_ms = (import_timer.init_duration - import_timer.connect_duration) * 1000
+    if budget_ms is not None and init_ms > budget_ms:
+        overruns.append('Init phase without the db connection took {0:.1f} ms, over budget of {1:.1f} ms'.format(init_ms, budget_ms))
+    connect_ms = import_timer.connect_duration * 1000
+    if connect_budget_ms is not None and connect_ms > connect_budget_ms:
+        overruns.append('First db connection took {0:.1f} ms, over budget of {1:.1f} ms'.format(connect_ms, connect_budget_ms))
+    return overruns
+
+
+def resolve_name(name, globals, level):
+    """ Absolute name of a relative import made from the module whose globals are given """
+    package = (globals or {}).get('__package__') or ''
+    try:
+        return importlib.util.resolve_name('.' * level + name, package)
+    except ValueError:
+        return '.' * level + name
+
+
+def main():
+    import argparse
+    import runpy
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='KinesisLambdaProcessor', help='module whose import is reported')
+    parser.add_argument('--budget-ms', type=float, help='exit non-zero when the init phase, without the first db connection, takes longer')
+    parser.add_argument('--connect-budget-ms', type=float, help='exit non-zero when the first db connection takes longer')
+    parser.add_argument('--modules', type=int, default=REPORTED_MODULE_COUNT, help='number of slowest imports to list')
+    args = parser.parse_args()
+
+    import_timer = ImportTimer()
+    import_timer.start()
+    module_globals = runpy.run_module(args.module, run_name=args.module)
+    import_timer.stop()
+    import_timer.connect_duration = module_globals.get(CONNECT_DURATION_GLOBAL, 0.0)
+
+    print(import_timer.get_report(args.modules))
+    overruns = get_budget_overruns(import_timer, args.budget_ms, args.connect_budget_ms)
+    if overruns:
+        print('\n'.join(overruns))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
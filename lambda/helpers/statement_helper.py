@@ -0,0 +1,114 @@
+"""
+Statement accounting for engines made by database_helper.create_new_engine.
+
+Every statement run through the engine's cursors is counted, with its round trip time and the rows it returned
+or changed, into the StatementStats collected by count_statements on the same thread, grouped by fingerprint:
+the statement text with literals and parameters replaced by '?'. Totals are also added to the unit of work's
+phase metrics, if one is being recorded.
+
+Statements the psycopg2 engine runs directly on the DBAPI cursor bypass SQLAlchemy's events and are not counted,
+nor are the dialect's special-case executions that have no execution context, like its checks on first connect.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from helpers.metrics_helper import get_current_phase_metrics, add_phase_rows, increment
+
+FINGERPRINT_CACHE_SIZE = 1000
+
+FINGERPRINT_REPLACEMENTS = (
+    (re.compile(r'--[^\n]*'), ''),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\?(?:\s*,\s*\?)+'), '?, ...'),
+    (re.compile(r'\s+'), ' ')
+)
+STATEMENT_SEPARATOR_PATTERN = re.compile(r";\s*(?=\S)")
+
+# Statements being counted by the current thread
+_current = threading.local()
+_fingerprint_cache = {}
+
+
+class StatementStats(object):
+
+    def __init__(self):
+        self.statements = 0
+        self.round_trips = 0
+        self.round_trip_ms = 0.0
+        self.rows = 0
+        # {String fingerprint: [Int round trips, Float round trip ms, Int rows]}
+        self.stats_by_fingerprint = OrderedDict()
+
+    def add(self, fingerprint, statements, round_trip_ms, rows):
+        self.statements += statements
+        self.round_trips += 1
+        self.round_trip_ms += round_trip_ms
+        self.rows += rows
+        fingerprint_stats = self.stats_by_fingerprint.setdefault(fingerprint, [0, 0.0, 0])
+        fingerprint_stats[0] += 1
+        fingerprint_stats[1] += round_trip_ms
+        fingerprint_stats[2] += rows
+
+
+def get_statement_fingerprint(statement):
+    """ :return: 2 element tuple, (String fingerprint, Int number of statements sent in this round trip) """
+    cached = _fingerprint_cache.get(statement)
+    if cached is None:
+        fingerprint = statement
+        for pattern, replacement in FINGERPRINT_REPLACEMENTS:
+            fingerprint = pattern.sub(replacement, fingerprint)
+        fingerprint = fingerprint.strip().rstrip(';').strip()
+        # Literals are already replaced, so every remaining ';' separates two statements
+        cached = (fingerprint, len(STATEMENT_SEPARATOR_PATTERN.findall(fingerprint)) + 1)
+        if len(_fingerprint_cache) >= FINGERPRINT_CACHE_SIZE:
+            _fingerprint_cache.clear()
+        _fingerprint_cache[statement] = cached
+    return cached
+
+
+@contextmanager
+def count_statements():
+    """ Collects the statements run by this thread until exited; nested collectors each see every statement """
+    statement_stats = StatementStats()
+    outer_collectors = getattr(_current, 'collectors', ())
+    _current.collectors = outer_collectors + (statement_stats,)
+    try:
+        yield statement_stats
+    finally:
+        _current.collectors = outer_collectors
+
+
+def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    # Kept on the execution context, so a statement that fails, and never reaches after_cursor_execute,
+    # leaves nothing behind on the connection
+    if context is not None:
+        context.statement_helper_start_time = time.perf_counter()
+
+
+def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+    round_trip_ms = (time.perf_counter() - context.statement_helper_start_time) * 1000
+    fingerprint, statements = get_statement_fingerprint(statement)
+    rows = max(cursor.rowcount, 0)
+
+    for statement_stats in getattr(_current, 'collectors', ()):
+        statement_stats.add(fingerprint, statements, round_trip_ms, rows)
+    phase_metrics = get_current_phase_metrics()
+    if phase_metrics is not None:
+        phase_metrics.add_duration('round_trip', round_trip_ms)
+        add_phase_rows('statement', rows)
+        increment('statements', statements)
+        increment('round_trips')
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
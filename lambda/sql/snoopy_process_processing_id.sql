@@ -0,0 +1,173 @@
+-- Server side version of helpers/database_helper.process_processing_id; one call runs the whole pipeline.
+-- Installed and upgraded through helpers/server_function_helper.py, which records SERVER_FUNCTION_VERSION
+-- in the function's comment. Bump that version whenever this file changes.
+CREATE FUNCTION snoopy.process_processing_id(
+    p_processing_id_type text,
+    p_processing_id text,
+    p_lock_timeout_ms integer DEFAULT 3000,
+    p_locking_mode text DEFAULT 'row_lock',
+    p_upsert_strategy text DEFAULT 'delete_insert',
+    OUT deleted bigint,
+    OUT inserted bigint
+)
+LANGUAGE plpgsql AS $function$
+DECLARE
+    v_condition text;
+    v_relevant_id_maps text;
+    v_conflict_condition text;
+    v_flight_ids text[];
+    v_perform_deletions boolean;
+    v_row_count bigint;
+BEGIN
+    deleted := 0;
+    inserted := 0;
+    IF p_locking_mode NOT IN ('row_lock', 'advisory') THEN
+        RAISE EXCEPTION 'Unknown locking_mode: %', p_locking_mode;
+    END IF;
+    IF p_upsert_strategy NOT IN ('delete_insert', 'on_conflict', 'diff') THEN
+        RAISE EXCEPTION 'Unknown upsert_strategy: %', p_upsert_strategy;
+    END IF;
+    PERFORM set_config('lock_timeout', p_lock_timeout_ms::text, true);
+
+    IF p_processing_id_type = 'li_code' THEN
+        -- repeats the flight_id condition, so the lookup can use the maps_flight_id_idx expression index;
+        -- see database_helper.CONDITION_STRING_BY_PROCESSING_ID_TYPE
+        v_condition := 'substring(m.li_code, 4) = substring($1, 4) AND m.li_code = $1';
+        v_relevant_id_maps := '(SELECT vendor_id, MIN(date_start) as min_date, MAX(date_end) as max_date FROM vendor_ids.maps WHERE substring(li_code, 4) = substring($1, 4) AND li_code = $1 GROUP BY 1)';
+        v_conflict_condition := 'tups.li_code = $1';
+        v_flight_ids := ARRAY[substring(p_processing_id, 4)];
+        v_perform_deletions := TRUE;
+    ELSIF p_processing_id_type = 'flight_id' THEN
+        v_condition := 'substring(m.li_code, 4) = $1';
+        v_relevant_id_maps := '(SELECT vendor_id, MIN(date_start) as min_date, MAX(date_end) as max_date FROM vendor_ids.maps WHERE substring(li_code, 4) = $1 GROUP BY 1)';
+        v_conflict_condition := 'substring(tups.li_code, 4) = $1';
+        v_flight_ids := ARRAY[p_processing_id];
+        v_perform_deletions := TRUE;
+    ELSIF p_processing_id_type = 'import_id' THEN
+        v_condition := 'im.import_record_id = $1::int';
+        v_relevant_id_maps := '(SELECT placement_id::text as vendor_id, MIN(date) as min_date, MAX(date) as max_date FROM double_click.raw_delivery WHERE import_record_id = $1::int GROUP BY 1)';
+        v_conflict_condition := 'rd2.import_record_id = $1::int';
+        v_perform_deletions := FALSE;
+    ELSE
+        RAISE EXCEPTION 'Unknown processing_id_type: %', p_processing_id_type;
+    END IF;
+
+    -- Expected data; see BUILD_EXPECTED_DATA_TEMP_TABLE_BASE_QUERY and INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_BASE_QUERY
+    DROP TABLE IF EXISTS pg_temp.expected_temp_table;
+    EXECUTE format($query$
+        CREATE TEMP TABLE expected_temp_table ON COMMIT DROP AS
+        SELECT rd.date, substring(m.li_code, 4) as flight_id, m.creative_rtb_id::text as creative_id, SUM(rd.impressions) as impressions, SUM(rd.clicks) as clicks, 'doubleclick'::TEXT as provider,
+        im.report_time_zone as time_zone, now() as updated_at, FALSE as is_deleted
+        FROM double_click.raw_delivery rd
+        JOIN vendor_ids.maps m ON m.vendor_id = rd.placement_id::text AND rd.date BETWEEN m.date_start AND m.date_end
+        JOIN double_click.import_metadata im USING (import_record_id)
+        LEFT JOIN vendor_ids.alignment_conflicts c ON m.li_code = c.li_code AND (rd.date BETWEEN c.date_start AND c.date_end)
+        WHERE %s AND m.is_deleted = false AND c.li_code IS NULL
+        group by rd.date, m.li_code, m.creative_rtb_id, im.report_time_zone
+    $query$, v_condition) USING p_processing_id;
+
+    EXECUTE format($query$
+        INSERT INTO expected_temp_table (
+            SELECT rd2.date, substring(tups.li_code, 4) as flight_id, NULL as creative_id, SUM(rd2.impressions) as impressions,
+                SUM(rd2.clicks) as clicks, 'doubleclick'::TEXT as provider, im.report_time_zone as time_zone,
+                now() as updated_at, FALSE as is_deleted
+            FROM double_click.raw_delivery rd2
+            JOIN (
+                SELECT m.vendor_id, c.report_date AS date, m.li_code, m.vendor FROM static.calendar c
+                JOIN vendor_ids.maps m ON c.report_date BETWEEN m.date_start AND m.date_end
+                JOIN %s i on i.vendor_id =  m.vendor_id AND m.date_start <= max_date AND m.date_end >= min_date
+                JOIN vendor_ids.alignment_conflicts cf on m.li_code = cf.li_code
+                    AND (c.report_date BETWEEN cf.date_start AND cf.date_end)
+                WHERE m.is_deleted = FALSE AND cf.li_code = cf.li_code_2
+                AND cf.li_code NOT IN (SELECT c2.li_code FROM vendor_ids.alignment_conflicts c2 WHERE c2.li_code != c2.li_code_2)
+                GROUP BY 1, 2, 3, 4
+                ) tups ON rd2.placement_id::text = tups.vendor_id AND rd2.date = tups.date
+            JOIN double_click.import_metadata im ON rd2.import_record_id = im.import_record_id
+            WHERE %s
+            GROUP BY rd2.date, tups.li_code, im.report_time_zone
+        )
+    $query$, v_relevant_id_maps, v_conflict_condition) USING p_processing_id;
+
+    IF NOT v_perform_deletions THEN
+        SELECT array_agg(DISTINCT flight_id) INTO v_flight_ids FROM expected_temp_table;
+        IF v_flight_ids IS NULL THEN
+            -- processing import_id, but no data in the temp table
+            RETURN;
+        END IF;
+    END IF;
+
+    -- Lock flights, the same way as the configured locking_mode of the other engines, so every engine's writers exclude
+    -- each other; lock timeout is raised to the caller, which retries. See database_helper.LOCK_FUNCTION_BY_LOCKING_MODE
+    IF p_locking_mode = 'advisory' THEN
+        PERFORM pg_advisory_xact_lock(5001, flight_id_hash)
+        FROM (SELECT DISTINCT hashtext(flight_id) AS flight_id_hash FROM unnest(v_flight_ids) flight_id ORDER BY 1) flight_id_hashes;
+    ELSE
+        PERFORM 1 FROM snoopy.delivery_by_flight_creative_day WHERE flight_id = ANY(v_flight_ids) FOR UPDATE;
+    END IF;
+
+    IF v_perform_deletions THEN
+        -- Mark is_deleted for the flight's Doubleclick data that is not in the temp table (all of it if the temp table is empty);
+        -- the diff strategy doesn't write rows already marked deleted again
+        UPDATE snoopy.delivery_by_flight_creative_day o SET is_deleted = TRUE, updated_at = current_timestamp
+        WHERE o.flight_id = v_flight_ids[1] AND o.provider = 'doubleclick'
+            AND (p_upsert_strategy != 'diff' OR o.is_deleted IS NOT TRUE)
+            AND NOT EXISTS (
+                SELECT 1 FROM expected_temp_table e
+                WHERE o.flight_id = e.flight_id AND o.creative_id IS NOT DISTINCT FROM e.creative_id
+                    AND o.date = e.date AND o.time_zone = e.time_zone
+            );
+        GET DIAGNOSTICS deleted = ROW_COUNT;
+    END IF;
+
+    -- Do updates / insertions together; see database_helper.UPSERT_FUNCTION_BY_STRATEGY
+    IF p_upsert_strategy = 'delete_insert' THEN
+        DELETE FROM snoopy.delivery_by_flight_creative_day o
+        USING expected_temp_table e
+        WHERE o.flight_id = e.flight_id AND o.creative_id IS NOT DISTINCT FROM e.creative_id
+            AND o.date = e.date AND o.time_zone = e.time_zone AND o.provider = 'doubleclick';
+
+        INSERT INTO snoopy.delivery_by_flight_creative_day (date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted)
+        SELECT date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted FROM expected_temp_table;
+        GET DIAGNOSTICS inserted = ROW_COUNT;
+    ELSIF p_upsert_strategy = 'on_conflict' THEN
+        -- Once per partial unique index; rows whose values are unchanged are left as they are
+        INSERT INTO snoopy.delivery_by_flight_creative_day AS o (date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted)
+        SELECT date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted FROM expected_temp_table
+        WHERE creative_id IS NOT NULL
+        ON CONFLICT (date, flight_id, time_zone, provider, creative_id) WHERE creative_id IS NOT NULL
+        DO UPDATE SET impressions = excluded.impressions, clicks = excluded.clicks, is_deleted = excluded.is_deleted, updated_at = excluded.updated_at
+        WHERE o.impressions IS DISTINCT FROM excluded.impressions OR o.clicks IS DISTINCT FROM excluded.clicks
+            OR o.is_deleted IS DISTINCT FROM excluded.is_deleted;
+        GET DIAGNOSTICS inserted = ROW_COUNT;
+
+        INSERT INTO snoopy.delivery_by_flight_creative_day AS o (date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted)
+        SELECT date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted FROM expected_temp_table
+        WHERE creative_id IS NULL
+        ON CONFLICT (date, flight_id, time_zone, provider) WHERE creative_id IS NULL
+        DO UPDATE SET impressions = excluded.impressions, clicks = excluded.clicks, is_deleted = excluded.is_deleted, updated_at = excluded.updated_at
+        WHERE o.impressions IS DISTINCT FROM excluded.impressions OR o.clicks IS DISTINCT FROM excluded.clicks
+            OR o.is_deleted IS DISTINCT FROM excluded.is_deleted;
+        GET DIAGNOSTICS v_row_count = ROW_COUNT;
+        inserted := inserted + v_row_count;
+    ELSE
+        -- diff: only rows whose values changed are updated, and only new rows are inserted
+        UPDATE snoopy.delivery_by_flight_creative_day o
+        SET impressions = e.impressions, clicks = e.clicks, is_deleted = e.is_deleted, updated_at = e.updated_at
+        FROM expected_temp_table e
+        WHERE o.flight_id = e.flight_id AND o.creative_id IS NOT DISTINCT FROM e.creative_id
+            AND o.date = e.date AND o.time_zone = e.time_zone AND o.provider = 'doubleclick'
+            AND (o.impressions IS DISTINCT FROM e.impressions OR o.clicks IS DISTINCT FROM e.clicks OR o.is_deleted IS DISTINCT FROM e.is_deleted);
+        GET DIAGNOSTICS inserted = ROW_COUNT;
+
+        INSERT INTO snoopy.delivery_by_flight_creative_day (date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted)
+        SELECT date, flight_id, creative_id, impressions, clicks, provider, time_zone, updated_at, is_deleted FROM expected_temp_table e
+        WHERE NOT EXISTS (
+            SELECT 1 FROM snoopy.delivery_by_flight_creative_day o
+            WHERE o.flight_id = e.flight_id AND o.creative_id IS NOT DISTINCT FROM e.creative_id
+                AND o.date = e.date AND o.time_zone = e.time_zone AND o.provider = 'doubleclick'
+        );
+        GET DIAGNOSTICS v_row_count = ROW_COUNT;
+        inserted := inserted + v_row_count;
+    END IF;
+END
+$function$;
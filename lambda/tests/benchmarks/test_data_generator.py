@@ -0,0 +1,69 @@
+import datetime
+import pytest
+
+from helpers import database_helper as h
+from benchmarks import data_generator as g
+from benchmarks.benchmark_helper import OUTPUT_TABLE_FULL_NAME
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_and_teardown_for_entire_test_suite(engine):
+    yield
+    # Teardown after ending entire test suite
+    engine.execute("TRUNCATE {};".format(", ".join(g.UPSTREAM_TABLES + (OUTPUT_TABLE_FULL_NAME,))))
+
+
+@pytest.fixture(scope="function")
+def connection(engine):
+    with engine.connect() as connection:
+        yield connection
+
+
+#################
+##### Tests #####
+#################
+
+def test_generate_flights_is_deterministic_from_seed():
+    assert g.generate_flights(flights=50, seed=1) == g.generate_flights(flights=50, seed=1)
+    assert g.generate_flights(flights=50, seed=1) != g.generate_flights(flights=50, seed=2)
+    assert list(g.generate_raw_delivery_lines(g.generate_flights(flights=5, seed=1), seed=1)) == \
+        list(g.generate_raw_delivery_lines(g.generate_flights(flights=5, seed=1), seed=1))
+
+
+def test_generate_flights_within_bounds():
+    flights = g.generate_flights(flights=200, days=30, max_creatives=10, conflict_share=0.5, seed=1)
+    last_date = g.DEFAULT_START_DATE + datetime.timedelta(days=29)
+
+    assert [flight.flight_id for flight in flights] == list(range(g.FIRST_FLIGHT_ID, g.FIRST_FLIGHT_ID + 200))
+    assert all(1 <= len(flight.placement_id_by_creative_id) <= 10 for flight in flights)
+    assert all(g.DEFAULT_START_DATE <= flight.date_start <= flight.date_end <= last_date for flight in flights)
+    assert any(flight.has_conflict for flight in flights)
+    assert all(len(set(flight.placement_id_by_creative_id.values())) == len(flight.placement_id_by_creative_id) - flight.has_conflict
+               for flight in flights)
+
+
+def test_line_stream_reads_lines_in_chunks():
+    stream = g.LineStream(['ab\n', 'cde\n', 'f\n'])
+
+    assert [stream.read(4), stream.read(4), stream.read(4)] == ['ab\nc', 'de\nf', '\n']
+    assert stream.read(4) == ''
+
+
+def test_generate_upstream_table_data_loads_processable_data(connection):
+    rows_by_table = g.generate_upstream_table_data(connection, flights=20, days=30, conflict_share=0.5, seed=1)
+    flights = g.generate_flights(flights=20, days=30, conflict_share=0.5, seed=1)
+
+    assert rows_by_table['vendor_ids.maps'] == sum(len(flight.placement_id_by_creative_id) for flight in flights)
+    assert rows_by_table['double_click.raw_delivery'] == sum(
+        len(set(flight.placement_id_by_creative_id.values())) * ((flight.date_end - flight.date_start).days + 1) for flight in flights)
+    assert rows_by_table['vendor_ids.alignment_conflicts'] == sum(flight.has_conflict for flight in flights)
+
+    connection.execute("TRUNCATE {};".format(OUTPUT_TABLE_FULL_NAME))
+    conflicted_flight = next(flight for flight in flights if flight.has_conflict)
+    deleted, inserted = h.process_processing_id(connection, 'flight_id', str(conflicted_flight.flight_id))
+    assert inserted
+    assert any(row['creative_id'] is None for row in inserted)
@@ -0,0 +1,19 @@
+import pytest
+
+from config import db_config
+from helpers import database_helper as h
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+def get_db_postgres_string(db_endpoint):
+    return "postgres://" + db_config.db_username + ":" + db_config.db_password + "@" + db_endpoint + "/" + db_config.db_name
+
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = h.create_new_engine(get_db_postgres_string(db_config.db_test_endpoint), 5, 10)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,150 @@
+import base64
+import datetime
+import json
+import threading
+import time
+
+from helpers import batch_helper as b
+
+#################
+##### Tests #####
+#################
+
+def test_decode_record_with_date_window_returns_date_window_import_record_id_or_none():
+    date_window_record = build_kinesis_record('li_code', 'LI-123456', {'date_start': '2018-05-01', 'date_end': '2018-05-03'})
+    import_record = build_kinesis_record('flight_id', '123456', {'import_record_id': 1468224})
+
+    assert b.decode_record_with_date_window(date_window_record) == \
+        (('li_code', 'LI-123456'), b.DateWindow(datetime.date(2018, 5, 1), datetime.date(2018, 5, 3)))
+    assert b.decode_record_with_date_window(import_record) == (('flight_id', '123456'), '1468224')
+    assert b.decode_record_with_date_window(build_kinesis_record('flight_id', '123456')) == (('flight_id', '123456'), None)
+
+
+def test_group_date_window_specs_is_none_when_any_covered_pair_has_no_window():
+    date_window = b.DateWindow(datetime.date(2018, 5, 1), datetime.date(2018, 5, 3))
+    processing_id_pairs = [('li_code', 'LI-123456'), ('flight_id', '123456'), ('li_code', 'LI-7891011'), ('li_code', 'LI-7891011')]
+
+    assert b.group_date_window_specs(b.group_processing_ids(processing_id_pairs), [date_window, '1', date_window, None]) == {
+        ('flight_id', '123456'): ['1', date_window],
+        ('li_code', 'LI-7891011'): None
+    }
+
+
+def test_group_processing_ids_with_duplicates_keeps_first_arrival_order():
+    processing_id_pairs = [
+        ('import_id', '1'),
+        ('li_code', 'LI-123456'),
+        ('import_id', '1'),
+        ('li_code', 'LI-7891011'),
+        ('li_code', 'LI-123456')
+    ]
+
+    assert list(b.group_processing_ids(processing_id_pairs)) == [
+        ('import_id', '1'),
+        ('li_code', 'LI-123456'),
+        ('li_code', 'LI-7891011')
+    ]
+
+
+def test_group_processing_ids_with_flight_id_covers_li_code_of_same_flight():
+    processing_id_pairs = [
+        ('li_code', 'LI-123456'),
+        ('li_code', 'LI-7891011'),
+        ('flight_id', '123456')
+    ]
+
+    assert list(b.group_processing_ids(processing_id_pairs)) == [
+        ('li_code', 'LI-7891011'),
+        ('flight_id', '123456')
+    ]
+
+
+def test_group_processing_ids_with_import_id_keeps_li_code_and_flight_id():
+    processing_id_pairs = [
+        ('import_id', '123456'),
+        ('li_code', 'LI-123456'),
+        ('flight_id', '7891011')
+    ]
+
+    assert list(b.group_processing_ids(processing_id_pairs)) == processing_id_pairs
+
+
+def test_group_processing_ids_maps_each_unit_to_every_pair_it_covers():
+    processing_id_pairs = [
+        ('li_code', 'LI-123456'),
+        ('import_id', '1'),
+        ('flight_id', '123456'),
+        ('import_id', '1'),
+        ('li_code', 'LI-123456')
+    ]
+
+    assert list(b.group_processing_ids(processing_id_pairs).items()) == [
+        (('import_id', '1'), [1, 3]),
+        (('flight_id', '123456'), [2, 0, 4])
+    ]
+
+
+def test_group_processing_ids_with_empty_batch_returns_empty():
+    assert b.group_processing_ids([]) == {}
+
+
+def test_group_by_flight_affinity_groups_li_codes_and_flight_ids_of_same_flight():
+    processing_id_pairs = [
+        ('li_code', 'LI-123456'),
+        ('import_id', '1'),
+        ('li_code', 'LI-7891011'),
+        ('flight_id', '123456')
+    ]
+
+    assert b.group_by_flight_affinity(processing_id_pairs) == (
+        [[('li_code', 'LI-123456'), ('flight_id', '123456')], [('li_code', 'LI-7891011')]],
+        [('import_id', '1')]
+    )
+
+
+def test_process_processing_ids_with_failure_processes_rest_and_returns_error():
+    processed = []
+    error = ValueError('bad record')
+
+    def process_function(processing_id_type, processing_id):
+        processed.append((processing_id_type, processing_id))
+        if processing_id == 'LI-123456':
+            raise error
+
+    results = b.process_processing_ids([('li_code', 'LI-123456'), ('li_code', 'LI-7891011')], process_function)
+
+    assert processed == [('li_code', 'LI-123456'), ('li_code', 'LI-7891011')]
+    assert list(results.items()) == [(('li_code', 'LI-123456'), error), (('li_code', 'LI-7891011'), None)]
+
+
+def test_process_processing_ids_concurrently_never_overlaps_same_flight_or_import_id():
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def process_function(processing_id_type, processing_id):
+        key = 'import' if processing_id_type == 'import_id' else processing_id[-6:]
+        with lock:
+            if key in running or 'import' in running or (key == 'import' and running):
+                overlaps.append((processing_id_type, processing_id))
+            running.append(key)
+        time.sleep(0.01)
+        with lock:
+            running.remove(key)
+
+    processing_id_pairs = [('li_code', 'LI-' + str(flight_id)) for flight_id in range(100000, 100008)] + \
+        [('flight_id', str(flight_id)) for flight_id in range(100000, 100008)] + \
+        [('import_id', '1'), ('import_id', '2')]
+    results = b.process_processing_ids(processing_id_pairs, process_function, max_workers=4)
+
+    assert overlaps == []
+    assert list(results) == processing_id_pairs
+    assert not any(results.values())
+
+
+##########################
+##### Helper Methods #####
+##########################
+def build_kinesis_record(processing_id_type, processing_id, extra_fields=None):
+    payload = json.dumps(dict({b.PROCESSING_ID_TYPE_JSON_HEADER: processing_id_type, b.PROCESSING_ID_JSON_HEADER: processing_id}, **(extra_fields or {})))
+    return {'kinesis': {'data': base64.b64encode(payload.encode("utf-8")).decode("utf-8")}}
@@ -4,41 +4,69 @@ import datetime
 from operator import itemgetter
 
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import select, MetaData, Table
+from sqlalchemy import event, select, text, MetaData, Table
 
-from config import db_config
+from config import processor_config
 from helpers import database_helper as h
+from helpers import metrics_helper as m
+from helpers import statement_helper
 
 OUTPUT_TABLE_FULL_NAME = h.OUTPUT_SCHEMA + "." + h.OUTPUT_TABLE
+# Statements one process_processing_id call may run once its session is set up and the output table reflected
+MAXIMUM_STATEMENTS_PER_CALL_BY_PROCESSING_ID_TYPE = {
+    'li_code' : 7,
+    'flight_id' : 7,
+    'import_id' : 6
+}
 
 ###########################
 ##### Pytest Fixtures #####
 ###########################
 
 
-@pytest.fixture(scope="module")
-def engine():
-    db_endpoint = db_config.db_test_endpoint
-    db_username = db_config.db_username
-    db_password = db_config.db_password
-    db_name = db_config.db_name
-    db_postgres_string = "postgres://" + db_username + ":" + db_password + "@" + db_endpoint + "/" + db_name
-    return h.create_new_engine(db_postgres_string, 5, 10)
-
-
 @pytest.fixture(scope="module", autouse=True)
 def setup_and_teardown_for_entire_test_suite(engine):
     # Setup before starting entire test suite
-    reset_upstream_tables(engine.connect())
-    truncate_output_table(engine.connect())
+    with engine.connect() as connection:
+        reset_upstream_tables(connection)
+        truncate_output_table(connection)
     yield
     # Teardown after ending entire test suite
-    truncate_all_tables(engine.connect())
+    with engine.connect() as connection:
+        truncate_all_tables(connection)
 
 
 @pytest.fixture(scope="function")
 def connection(engine):
-    return engine.connect()
+    with engine.connect() as connection:
+        yield connection
+
+
+@pytest.fixture(scope="function")
+def on_conflict_upsert_strategy(monkeypatch):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', h.ON_CONFLICT_UPSERT_STRATEGY)
+
+
+@pytest.fixture(scope="function")
+def diff_upsert_strategy(monkeypatch):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', h.DIFF_UPSERT_STRATEGY)
+
+
+@pytest.fixture(scope="function")
+def two_phase_transaction_mode(monkeypatch):
+    monkeypatch.setattr(processor_config, 'transaction_mode', h.TWO_PHASE_TRANSACTION_MODE)
+
+
+@pytest.fixture(scope="function")
+def advisory_locking_mode(monkeypatch):
+    monkeypatch.setattr(processor_config, 'locking_mode', h.ADVISORY_LOCKING_MODE)
+
+
+@pytest.fixture(scope="function")
+def input_fingerprint_cache(connection, monkeypatch):
+    monkeypatch.setattr(processor_config, 'input_fingerprint_cache', True)
+    yield
+    connection.execute("TRUNCATE {};".format(h.INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME))
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -335,6 +363,15 @@ def test_generate_expected_data_temp_table_processing_id_creates_correct_temp_ta
         assert {tuple(rowproxy.values()) for rowproxy in connection.execute(s).fetchall()} == get_standard_output_data()
 
 
+def test_build_temp_table_matches_reflected_temp_table(connection):
+    with connection.begin() as transaction:
+        temp_table = h.generate_expected_data_temp_table(connection, 'import_id', '1')
+        reflected_temp_table = Table(temp_table.name, MetaData(), autoload=True, autoload_with=connection)
+
+        assert [(column.name, column.type.compile(dialect=connection.dialect)) for column in temp_table.columns] == \
+               [(column.name, column.type.compile(dialect=connection.dialect)) for column in reflected_temp_table.columns]
+
+
 def test_calculate_diffs_and_writes_to_output_table_temp_table_and_do_perform_deletions_returns_correct_diffs(connection):
     insert_standard_output_data(connection)
     with connection.begin() as transaction:
@@ -371,20 +408,463 @@ def test_calculate_diffs_and_writes_to_output_table_temp_table_and_do_perform_de
         assert inserted == expected_inserted
 
 
-def test_set_lock_timeout_for_transaction_timeout_with_expected_error(engine):
-    insert_standard_output_data(engine.connect())
-    locking_connection = engine.connect()
-    blocked_connection = engine.connect()
+def test_process_li_code_with_on_conflict_upsert_populates_expected_output(connection, on_conflict_upsert_strategy):
+    insert_standard_output_data(connection)
+    connection.execute("UPDATE {} SET clicks = 0 WHERE flight_id = '123456';".format(OUTPUT_TABLE_FULL_NAME))
+    connection.execute("DELETE FROM {} WHERE flight_id = '123456' AND date = '2018-05-01';".format(OUTPUT_TABLE_FULL_NAME))
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'li_code', 'LI-7891011')
+
+    results = select_all_from_output_table(connection)
+    assert results == get_standard_output_data()
+
+
+def test_upsert_with_on_conflict_with_unchanged_data_writes_nothing(connection, on_conflict_upsert_strategy):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    row_versions_before = select_row_versions_from_output_table(connection)
+
+    with connection.begin() as transaction:
+        temp_table = h.generate_expected_data_temp_table(connection, 'li_code', 'LI-123456')
+        deleted, inserted = h.calculate_diffs_and_writes_to_output_table(connection, temp_table, ['123456'], True)
+
+    assert deleted == []
+    assert inserted == []
+    assert select_row_versions_from_output_table(connection) == row_versions_before
+
+
+def test_upsert_with_on_conflict_with_null_creative_id_updates_in_place(connection, on_conflict_upsert_strategy):
+    connection.execute("""
+            INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+            VALUES ('2018-05-01', '123456', NULL, 999, 999, 'doubleclick', 'America/New_York', 'f');
+        """.format(OUTPUT_TABLE_FULL_NAME))
+
+    with connection.begin() as transaction:
+        connection.execute("""
+                CREATE TEMP TABLE null_creative_temp_table ON COMMIT DROP AS
+                SELECT date, flight_id, creative_id, 1 AS impressions, 1 AS clicks, provider, time_zone, now() AS updated_at, is_deleted
+                FROM {};
+            """.format(OUTPUT_TABLE_FULL_NAME))
+        temp_table = h.build_temp_table('null_creative_temp_table')
+        deleted, inserted = h.calculate_diffs_and_writes_to_output_table(connection, temp_table, ['123456'], False)
+
+    assert [(row['creative_id'], row['impressions'], row['clicks']) for row in inserted] == [(None, 1, 1)]
+    results = select_all_from_output_table(connection)
+    assert results == {(datetime.date(2018, 5, 1), '123456', None, 1, 1, 'doubleclick', 'America/New_York', False)}
+
+
+def test_process_li_code_with_diff_upsert_populates_expected_output(connection, diff_upsert_strategy):
+    insert_standard_output_data(connection)
+    connection.execute("UPDATE {} SET clicks = 0 WHERE flight_id = '123456';".format(OUTPUT_TABLE_FULL_NAME))
+    connection.execute("DELETE FROM {} WHERE flight_id = '123456' AND date = '2018-05-01';".format(OUTPUT_TABLE_FULL_NAME))
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'li_code', 'LI-7891011')
+
+    results = select_all_from_output_table(connection)
+    assert results == get_standard_output_data()
+
+
+def test_upsert_with_diff_with_unchanged_data_writes_nothing(connection, diff_upsert_strategy):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    connection.execute("""
+            INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+            VALUES ('2018-05-01', '123456', '9999999', 1, 1, 'doubleclick', 'America/New_York', 't');
+        """.format(OUTPUT_TABLE_FULL_NAME))
+    row_versions_before = select_row_versions_from_output_table(connection)
+
+    deleted, inserted = h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    assert deleted == []
+    assert inserted == []
+    assert select_row_versions_from_output_table(connection) == row_versions_before
+
+
+def test_upsert_with_diff_writes_only_new_changed_and_vanished_rows_in_place(connection, diff_upsert_strategy):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    connection.execute("DELETE FROM {} WHERE flight_id = '123456' AND date = '2018-05-01' AND creative_id = '2222222';".format(OUTPUT_TABLE_FULL_NAME))
+    connection.execute("UPDATE double_click.raw_delivery SET clicks = clicks + 1 WHERE placement_id = 12121212 AND date = '2018-05-03'")
+    connection.execute("""
+            INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+            VALUES ('2018-05-01', '123456', '9999999', 1, 1, 'doubleclick', 'America/New_York', 'f');
+        """.format(OUTPUT_TABLE_FULL_NAME))
+
+    with connection.begin() as transaction:
+        tuples_written_before = select_output_table_tuples_written(connection)
+        deleted, inserted = h.process_processing_id(connection, 'li_code', 'LI-123456')
+        tuples_written = [after - before for after, before in zip(select_output_table_tuples_written(connection), tuples_written_before)]
+
+    assert [(row['creative_id'], row['date']) for row in deleted] == [('9999999', datetime.date(2018, 5, 1))]
+    assert sorted((row['creative_id'], row['date'], row['clicks']) for row in inserted) == \
+        [('1111111', datetime.date(2018, 5, 3), 8), ('2222222', datetime.date(2018, 5, 1), 2)]
+    # one insert, and two updates in place
+    assert tuples_written == [1, 2, 0, 2]
+    expected = {row[:4] + (row[4] + 1,) + row[5:] if row[2] == '1111111' and row[0] == datetime.date(2018, 5, 3) else row
+                for row in get_standard_output_data_flight123456()}
+    expected.add((datetime.date(2018, 5, 1), '123456', '9999999', 1, 1, 'doubleclick', 'America/New_York', True))
+    assert select_all_from_output_table(connection) == expected
+
+
+@pytest.mark.parametrize('upsert_strategy, expected_tuples_written', [
+    # every one of the flight's 8 rows deleted and inserted again
+    (h.DELETE_INSERT_UPSERT_STRATEGY, 16),
+    (h.ON_CONFLICT_UPSERT_STRATEGY, 0),
+    (h.DIFF_UPSERT_STRATEGY, 0)
+])
+def test_process_li_code_with_unchanged_data_writes_tuples_per_upsert_strategy(connection, monkeypatch, upsert_strategy, expected_tuples_written):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', upsert_strategy)
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    with connection.begin() as transaction:
+        tuples_written_before = select_output_table_tuples_written(connection)
+        h.process_processing_id(connection, 'li_code', 'LI-123456')
+        tuples_written = [after - before for after, before in zip(select_output_table_tuples_written(connection), tuples_written_before)]
+
+    assert sum(tuples_written[:3]) == expected_tuples_written
+
+
+def test_get_output_table_reflects_once_until_invalidated(engine):
+    h.invalidate_output_table()
+    with engine.connect() as connection, engine.connect() as other_connection:
+        output_table = h.get_output_table(connection)
+
+        assert h.get_output_table(other_connection) is output_table
+        assert output_table.fullname == OUTPUT_TABLE_FULL_NAME
+        assert output_table.bind is None
+
+        h.invalidate_output_table()
+        assert h.get_output_table(other_connection) is not output_table
+
+
+def test_prepare_connection_prepares_statements_once_per_session(connection):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'import_id', '1')
+
+    prepared_statements = connection.execute("SELECT name, statement FROM pg_prepared_statements").fetchall()
+    assert {name for name, statement in prepared_statements} == \
+        set(h.BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.values()) | \
+        set(h.INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.values()) | \
+        set(h.INPUT_FINGERPRINT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.values()) | \
+        set(h.DATE_WINDOW_BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.values()) | \
+        set(h.DATE_WINDOW_INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE.values())
+    assert all('LI-123456' not in statement for name, statement in prepared_statements)
+
+
+def test_prepare_connection_after_rollback_sets_up_session_again(engine):
+    # start from a new session, so the session is first set up inside the rolled back transaction
+    connection = h.create_new_engine(str(engine.url), 1, 0).connect()
+    with pytest.raises(Exception):
+        with connection.begin() as transaction:
+            h.generate_expected_data_temp_table(connection, 'li_code', 'LI-123456')
+            raise ValueError()
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    results = select_all_from_output_table(connection)
+    assert results == get_standard_output_data_flight123456()
+
+
+def test_create_new_engine_sets_session_settings_once_per_connection(engine):
+    connection = h.create_new_engine(str(engine.url), 1, 0).connect()
+    statements = []
+    event.listen(connection, 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    assert connection.execute("SELECT setting FROM pg_settings WHERE name = 'lock_timeout'").scalar() == str(h.LOCK_TIMEOUT_MS)
+    assert connection.execute("SHOW application_name").scalar() == h.APPLICATION_NAME
+    assert not [statement for statement in statements if statement.lstrip().upper().startswith('SET ')]
+    connection.close()
+
+
+def test_check_idle_connection_is_alive_reconnects_terminated_connection(engine, monkeypatch):
+    monkeypatch.setattr(h, 'LIVENESS_CHECK_IDLE_SECONDS', 0)
+    single_connection_engine = h.create_new_engine(str(engine.url), 1, 0)
+    connection = single_connection_engine.connect()
+    terminated_pid = connection.execute("SELECT pg_backend_pid()").scalar()
+    connection.close()
+    engine.execute("SELECT pg_terminate_backend({})".format(terminated_pid))
+
+    connection = single_connection_engine.connect()
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
 
-    with locking_connection.begin() as transaction:
-        locking_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
-        h.set_lock_timeout_for_transaction(blocked_connection)
-        with pytest.raises(OperationalError):
-            try:
-                blocked_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
-            except OperationalError as e:
-                if h.LOCK_ERROR_MESSAGE in traceback.format_exc():
-                    raise
+    assert connection.execute("SELECT pg_backend_pid()").scalar() != terminated_pid
+    assert connection.execute("SHOW application_name").scalar() == h.APPLICATION_NAME
+    assert select_all_from_output_table(connection) == get_standard_output_data_flight123456()
+    connection.close()
+
+
+@pytest.mark.parametrize('upsert_strategy', sorted(h.UPSERT_FUNCTION_BY_STRATEGY))
+@pytest.mark.parametrize('processing_id_type, processing_id', [('li_code', 'LI-123456'), ('flight_id', '123456'), ('import_id', '1')])
+def test_process_processing_id_runs_at_most_maximum_statements_per_call(connection, monkeypatch, upsert_strategy, processing_id_type, processing_id):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', upsert_strategy)
+    h.process_processing_id(connection, processing_id_type, processing_id)
+
+    # reprocessing, so the call also runs every write statement of an output table that is already populated
+    with statement_helper.count_statements() as statement_stats:
+        h.process_processing_id(connection, processing_id_type, processing_id)
+
+    assert statement_stats.statements <= MAXIMUM_STATEMENTS_PER_CALL_BY_PROCESSING_ID_TYPE[processing_id_type], \
+        list(statement_stats.stats_by_fingerprint)
+    assert statement_stats.round_trips == statement_stats.statements
+    assert not [fingerprint for fingerprint in statement_stats.stats_by_fingerprint
+                if 'pg_catalog' in fingerprint or 'information_schema' in fingerprint]
+
+
+@pytest.mark.parametrize('processing_id_type, processing_id', [('li_code', 'LI-123456'), ('flight_id', '123456')])
+def test_expected_data_statements_for_flight_use_flight_id_index_on_maps(connection, processing_id_type, processing_id):
+    with connection.begin() as transaction:
+        h.prepare_connection(connection)
+        # only an index that can serve the lookup avoids the seq scan once seq scans are made prohibitively expensive
+        connection.execute("SET LOCAL enable_seqscan = off;")
+        for statement_name in (h.BUILD_EXPECTED_DATA_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type],
+                               h.INSERT_WITHIN_FLIGHT_CREATIVE_CONFLICT_STATEMENT_NAME_BY_PROCESSING_ID_TYPE[processing_id_type]):
+            plan = "\n".join(row[0] for row in connection.execute(
+                text("EXPLAIN EXECUTE {0}(:processing_id)".format(statement_name)), processing_id=processing_id).fetchall())
+            assert 'Seq Scan on maps' not in plan
+            assert 'maps_flight_id_idx' in plan
+
+
+@pytest.mark.parametrize('processing_id_type, processing_id, expected_output', [
+    ('li_code', 'LI-123456', 'get_standard_output_data_flight123456'),
+    ('flight_id', '123456', 'get_standard_output_data_flight123456'),
+    ('import_id', '1', 'get_standard_output_data')
+])
+def test_process_processing_id_in_two_phases_populates_expected_output(connection, two_phase_transaction_mode, processing_id_type, processing_id, expected_output):
+    deleted, inserted = h.process_processing_id(connection, processing_id_type, processing_id)
+
+    results = select_all_from_output_table(connection)
+    assert results == globals()[expected_output]()
+    assert len(inserted) == len(results)
+
+
+def test_process_processing_id_in_two_phases_holds_no_locks_while_building_expected_data(connection, two_phase_transaction_mode, monkeypatch):
+    statements_by_transaction_mode = []
+
+    def record_transaction_mode(*args):
+        statements_by_transaction_mode.append(
+            connection.execute("SELECT current_setting('transaction_read_only'), current_setting('transaction_isolation')").fetchone())
+    generate_expected_data_temp_table = h.generate_expected_data_temp_table
+    monkeypatch.setattr(h, 'generate_expected_data_temp_table', lambda *args: (generate_expected_data_temp_table(*args), record_transaction_mode())[0])
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    assert statements_by_transaction_mode == [('on', 'repeatable read')]
+    assert select_all_from_output_table(connection) == get_standard_output_data_flight123456()
+
+
+def test_process_processing_id_in_two_phases_with_inputs_changed_processes_again(engine, connection, two_phase_transaction_mode, monkeypatch):
+    get_input_fingerprint = h.get_input_fingerprint
+    fingerprints = []
+
+    def get_input_fingerprint_changing_inputs(connection, processing_id_type, processing_id):
+        fingerprints.append(get_input_fingerprint(connection, processing_id_type, processing_id))
+        if len(fingerprints) == 1:
+            # another writer changes the inputs after the expected data was built
+            engine.execute("UPDATE double_click.raw_delivery SET impressions = impressions + 1 WHERE placement_id = 12121212")
+        return fingerprints[-1]
+    monkeypatch.setattr(h, 'get_input_fingerprint', get_input_fingerprint_changing_inputs)
+
+    try:
+        with statement_helper.count_statements() as statement_stats:
+            h.process_processing_id(connection, 'li_code', 'LI-123456')
+        results = select_all_from_output_table(connection)
+    finally:
+        engine.execute("UPDATE double_click.raw_delivery SET impressions = impressions - 1 WHERE placement_id = 12121212")
+
+    assert fingerprints[0] != fingerprints[1]
+    assert any(fingerprint.startswith('EXECUTE build_expected_data_li_code') and stats[0] == 2
+               for fingerprint, stats in statement_stats.stats_by_fingerprint.items())
+    assert results == {row[:3] + (row[3] + 1,) + row[4:] if row[2] == '1111111' else row for row in get_standard_output_data_flight123456()}
+
+
+def test_get_input_fingerprint_changes_only_with_input_rows(connection):
+    fingerprint = h.get_input_fingerprint(connection, 'flight_id', '123456')
+
+    assert fingerprint is not None
+    assert h.get_input_fingerprint(connection, 'flight_id', '123456') == fingerprint
+    assert h.get_input_fingerprint(connection, 'li_code', 'LI-123456') == fingerprint
+    connection.execute("UPDATE vendor_ids.maps SET is_deleted = is_deleted WHERE substring(li_code, 4) = '123456'")
+    assert h.get_input_fingerprint(connection, 'flight_id', '123456') != fingerprint
+    fingerprint = h.get_input_fingerprint(connection, 'flight_id', '123456')
+    connection.execute("DELETE FROM static.calendar WHERE report_date = '2018-05-01'")
+    assert h.get_input_fingerprint(connection, 'flight_id', '123456') != fingerprint
+    assert h.get_input_fingerprint(connection, 'import_id', '1') is not None
+    assert h.get_input_fingerprint(connection, 'flight_id', 'no such flight') is None
+
+
+@pytest.mark.parametrize('processing_id_type, processing_id', [('li_code', 'LI-123456'), ('flight_id', '123456')])
+def test_process_processing_id_with_date_window_only_diffs_rows_within_window(connection, processing_id_type, processing_id):
+    h.process_processing_id(connection, 'flight_id', '123456')
+    connection.execute("UPDATE double_click.raw_delivery SET impressions = impressions + 1 WHERE placement_id = 12121212")
+    connection.execute("""
+        INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+        VALUES
+            ('2018-04-29', '123456', '1111111', 1, 1, 'doubleclick', 'America/New_York', 'f'),
+            ('2018-05-03', '123456', '9999999', 1, 1, 'doubleclick', 'America/New_York', 'f')
+    """.format(OUTPUT_TABLE_FULL_NAME))
+    versions_outside_window = {row for row in select_row_versions_and_dates_from_output_table(connection) if row[2] < datetime.date(2018, 5, 2)}
+
+    deleted, inserted = h.process_processing_id(connection, processing_id_type, processing_id, h.DateWindow(datetime.date(2018, 5, 2), datetime.date(2018, 5, 3)))
+
+    assert {row['date'] for row in deleted} == {datetime.date(2018, 5, 3)}
+    assert {row['date'] for row in inserted} == {datetime.date(2018, 5, 2), datetime.date(2018, 5, 3)}
+    assert versions_outside_window <= select_row_versions_and_dates_from_output_table(connection)
+    results = select_all_from_output_table(connection)
+    expected = {row[:3] + (row[3] + 1,) + row[4:] if row[2] == '1111111' and row[0] >= datetime.date(2018, 5, 2) else row
+                for row in get_standard_output_data_flight123456()}
+    expected.add((datetime.date(2018, 4, 29), '123456', '1111111', 1, 1, 'doubleclick', 'America/New_York', False))
+    expected.add((datetime.date(2018, 5, 3), '123456', '9999999', 1, 1, 'doubleclick', 'America/New_York', True))
+    assert results == expected
+
+
+def test_process_flight_id_with_empty_date_window_only_deletes_rows_within_window(connection):
+    h.process_processing_id(connection, 'flight_id', '123456')
+    connection.execute("""
+        INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+        VALUES ('2018-06-01', '123456', '1111111', 1, 1, 'doubleclick', 'America/New_York', 'f')
+    """.format(OUTPUT_TABLE_FULL_NAME))
+
+    h.process_processing_id(connection, 'flight_id', '123456', h.DateWindow(datetime.date(2018, 6, 1), datetime.date(2018, 6, 30)))
+
+    expected = get_standard_output_data_flight123456()
+    expected.add((datetime.date(2018, 6, 1), '123456', '1111111', 1, 1, 'doubleclick', 'America/New_York', True))
+    assert select_all_from_output_table(connection) == expected
+
+
+def test_resolve_date_window_covers_every_date_window_and_import(connection):
+    date_window = h.DateWindow(datetime.date(2018, 5, 10), datetime.date(2018, 5, 12))
+
+    assert h.get_date_window_of_import(connection, '1') == h.DateWindow(datetime.date(2018, 4, 30), datetime.date(2018, 5, 3))
+    assert h.get_date_window_of_import(connection, '2') is None
+    assert h.resolve_date_window(connection, [date_window, '1']) == h.DateWindow(datetime.date(2018, 4, 30), datetime.date(2018, 5, 12))
+    assert h.resolve_date_window(connection, [date_window]) == date_window
+    # an import without raw delivery can't limit the dates
+    assert h.resolve_date_window(connection, [date_window, '2']) is None
+    assert h.resolve_date_window(connection, None) is None
+
+
+def test_process_import_id_ignores_date_window(connection):
+    h.process_processing_id(connection, 'import_id', '1', h.DateWindow(datetime.date(2018, 5, 3), datetime.date(2018, 5, 3)))
+
+    assert select_all_from_output_table(connection) == get_standard_output_data()
+
+
+@pytest.mark.parametrize('transaction_mode', [h.ONE_TRANSACTION_MODE, h.TWO_PHASE_TRANSACTION_MODE])
+def test_process_processing_id_with_unchanged_inputs_writes_nothing(engine, connection, input_fingerprint_cache, transaction_mode, monkeypatch):
+    monkeypatch.setattr(processor_config, 'transaction_mode', transaction_mode)
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    # read on another connection, as two phases can't start on a connection left in a transaction by a SELECT
+    with engine.connect() as other_connection:
+        row_versions = select_row_versions_from_output_table(other_connection)
+
+    with m.record_phase_metrics({'processing_id_type': 'test'}) as phase_metrics:
+        assert h.process_processing_id(connection, 'li_code', 'LI-123456') == ([], [])
+        with engine.connect() as other_connection:
+            assert select_row_versions_from_output_table(other_connection) == row_versions
+        # cached per processing_id, so the flight_id of the same flight is still processed
+        assert h.process_processing_id(connection, 'flight_id', '123456') != ([], [])
+
+    assert get_input_fingerprint_cache_counts(phase_metrics) == {'input_fingerprint_cache_hits': 1, 'input_fingerprint_cache_misses': 1}
+    assert select_all_from_output_table(connection) == get_standard_output_data_flight123456()
+
+
+def test_process_processing_id_with_changed_inputs_misses_input_fingerprint_cache(connection, input_fingerprint_cache):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    connection.execute("UPDATE double_click.raw_delivery SET impressions = impressions + 1 WHERE placement_id = 12121212")
+
+    with m.record_phase_metrics({'processing_id_type': 'test'}) as phase_metrics:
+        deleted, inserted = h.process_processing_id(connection, 'li_code', 'LI-123456')
+        assert h.process_processing_id(connection, 'li_code', 'LI-123456') == ([], [])
+
+    assert len(inserted) == len(get_standard_output_data_flight123456())
+    assert get_input_fingerprint_cache_counts(phase_metrics) == {'input_fingerprint_cache_hits': 1, 'input_fingerprint_cache_misses': 1}
+    assert select_all_from_output_table(connection) == \
+        {row[:3] + (row[3] + 1,) + row[4:] if row[2] == '1111111' else row for row in get_standard_output_data_flight123456()}
+
+
+def test_process_processing_id_writing_flight_drops_input_fingerprints_covering_it(connection, input_fingerprint_cache):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'li_code', 'LI-7891011')
+    assert select_cached_flight_ids(connection) == {('li_code', 'LI-123456'): ['123456'], ('li_code', 'LI-7891011'): ['7891011']}
+
+    # the import rewrites the flights' rows, so the li_codes of the same flights are processed again
+    h.process_processing_id(connection, 'import_id', '1')
+    assert select_cached_flight_ids(connection) == {('import_id', '1'): ['123456', '7891011']}
+    with m.record_phase_metrics({'processing_id_type': 'test'}) as phase_metrics:
+        assert h.process_processing_id(connection, 'li_code', 'LI-123456') != ([], [])
+
+    assert get_input_fingerprint_cache_counts(phase_metrics) == {'input_fingerprint_cache_misses': 1}
+    assert select_all_from_output_table(connection) == get_standard_output_data()
+
+
+@pytest.mark.parametrize('write_query', [
+    "UPDATE {} SET clicks = 0 WHERE flight_id = '123456';".format(OUTPUT_TABLE_FULL_NAME),
+    "DELETE FROM {} WHERE flight_id = '123456' AND date = '2018-05-01';".format(OUTPUT_TABLE_FULL_NAME),
+    "TRUNCATE {};".format(OUTPUT_TABLE_FULL_NAME)
+])
+def test_out_of_band_output_write_drops_input_fingerprints_of_its_flights(connection, input_fingerprint_cache, write_query):
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'li_code', 'LI-7891011')
+
+    connection.execute(write_query)
+
+    assert ('li_code', 'LI-123456') not in select_cached_flight_ids(connection)
+    assert h.process_processing_id(connection, 'li_code', 'LI-123456') != ([], [])
+    assert select_all_from_output_table(connection) >= get_standard_output_data_flight123456()
+
+
+def test_process_processing_id_with_date_window_doesnt_cache_input_fingerprint(connection, input_fingerprint_cache):
+    h.process_processing_id(connection, 'flight_id', '123456', h.DateWindow(datetime.date(2018, 5, 3), datetime.date(2018, 5, 3)))
+
+    assert h.process_processing_id(connection, 'flight_id', '123456') != ([], [])
+    assert select_all_from_output_table(connection) == get_standard_output_data_flight123456()
+    assert h.process_processing_id(connection, 'flight_id', '123456') == ([], [])
+
+
+def test_process_li_code_with_advisory_locks_populates_expected_output(connection, advisory_locking_mode):
+    insert_standard_output_data(connection)
+    connection.execute("UPDATE {} SET clicks = 0 WHERE flight_id = '123456';".format(OUTPUT_TABLE_FULL_NAME))
+
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+    h.process_processing_id(connection, 'import_id', '1')
+
+    results = select_all_from_output_table(connection)
+    assert results == get_standard_output_data()
+
+
+def test_lock_flights_with_advisory_locks_blocks_new_flight_with_expected_error(engine, advisory_locking_mode):
+    with engine.connect() as locking_connection, engine.connect() as blocked_connection:
+        blocked_connection.execute(text("SET lock_timeout = 100;").execution_options(autocommit=True))
+
+        with locking_connection.begin() as transaction:
+            # flight 123456 has no output rows yet, so row locks could not have covered it
+            h.lock_flights_with_advisory_locks(locking_connection, h.get_output_table(locking_connection), ['7891011', '123456'])
+            with pytest.raises(OperationalError):
+                try:
+                    h.process_processing_id(blocked_connection, 'flight_id', '123456')
+                except OperationalError as e:
+                    if 'lock timeout' in traceback.format_exc():
+                        raise
+
+        h.process_processing_id(blocked_connection, 'flight_id', '123456')
+        assert select_all_from_output_table(blocked_connection) == get_standard_output_data_flight123456()
+
+
+def test_lock_timeout_with_expected_error(engine):
+    with engine.connect() as connection:
+        insert_standard_output_data(connection)
+    with engine.connect() as locking_connection, engine.connect() as blocked_connection:
+        blocked_connection.execute(text("SET lock_timeout = 100;").execution_options(autocommit=True))
+
+        with locking_connection.begin() as transaction:
+            locking_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
+            with pytest.raises(OperationalError):
+                try:
+                    blocked_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
+                except OperationalError as e:
+                    if 'lock timeout' in traceback.format_exc():
+                        raise
 
 
 def test_upsert_with_null_creative_id(connection):
@@ -558,6 +1038,30 @@ def select_all_from_output_table(connection):
     return {tuple(rowproxy.values()) for rowproxy in connection.execute("select date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted from {} ".format(OUTPUT_TABLE_FULL_NAME)).fetchall()}
 
 
+def select_row_versions_from_output_table(connection):
+    return {tuple(rowproxy.values()) for rowproxy in connection.execute("select ctid, xmin::text from {} ".format(OUTPUT_TABLE_FULL_NAME)).fetchall()}
+
+
+def select_output_table_tuples_written(connection):
+    """ Tuples inserted, updated, deleted and HOT updated by the session, not yet reported; only changes within a transaction are exact """
+    return connection.execute(text("""
+            SELECT n_tup_ins, n_tup_upd, n_tup_del, n_tup_hot_upd FROM pg_stat_xact_user_tables WHERE schemaname = :schema AND relname = :table
+        """), schema=h.OUTPUT_SCHEMA, table=h.OUTPUT_TABLE).fetchone()
+
+
+def select_cached_flight_ids(connection):
+    return {(row[0], row[1]): sorted(row[2]) for row in connection.execute(
+        "SELECT processing_id_type, processing_id, flight_ids FROM {};".format(h.INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME))}
+
+
+def get_input_fingerprint_cache_counts(phase_metrics):
+    return {name: count for name, count in phase_metrics.count_by_name.items() if name.startswith('input_fingerprint_cache')}
+
+
+def select_row_versions_and_dates_from_output_table(connection):
+    return {tuple(rowproxy.values()) for rowproxy in connection.execute("select ctid, xmin::text, date from {} ".format(OUTPUT_TABLE_FULL_NAME)).fetchall()}
+
+
 def get_standard_output_data():
     return get_standard_output_data_flight123456().union(get_standard_output_data_flight7891011())
 
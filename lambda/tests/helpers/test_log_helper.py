@@ -0,0 +1,66 @@
+import json
+import logging
+
+from config import processor_config
+from helpers import log_helper as l
+from helpers import metrics_helper as m
+
+#################
+##### Tests #####
+#################
+
+def test_log_info_serializes_fields_as_one_json_line(caplog):
+    caplog.set_level(logging.INFO)
+
+    l.log_info('batch_summary', records=2, units_of_work=1)
+
+    assert [json.loads(record.getMessage()) for record in caplog.records] == [
+        {'message': 'batch_summary', 'records': 2, 'units_of_work': 1}]
+
+
+def test_log_below_logger_level_never_serializes_fields(caplog, monkeypatch):
+    caplog.set_level(logging.WARNING)
+    monkeypatch.setattr(l.StructuredMessage, '__str__', lambda self: 1 / 0)
+
+    l.log_info('processing', processing_id='1')
+
+    assert not caplog.records
+
+
+def test_log_sampled_logs_only_sampled_share(caplog, monkeypatch):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(processor_config, 'log_sample_rate', 0)
+    l.log_sampled('processing', processing_id='1')
+    assert not caplog.records
+
+    monkeypatch.setattr(processor_config, 'log_sample_rate', 1)
+    l.log_sampled('processing', processing_id='1')
+    assert json.loads(caplog.records[0].getMessage()) == {'message': 'processing', 'processing_id': '1', 'sample_rate': 1}
+
+
+def test_log_warning_is_only_sampled_when_its_event_has_a_sample_rate(caplog, monkeypatch):
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr(processor_config, 'log_sample_rate_by_event', {'retrying': 0})
+    l.log_warning('retrying', error_class='deadlock')
+    l.log_warning('replica_unavailable', processing_id='1')
+
+    assert [json.loads(record.getMessage()) for record in caplog.records] == [
+        {'message': 'replica_unavailable', 'processing_id': '1'}]
+
+
+def test_log_error_adds_unit_of_work_and_phase_timings(caplog, monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', False)
+    caplog.set_level(logging.INFO)
+
+    with m.record_phase_metrics({'processing_id_type': 'li_code'}, {'processing_id': 'LI-123456'}):
+        with m.time_phase('lock'):
+            pass
+        try:
+            raise ValueError()
+        except ValueError:
+            l.log_error('processing_failed')
+
+    document = json.loads(caplog.records[0].getMessage())
+    assert (document['message'], document['processing_id_type'], document['processing_id']) == ('processing_failed', 'li_code', 'LI-123456')
+    assert list(document['phase_ms']) == ['lock']
+    assert caplog.records[0].exc_info[0] is ValueError
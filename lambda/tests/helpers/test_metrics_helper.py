@@ -0,0 +1,63 @@
+import json
+
+from config import processor_config
+from helpers import metrics_helper as m
+
+#################
+##### Tests #####
+#################
+
+def test_record_phase_metrics_emits_embedded_metric_format_line(capsys, monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', True)
+
+    with m.record_phase_metrics({'processing_id_type': 'li_code'}, {'processing_id': 'LI-123456'}):
+        with m.time_phase('lock'):
+            pass
+        m.add_phase_rows('insert', 8)
+        m.increment('retries')
+
+    document = json.loads(capsys.readouterr().out)
+    metric_directive = document['_aws']['CloudWatchMetrics'][0]
+    assert metric_directive['Namespace'] == m.METRICS_NAMESPACE
+    assert metric_directive['Dimensions'] == [['processing_id_type']]
+    assert {metric['Name']: metric['Unit'] for metric in metric_directive['Metrics']} == {
+        'total_ms': 'Milliseconds', 'lock_ms': 'Milliseconds', 'insert_rows': 'Count', 'retries': 'Count'}
+    assert document['processing_id_type'] == 'li_code'
+    assert document['processing_id'] == 'LI-123456'
+    assert document['insert_rows'] == 8
+    assert document['total_ms'] >= document['lock_ms'] >= 0
+
+
+def test_record_phase_metrics_emits_when_unit_of_work_fails(capsys, monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', True)
+
+    try:
+        with m.record_phase_metrics({'processing_id_type': 'li_code'}):
+            m.increment('attempts')
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert json.loads(capsys.readouterr().out)['attempts'] == 1
+
+
+def test_record_phase_metrics_nested_restores_outer_metrics(monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', False)
+
+    with m.record_phase_metrics({'metric_scope': 'batch'}) as batch_metrics:
+        with m.record_phase_metrics({'processing_id_type': 'li_code'}) as unit_metrics:
+            m.add_phase_rows('insert', 8)
+        m.increment('records', 2)
+
+    assert unit_metrics.rows_by_phase == {'insert': 8}
+    assert batch_metrics.rows_by_phase == {}
+    assert batch_metrics.count_by_name == {'records': 2}
+    assert m.get_current_phase_metrics() is None
+
+
+def test_time_phase_outside_of_unit_of_work_is_no_op():
+    with m.time_phase('lock'):
+        m.add_phase_rows('insert', 8)
+        m.increment('retries')
+
+    assert m.get_current_phase_metrics() is None
@@ -0,0 +1,104 @@
+import pytest
+import traceback
+
+from sqlalchemy.exc import OperationalError
+
+from config import processor_config
+from helpers import database_helper as h
+from helpers import psycopg2_helper as p
+from test_database_helper import (OUTPUT_TABLE_FULL_NAME, reset_upstream_tables, truncate_all_tables, truncate_output_table,
+                                  select_all_from_output_table, get_standard_output_data, get_standard_output_data_flight123456)
+from test_server_function_helper import PARITY_SCENARIOS, setup_scenario
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_and_teardown_for_entire_test_suite(engine):
+    yield
+    # Teardown after ending entire test suite
+    with engine.connect() as connection:
+        truncate_all_tables(connection)
+        truncate_output_table(connection)
+
+
+@pytest.fixture(scope="function")
+def connection(engine):
+    with engine.connect() as connection:
+        yield connection
+
+
+@pytest.fixture(scope="function", params=sorted(h.UPSERT_FUNCTION_BY_STRATEGY))
+def upsert_strategy(request, monkeypatch):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', request.param)
+
+
+@pytest.fixture(scope="function", params=sorted(h.LOCK_FUNCTION_BY_LOCKING_MODE))
+def locking_mode(request, monkeypatch):
+    monkeypatch.setattr(processor_config, 'locking_mode', request.param)
+
+
+#################
+##### Tests #####
+#################
+
+@pytest.mark.parametrize('with_standard_output, setup_queries, processing_id_pairs', list(PARITY_SCENARIOS.values()), ids=list(PARITY_SCENARIOS))
+def test_process_processing_id_with_psycopg2_matches_sqlalchemy_engine(connection, upsert_strategy, with_standard_output, setup_queries, processing_id_pairs):
+    setup_scenario(connection, with_standard_output, setup_queries)
+    sqlalchemy_results = [h.process_processing_id(connection, processing_id_type, processing_id)
+                          for processing_id_type, processing_id in processing_id_pairs]
+    sqlalchemy_output = select_all_from_output_table(connection)
+
+    setup_scenario(connection, with_standard_output, setup_queries)
+    psycopg2_results = [p.process_processing_id_with_psycopg2(connection, processing_id_type, processing_id)
+                        for processing_id_type, processing_id in processing_id_pairs]
+    psycopg2_output = select_all_from_output_table(connection)
+
+    assert psycopg2_output == sqlalchemy_output
+    assert [(len(deleted), len(inserted)) for deleted, inserted in psycopg2_results] == \
+        [(len(deleted), len(inserted)) for deleted, inserted in sqlalchemy_results]
+    assert [sorted(deleted, key=repr) for deleted, inserted in psycopg2_results] == \
+        [sorted(deleted, key=repr) for deleted, inserted in sqlalchemy_results]
+
+
+def test_process_processing_id_with_psycopg2_populates_expected_output(connection, locking_mode):
+    setup_scenario(connection, False, [])
+
+    p.process_processing_id_with_psycopg2(connection, 'li_code', 'LI-123456')
+    p.process_processing_id_with_psycopg2(connection, 'import_id', '1')
+
+    assert select_all_from_output_table(connection) == get_standard_output_data()
+
+
+def test_process_processing_id_with_psycopg2_drops_input_fingerprints_of_flights_written(connection, monkeypatch):
+    monkeypatch.setattr(processor_config, 'input_fingerprint_cache', True)
+    setup_scenario(connection, False, [])
+    h.process_processing_id(connection, 'li_code', 'LI-123456')
+
+    p.process_processing_id_with_psycopg2(connection, 'flight_id', '123456')
+
+    assert h.process_processing_id(connection, 'li_code', 'LI-123456') != ([], [])
+    connection.execute("TRUNCATE {};".format(h.INPUT_FINGERPRINT_CACHE_TABLE_FULL_NAME))
+
+
+def test_process_processing_id_with_psycopg2_lock_timeout_with_expected_error(engine):
+    with engine.connect() as connection:
+        setup_scenario(connection, True, [])
+    with engine.connect() as locking_connection, engine.connect() as blocked_connection:
+        blocked_connection.execute(h.text("SET lock_timeout = 100;").execution_options(autocommit=True))
+
+        with locking_connection.begin() as transaction:
+            locking_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
+            with pytest.raises(OperationalError):
+                try:
+                    p.process_processing_id_with_psycopg2(blocked_connection, 'li_code', 'LI-123456')
+                except OperationalError as e:
+                    if 'lock timeout' in traceback.format_exc():
+                        raise
+
+        # the failed attempt was rolled back, and the session can be used again
+        truncate_output_table(locking_connection)
+        p.process_processing_id_with_psycopg2(blocked_connection, 'li_code', 'LI-123456')
+        assert select_all_from_output_table(blocked_connection) == get_standard_output_data_flight123456()
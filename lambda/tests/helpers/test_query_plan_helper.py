@@ -0,0 +1,90 @@
+import datetime
+import json
+import logging
+
+import pytest
+
+from config import processor_config
+from helpers import database_helper as h
+from helpers import query_plan_helper as q
+from test_database_helper import (reset_upstream_tables, truncate_all_tables, truncate_output_table, insert_standard_output_data,
+                                  select_all_from_output_table, get_standard_output_data)
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_and_teardown_for_entire_test_suite(engine):
+    with engine.connect() as connection:
+        reset_upstream_tables(connection)
+    yield
+    # Teardown after ending entire test suite
+    with engine.connect() as connection:
+        truncate_all_tables(connection)
+
+
+@pytest.fixture(scope="function")
+def connection(engine):
+    with engine.connect() as connection:
+        truncate_output_table(connection)
+        yield connection
+
+
+@pytest.fixture(scope="function")
+def capture_every_slow_invocation(monkeypatch):
+    monkeypatch.setattr(processor_config, 'slow_invocation_threshold_ms', 100)
+    monkeypatch.setattr(processor_config, 'query_plan_sample_rate', 1.0)
+    monkeypatch.setattr(processor_config, 'processing_engine', 'python')
+    monkeypatch.setattr(q, '_last_capture_time', None)
+
+
+#################
+##### Tests #####
+#################
+
+@pytest.mark.parametrize('processing_id_type, processing_id, date_window', [
+    ('li_code', 'LI-123456', None),
+    ('flight_id', '123456', h.DateWindow(datetime.date(2018, 5, 2), datetime.date(2018, 5, 3))),
+    ('import_id', '1', None)
+])
+def test_capture_query_plan_explains_expected_data_statement_and_writes_nothing(connection, processing_id_type, processing_id, date_window):
+    insert_standard_output_data(connection)
+
+    query_plan = q.capture_query_plan(connection, processing_id_type, processing_id, date_window)
+
+    assert 'Shared Hit Blocks' in query_plan[0]['Plan'] and 'Actual Total Time' in query_plan[0]['Plan']
+    assert select_all_from_output_table(connection) == get_standard_output_data()
+    assert connection.execute("SELECT COUNT(*) FROM " + h.TEMP_TABLE_NAME).scalar() == 0
+
+
+def test_capture_query_plan_on_autocommit_connection_raises_before_explaining(engine):
+    with engine.connect() as connection:
+        autocommit_connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        with pytest.raises(RuntimeError):
+            q.capture_query_plan(autocommit_connection, 'import_id', '1')
+
+
+def test_maybe_capture_query_plan_logs_slow_invocation_once_per_interval(connection, capture_every_slow_invocation, caplog):
+    caplog.set_level(logging.INFO)
+
+    assert not q.maybe_capture_query_plan(connection, 'import_id', '1', 99)
+    assert q.maybe_capture_query_plan(connection, 'import_id', '1', 100)
+    assert not q.maybe_capture_query_plan(connection, 'import_id', '1', 100)
+
+    plan_logs = [json.loads(record.getMessage()) for record in caplog.records if record.getMessage().startswith('{')]
+    assert [(plan_log['message'], plan_log['processing_id_type'], plan_log['processing_id'], plan_log['duration_ms'])
+            for plan_log in plan_logs] == [('query_plan', 'import_id', '1', 100)]
+    assert 'Actual Total Time' in plan_logs[0]['plan'][0]['Plan']
+
+
+def test_maybe_capture_query_plan_skips_server_function_engine(connection, capture_every_slow_invocation, monkeypatch):
+    monkeypatch.setattr(processor_config, 'processing_engine', 'server_function')
+
+    assert not q.maybe_capture_query_plan(connection, 'import_id', '1', 100)
+
+
+def test_maybe_capture_query_plan_failure_is_not_raised(connection, capture_every_slow_invocation):
+    assert not q.maybe_capture_query_plan(connection, 'unknown_type', '1', 100)
+    assert connection.execute("SELECT 1").scalar() == 1
@@ -0,0 +1,124 @@
+import json
+import logging
+
+import pytest
+
+from sqlalchemy.exc import OperationalError
+
+from helpers import retry_helper as r
+from test_database_helper import OUTPUT_TABLE_FULL_NAME
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="function")
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(r.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+#################
+##### Tests #####
+#################
+
+@pytest.mark.parametrize('errcode, error_class', [
+    ('deadlock_detected', r.DEADLOCK_ERROR_CLASS),
+    ('serialization_failure', r.SERIALIZATION_FAILURE_ERROR_CLASS),
+    ('admin_shutdown', r.CONNECTION_ERROR_CLASS),
+    ('connection_failure', r.CONNECTION_ERROR_CLASS),
+    ('division_by_zero', None),
+    ('unique_violation', None)
+])
+def test_classify_error_by_sqlstate(engine, errcode, error_class):
+    error = raise_database_error(engine, errcode)
+
+    assert r.classify_error(error) == error_class
+
+
+def test_classify_error_with_lock_timeout(engine):
+    with engine.connect() as locking_connection:
+        with locking_connection.begin() as transaction:
+            locking_connection.execute("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(OUTPUT_TABLE_FULL_NAME))
+            with pytest.raises(OperationalError) as excinfo:
+                with engine.connect() as connection, connection.begin():
+                    connection.execute("SET LOCAL lock_timeout = 100; SELECT * FROM {}".format(OUTPUT_TABLE_FULL_NAME))
+
+    assert r.classify_error(excinfo.value) == r.LOCK_TIMEOUT_ERROR_CLASS
+
+
+def test_classify_error_with_non_database_error():
+    assert r.classify_error(ValueError('not a database error')) is None
+
+
+def test_call_with_retries_retries_until_success_with_backoff(engine, sleeps):
+    deadlock = raise_database_error(engine, 'deadlock_detected')
+    outcomes = [deadlock, deadlock, 'result']
+
+    assert r.call_with_retries(lambda: pop_outcome(outcomes), 'flight_id 123456') == 'result'
+    policy = r.RETRY_POLICY_BY_ERROR_CLASS[r.DEADLOCK_ERROR_CLASS]
+    assert len(sleeps) == 2
+    assert all(0 <= sleep * 1000 <= policy.base_delay_ms * 2 ** retry_number for retry_number, sleep in enumerate(sleeps))
+
+
+def test_call_with_retries_logs_each_retry(engine, sleeps, caplog):
+    caplog.set_level(logging.INFO)
+    outcomes = [raise_database_error(engine, 'deadlock_detected'), 'result']
+
+    r.call_with_retries(lambda: pop_outcome(outcomes), 'flight_id 123456')
+
+    documents = [json.loads(record.getMessage()) for record in caplog.records if record.getMessage().startswith('{')]
+    assert [(document['message'], document['description'], document['error_class']) for document in documents] == [
+        ('retrying', 'flight_id 123456', r.DEADLOCK_ERROR_CLASS)]
+
+
+def test_call_with_retries_raises_after_max_retries_of_error_class(engine, sleeps):
+    deadlock = raise_database_error(engine, 'deadlock_detected')
+    max_retries = r.RETRY_POLICY_BY_ERROR_CLASS[r.DEADLOCK_ERROR_CLASS].max_retries
+    outcomes = [deadlock] * (max_retries + 1) + ['result']
+
+    with pytest.raises(OperationalError):
+        r.call_with_retries(lambda: pop_outcome(outcomes), 'flight_id 123456')
+    assert len(sleeps) == max_retries
+
+
+def test_call_with_retries_raises_non_retryable_error_immediately(engine, sleeps):
+    outcomes = [raise_database_error(engine, 'division_by_zero'), 'result']
+
+    with pytest.raises(Exception):
+        r.call_with_retries(lambda: pop_outcome(outcomes), 'flight_id 123456')
+    assert sleeps == []
+
+
+def test_call_with_retries_raises_without_enough_remaining_time(engine, sleeps):
+    outcomes = [raise_database_error(engine, 'deadlock_detected'), 'result']
+
+    with pytest.raises(OperationalError):
+        r.call_with_retries(lambda: pop_outcome(outcomes), 'flight_id 123456', lambda: r.MINIMUM_REMAINING_TIME_TO_RETRY_MS - 1)
+    assert sleeps == []
+
+
+def test_get_backoff_ms_is_capped_at_max_delay():
+    policy = r.RetryPolicy(max_retries=10, base_delay_ms=100, max_delay_ms=500)
+
+    assert all(0 <= r.get_backoff_ms(policy, 10) <= 500 for _ in range(100))
+
+
+##########################
+##### Helper Methods #####
+##########################
+def raise_database_error(engine, errcode):
+    """ Returns the SQLAlchemy error wrapping a real psycopg2 error with the SQLSTATE of errcode """
+    try:
+        engine.execute("DO $$ BEGIN RAISE EXCEPTION 'raised by test' USING ERRCODE = '{}'; END $$;".format(errcode))
+    except Exception as e:
+        return e
+
+
+def pop_outcome(outcomes):
+    outcome = outcomes.pop(0)
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
@@ -0,0 +1,161 @@
+import pytest
+import traceback
+
+from sqlalchemy.exc import OperationalError
+
+from config import processor_config
+from helpers import database_helper as h
+from helpers import server_function_helper as s
+from test_database_helper import (OUTPUT_TABLE_FULL_NAME, reset_upstream_tables, truncate_all_tables, truncate_output_table,
+                                  insert_standard_output_data, select_all_from_output_table)
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="module", autouse=True)
+def setup_and_teardown_for_entire_test_suite(engine):
+    # Setup before starting entire test suite
+    with engine.connect() as connection:
+        s.install_server_function(connection)
+    yield
+    # Teardown after ending entire test suite
+    with engine.connect() as connection:
+        truncate_all_tables(connection)
+        truncate_output_table(connection)
+
+
+@pytest.fixture(scope="function")
+def connection(engine):
+    with engine.connect() as connection:
+        yield connection
+
+
+##################################
+##### Parity Test Scenarios #####
+##################################
+
+PARITY_SCENARIOS = {
+    'li_codes_with_empty_table': (False, [], [('li_code', 'LI-123456'), ('li_code', 'LI-7891011')]),
+    'flight_ids_with_empty_table': (False, [], [('flight_id', '123456'), ('flight_id', '7891011')]),
+    'import_id_with_empty_table': (False, [], [('import_id', '1')]),
+    'import_id_with_no_resulting_data': (False, ["UPDATE vendor_ids.maps SET is_deleted = TRUE;"], [('import_id', '1')]),
+    'li_code_with_deleted_and_updated_rows': (True, [
+        """INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+           VALUES ('2018-05-05', '123456', '1111111', 999, 999, 'doubleclick', 'America/New_York', 'f');""".format(OUTPUT_TABLE_FULL_NAME),
+        "UPDATE {} SET clicks = 0 WHERE flight_id = '123456' AND date = '2018-05-01';".format(OUTPUT_TABLE_FULL_NAME)
+    ], [('li_code', 'LI-123456')]),
+    'li_code_with_no_resulting_data': (True, ["UPDATE vendor_ids.maps SET is_deleted = TRUE WHERE li_code = 'LI-123456';"], [('li_code', 'LI-123456')]),
+    'flight_id_with_sizmek_data': (False, [
+        """INSERT INTO {} ("date", flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+           VALUES ('2018-05-03', '123456', '1111111', 50714, 7, 'mediamind', 'America/New_York', 'f');""".format(OUTPUT_TABLE_FULL_NAME)
+    ], [('flight_id', '123456')]),
+    'li_code_with_within_flight_creative_conflict': (True, [
+        "UPDATE vendor_ids.maps SET vendor_id = '12121212' WHERE li_code = 'LI-123456';",
+        """INSERT INTO vendor_ids.alignment_conflicts (li_code, li_code_2, date_start, date_end, creative_ids)
+           VALUES ('LI-123456', 'LI-123456', '2018-04-30', '2018-05-03', ARRAY[1111111, 2222222]);""",
+        """INSERT INTO {} (date, flight_id, creative_id, impressions, clicks, provider, time_zone, is_deleted)
+           VALUES ('2018-05-01', '123456', NULL, 999, 999, 'doubleclick', 'America/New_York', 'f');""".format(OUTPUT_TABLE_FULL_NAME)
+    ], [('li_code', 'LI-123456'), ('import_id', '1')]),
+}
+
+
+#################
+##### Tests #####
+#################
+
+@pytest.mark.parametrize('upsert_strategy', sorted(h.UPSERT_FUNCTION_BY_STRATEGY))
+@pytest.mark.parametrize('with_standard_output, setup_queries, processing_id_pairs', list(PARITY_SCENARIOS.values()), ids=list(PARITY_SCENARIOS))
+def test_process_processing_id_on_server_matches_python_engine(connection, monkeypatch, upsert_strategy, with_standard_output, setup_queries,
+                                                               processing_id_pairs):
+    monkeypatch.setattr(processor_config, 'upsert_strategy', upsert_strategy)
+    setup_scenario(connection, with_standard_output, setup_queries)
+    python_counts = [tuple(len(rows) for rows in h.process_processing_id(connection, processing_id_type, processing_id))
+                     for processing_id_type, processing_id in processing_id_pairs]
+    python_results = select_all_from_output_table(connection)
+
+    setup_scenario(connection, with_standard_output, setup_queries)
+    server_counts = [s.process_processing_id_on_server(connection, processing_id_type, processing_id)
+                     for processing_id_type, processing_id in processing_id_pairs]
+    server_results = select_all_from_output_table(connection)
+
+    assert server_results == python_results
+    assert server_counts == python_counts
+
+
+def test_process_processing_id_on_server_with_unknown_processing_id_type_raises(connection):
+    with pytest.raises(Exception):
+        s.process_processing_id_on_server(connection, 'unknown_type', '1')
+
+
+def test_process_processing_id_on_server_lock_timeout_with_expected_error(engine):
+    with engine.connect() as connection:
+        setup_scenario(connection, True, [])
+    with engine.connect() as locking_connection, engine.connect() as blocked_connection:
+        with locking_connection.begin() as transaction:
+            locking_connection.execute("SELECT * FROM {} FOR UPDATE".format(OUTPUT_TABLE_FULL_NAME))
+            with pytest.raises(OperationalError):
+                try:
+                    s.process_processing_id_on_server(blocked_connection, 'li_code', 'LI-123456')
+                except OperationalError as e:
+                    if 'lock timeout' in traceback.format_exc():
+                        raise
+
+
+def test_process_processing_id_on_server_with_advisory_locks_waits_for_python_engine_writer(engine, monkeypatch):
+    monkeypatch.setattr(processor_config, 'locking_mode', h.ADVISORY_LOCKING_MODE)
+    with engine.connect() as connection:
+        setup_scenario(connection, True, [])
+    with engine.connect() as locking_connection, engine.connect() as connection:
+        with locking_connection.begin() as transaction:
+            h.lock_flights_with_advisory_locks(locking_connection, None, ['123456'])
+            with pytest.raises(OperationalError) as excinfo:
+                s.process_processing_id_on_server(connection, 'li_code', 'LI-123456')
+
+    assert 'lock timeout' in str(excinfo.value)
+
+
+def test_process_processing_id_on_server_with_unknown_locking_mode_raises(connection, monkeypatch):
+    monkeypatch.setattr(processor_config, 'locking_mode', 'unknown_mode')
+
+    with pytest.raises(Exception):
+        s.process_processing_id_on_server(connection, 'li_code', 'LI-123456')
+
+
+def test_server_function_looks_up_maps_with_index_friendly_conditions():
+    with open(s.SERVER_FUNCTION_SQL_PATH) as sql_file:
+        create_function_query = sql_file.read()
+
+    assert "'" + h.CONDITION_STRING_BY_PROCESSING_ID_TYPE['li_code'] + "'" in create_function_query
+    assert "'" + h.CONDITION_STRING_BY_PROCESSING_ID_TYPE['flight_id'] + "'" in create_function_query
+    assert "WHERE substring(li_code, 4) = substring($1, 4) AND li_code = $1 GROUP BY 1" in create_function_query
+
+
+def test_install_server_function_records_version(connection):
+    s.install_server_function(connection)
+
+    assert s.get_installed_server_function_version(connection) == s.SERVER_FUNCTION_VERSION
+
+
+def test_check_server_function_version_with_other_version_raises(connection):
+    connection.execute("COMMENT ON FUNCTION {} IS '{}';".format(s.SERVER_FUNCTION_SIGNATURE, s.SERVER_FUNCTION_COMMENT.format(0)))
+    s.invalidate_server_function_version()
+
+    with pytest.raises(s.ServerFunctionVersionError):
+        s.check_server_function_version(connection)
+
+    s.install_server_function(connection)
+    s.check_server_function_version(connection)
+
+
+##########################
+##### Helper Methods #####
+##########################
+def setup_scenario(connection, with_standard_output, setup_queries):
+    reset_upstream_tables(connection)
+    truncate_output_table(connection)
+    if with_standard_output:
+        insert_standard_output_data(connection)
+    for query in setup_queries:
+        connection.execute(query)
@@ -0,0 +1,59 @@
+import sys
+
+from helpers import startup_helper as st
+
+#################
+##### Tests #####
+#################
+
+def test_import_timer_records_newly_imported_modules():
+    sys.modules.pop('colorsys', None)
+    import_timer = st.ImportTimer()
+
+    import_timer.start()
+    import colorsys
+    import json
+    import_timer.stop()
+
+    assert 'colorsys' in import_timer.cumulative_seconds_by_module
+    assert 'json' not in import_timer.cumulative_seconds_by_module
+    assert import_timer.init_duration >= import_timer.cumulative_seconds_by_module['colorsys']
+
+
+def test_import_timer_restores_import_when_stopped():
+    original_import = st.builtins.__import__
+    import_timer = st.ImportTimer()
+
+    import_timer.start()
+    import_timer.stop()
+
+    assert st.builtins.__import__ is original_import
+
+
+def test_get_report_lists_slowest_modules_first():
+    import_timer = st.ImportTimer()
+    import_timer.init_duration = 0.5
+    import_timer.connect_duration = 0.1
+    import_timer.cumulative_seconds_by_module = {'fast': 0.01, 'slow': 0.3, 'medium': 0.1}
+    import_timer.self_seconds_by_module = {'fast': 0.01, 'slow': 0.2, 'medium': 0.1}
+
+    report_lines = import_timer.get_report(module_count=2).split('\n')
+
+    assert report_lines[0] == 'Init phase: 500.0 ms, 310.0 ms importing, 100.0 ms connecting to the db'
+    assert [line.split()[-1] for line in report_lines[2:]] == ['slow', 'medium']
+
+
+def test_get_budget_overruns_leaves_db_connection_out_of_init_phase_budget():
+    import_timer = st.ImportTimer()
+    import_timer.init_duration = 2.0
+    import_timer.connect_duration = 1.0
+
+    assert st.get_budget_overruns(import_timer, budget_ms=1500) == []
+    assert len(st.get_budget_overruns(import_timer, budget_ms=500)) == 1
+    assert st.get_budget_overruns(import_timer, budget_ms=1500, connect_budget_ms=500) == [
+        'First db connection took 1000.0 ms, over budget of 500.0 ms']
+
+
+def test_resolve_name_of_relative_import():
+    assert st.resolve_name('elements', {'__package__': 'sqlalchemy.sql'}, 1) == 'sqlalchemy.sql.elements'
+    assert st.resolve_name('', {'__package__': 'sqlalchemy.sql'}, 2) == 'sqlalchemy'
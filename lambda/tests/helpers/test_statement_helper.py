@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from config import db_config, processor_config
+from conftest import get_db_postgres_string
+from helpers import database_helper as h
+from helpers import statement_helper as s
+from helpers.metrics_helper import record_phase_metrics
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="module")
+def engine():
+    # a single pooled connection, so whatever a test leaves on it is handed to the next checkout
+    engine = h.create_new_engine(get_db_postgres_string(db_config.db_test_endpoint), 1, 0)
+    yield engine
+    engine.dispose()
+
+#################
+##### Tests #####
+#################
+
+def test_get_statement_fingerprint_replaces_literals_and_parameters():
+    fingerprint, statements = s.get_statement_fingerprint(
+        "SELECT 1 FROM o WHERE flight_id IN (%(flight_id_1)s, %(flight_id_2)s) AND provider = 'dcm' -- lock\n  FOR UPDATE")
+
+    assert fingerprint == "SELECT ? FROM o WHERE flight_id IN (?, ...) AND provider = ? FOR UPDATE"
+    assert statements == 1
+    assert s.get_statement_fingerprint("SELECT 2 FROM o WHERE flight_id IN (%(flight_id_1)s) AND provider = 'it''s' FOR UPDATE")[0] == \
+        "SELECT ? FROM o WHERE flight_id IN (?) AND provider = ? FOR UPDATE"
+
+
+def test_get_statement_fingerprint_counts_statements_sent_together():
+    assert s.get_statement_fingerprint("SET a = 'x;y'; SET b = 2;")[1] == 2
+    assert s.get_statement_fingerprint("EXECUTE a(%(processing_id)s);")[1] == 1
+
+
+def test_count_statements_collects_into_every_nested_collector():
+    with s.count_statements() as outer_stats:
+        s.after_cursor_execute(*get_cursor_execute_arguments("SELECT 1"))
+        with s.count_statements() as inner_stats:
+            s.after_cursor_execute(*get_cursor_execute_arguments("SELECT 2; SELECT 3", rowcount=4))
+    s.after_cursor_execute(*get_cursor_execute_arguments("SELECT 4"))
+
+    assert (outer_stats.statements, outer_stats.round_trips, outer_stats.rows) == (3, 2, 5)
+    assert (inner_stats.statements, inner_stats.round_trips, inner_stats.rows) == (2, 1, 4)
+    assert list(outer_stats.stats_by_fingerprint) == ["SELECT ?", "SELECT ?; SELECT ?"]
+    assert outer_stats.stats_by_fingerprint["SELECT ?"][0] == 1
+
+
+def test_after_cursor_execute_adds_round_trip_to_phase_metrics(monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', False)
+    with record_phase_metrics({'metric_scope': 'test'}) as phase_metrics:
+        s.after_cursor_execute(*get_cursor_execute_arguments("SELECT 1; SELECT 2", rowcount=2))
+
+    assert 'round_trip' in phase_metrics.duration_ms_by_phase
+    assert phase_metrics.rows_by_phase['statement'] == 2
+    assert (phase_metrics.count_by_name['statements'], phase_metrics.count_by_name['round_trips']) == (2, 1)
+
+
+def test_count_statements_failed_statement_leaves_nothing_on_connection(engine):
+    connection = engine.connect()
+    try:
+        with s.count_statements() as statement_stats:
+            for _ in range(3):
+                with pytest.raises(DBAPIError):
+                    connection.execute(text("SELECT 1 / 0"))
+            connection.execute(text("SELECT 1"))
+        connection_info = dict(connection.info)
+    finally:
+        connection.close()
+
+    assert list(statement_stats.stats_by_fingerprint) == ["SELECT ?"]
+    assert not [key for key in connection_info if str(key).startswith('statement_helper')]
+
+
+##########################
+##### Helper Methods #####
+##########################
+class FakeExecutionContext(object):
+
+    def __init__(self):
+        self.statement_helper_start_time = 0.0
+
+
+class FakeCursor(object):
+
+    def __init__(self, rowcount):
+        self.rowcount = rowcount
+
+
+def get_cursor_execute_arguments(statement, rowcount=1):
+    return (None, FakeCursor(rowcount), statement, {}, FakeExecutionContext(), False)
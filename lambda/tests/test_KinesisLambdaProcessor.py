@@ -0,0 +1,159 @@
+import pytest
+import base64
+import datetime
+import json
+import logging
+import subprocess
+import sys
+
+from config import processor_config
+from helpers import database_helper as h
+import KinesisLambdaProcessor as k
+
+###########################
+##### Pytest Fixtures #####
+###########################
+
+
+@pytest.fixture(scope="function", autouse=True)
+def use_test_engine(engine, monkeypatch):
+    monkeypatch.setattr(k, 'engine', engine)
+
+
+@pytest.fixture(scope="function")
+def report_batch_item_failures(monkeypatch):
+    monkeypatch.setattr(processor_config, 'report_batch_item_failures', True)
+
+
+@pytest.fixture(scope="function")
+def processing_concurrency(monkeypatch):
+    monkeypatch.setattr(processor_config, 'processing_concurrency', 4)
+
+
+#################
+##### Tests #####
+#################
+
+def test_lambda_handler_all_records_succeed_returns_success_string():
+    event = build_kinesis_event([('import_id', '0'), ('import_id', '0')])
+
+    assert k.lambda_handler(event, None) == 'Successfully processed 2 records.'
+
+
+def test_lambda_handler_one_record_fails_returns_failure_string():
+    event = build_kinesis_event([('import_id', '0'), ('unknown_type', '0')])
+
+    assert k.lambda_handler(event, None) == 'Failed to process 2 records'
+
+
+def test_lambda_handler_emits_phase_metrics_per_unit_of_work(capsys, monkeypatch):
+    monkeypatch.setattr(processor_config, 'phase_metrics', True)
+    event = build_kinesis_event([('li_code', 'LI-123456'), ('unknown_type', '0')])
+
+    k.lambda_handler(event, None)
+
+    documents = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{')]
+    document_by_processing_id_type = {document.get('processing_id_type', 'batch'): document for document in documents}
+    assert document_by_processing_id_type['li_code']['attempts'] == 1
+    assert {'connect_ms', 'build_expected_data_ms', 'lock_ms', 'soft_delete_ms', 'total_ms'} <= set(document_by_processing_id_type['li_code'])
+    assert document_by_processing_id_type['unknown_type']['failures'] == 1
+    assert document_by_processing_id_type['batch']['records'] == 2
+    assert 'decode_ms' in document_by_processing_id_type['batch']
+
+
+def test_lambda_handler_logs_failed_unit_with_phase_timings_and_one_batch_summary(caplog, monkeypatch):
+    monkeypatch.setattr(processor_config, 'log_sample_rate', 0)
+    caplog.set_level(logging.INFO)
+    event = build_kinesis_event([('li_code', 'LI-123456'), ('unknown_type', '0')])
+
+    k.lambda_handler(event, None)
+
+    documents = [json.loads(record.getMessage()) for record in caplog.records if record.getMessage().startswith('{')]
+    assert [document['message'] for document in documents] == ['processing_failed', 'batch_summary']
+    assert documents[0]['processing_id_type'] == 'unknown_type'
+    assert documents[0]['processing_id'] == '0'
+    assert 'connect' in documents[0]['phase_ms']
+    assert (documents[1]['records'], documents[1]['units_of_work'], documents[1]['failed_units_of_work']) == (2, 2, 1)
+
+
+def test_lambda_handler_reporting_item_failures_all_records_succeed_returns_no_failures(report_batch_item_failures):
+    event = build_kinesis_event([('import_id', '0'), ('import_id', '0'), ('li_code', 'LI-0'), ('flight_id', '0')])
+
+    assert k.lambda_handler(event, None) == {'batchItemFailures': []}
+
+
+def test_lambda_handler_reporting_item_failures_returns_only_failed_sequence_numbers(report_batch_item_failures):
+    event = build_kinesis_event([('import_id', '0'), ('unknown_type', '0'), ('li_code', 'LI-0'), ('unknown_type', '0')])
+
+    assert k.lambda_handler(event, None) == {'batchItemFailures': [
+        {'itemIdentifier': get_sequence_number(1)},
+        {'itemIdentifier': get_sequence_number(3)}
+    ]}
+
+
+def test_lambda_handler_reporting_item_failures_concurrently_returns_only_failed_sequence_numbers(report_batch_item_failures, processing_concurrency):
+    event = build_kinesis_event([('li_code', 'LI-0'), ('unknown_type', '0'), ('flight_id', '1'), ('import_id', '0'), ('li_code', 'LI-2')])
+
+    assert k.lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': get_sequence_number(1)}]}
+
+
+def test_lambda_handler_reporting_item_failures_undecodable_record_returns_its_sequence_number(report_batch_item_failures):
+    event = build_kinesis_event([('import_id', '0')])
+    event['Records'].append(build_kinesis_record_from_data(b'not json', 1))
+
+    assert k.lambda_handler(event, None) == {'batchItemFailures': [{'itemIdentifier': get_sequence_number(1)}]}
+
+
+def test_lambda_handler_processes_each_unit_within_date_window_of_its_records(monkeypatch):
+    date_windows_by_processing_id_pair = {}
+
+    def process_processing_id(connection, processing_id_type, processing_id, date_window=None):
+        date_windows_by_processing_id_pair[(processing_id_type, processing_id)] = date_window
+    monkeypatch.setattr(k, 'process_processing_id', process_processing_id)
+    monkeypatch.setitem(k.PROCESS_FUNCTION_BY_PROCESSING_ENGINE, 'python', process_processing_id)
+    event = build_kinesis_event([('li_code', 'LI-123456'), ('flight_id', '123456'), ('li_code', 'LI-7891011'), ('li_code', 'LI-7891011')],
+                                [{'date_start': '2018-05-02', 'date_end': '2018-05-03'}, {'date_start': '2018-05-01', 'date_end': '2018-05-01'},
+                                 {'date_start': '2018-05-01', 'date_end': '2018-05-01'}, {}])
+
+    assert k.lambda_handler(event, None) == 'Successfully processed 4 records.'
+    assert date_windows_by_processing_id_pair == {
+        ('flight_id', '123456'): h.DateWindow(datetime.date(2018, 5, 1), datetime.date(2018, 5, 3)),
+        ('li_code', 'LI-7891011'): None
+    }
+
+
+def test_import_leaves_optional_engine_helpers_unimported():
+    imported_modules = subprocess.check_output([sys.executable, '-c', 'import sys, KinesisLambdaProcessor; print(" ".join(sys.modules))'],
+                                               universal_newlines=True).split()
+
+    assert not {'helpers.psycopg2_helper', 'helpers.server_function_helper', 'helpers.replica_helper',
+                'helpers.query_plan_helper'} & set(imported_modules)
+
+
+##########################
+##### Helper Methods #####
+##########################
+def build_kinesis_event(processing_id_pairs, extra_fields=None):
+    return {'Records': [build_kinesis_record(processing_id_type, processing_id, index, extra_fields[index] if extra_fields else None)
+                        for index, (processing_id_type, processing_id) in enumerate(processing_id_pairs)]}
+
+
+def build_kinesis_record(processing_id_type, processing_id, index, extra_fields=None):
+    payload = json.dumps(dict({'processing_id_type': processing_id_type, 'processing_id': processing_id}, **(extra_fields or {})))
+    return build_kinesis_record_from_data(payload.encode("utf-8"), index)
+
+
+def build_kinesis_record_from_data(data, index):
+    return {
+        'eventSource': 'aws:kinesis',
+        'eventID': 'shardId-000000000000:' + get_sequence_number(index),
+        'kinesis': {
+            'partitionKey': str(index),
+            'sequenceNumber': get_sequence_number(index),
+            'data': base64.b64encode(data).decode("utf-8")
+        }
+    }
+
+
+def get_sequence_number(index):
+    return str(49590338271490256608559692538361571095921575989136588898 + index)